@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+''' Scaling benchmark of the tetrad analysis on synthetic structures.
+    Each case times group_tetrads(), analyze_twist() and the full analyze() on a generated model
+    as the number of decoy guanines or tetrads grows, the results are compared with a stored baseline. '''
+import sys, os, getopt, time, math
+from StringIO import StringIO
+import tetrad
+import pdbstream
+import synth
+
+# Stored baseline next to the test sets
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'bench.tsv')
+# Benchmark cases as (case, parameter, values, fixed generator parameters)
+CASES = [
+    ('decoys', 'decoys', (0, 50, 100, 200, 400, 800), {'tetrads': 4, 'loops': 'LDL', 'jitter': 0.1}),
+    ('tetrads', 'tetrads', (2, 4, 8, 16, 32), {'strands': 4, 'loops': '', 'jitter': 0.1}),
+]
+# Timed functions
+METRICS = ('group', 'twist', 'analyze')
+# Maximum slope of log(time) over log(guanines) before the scaling is reported as superlinear
+SLOPE_MAX = 1.5
+
+def generate_model(**params):
+    ''' Generate synthetic model with fixed seed. '''
+    out = StringIO()
+    synth.generate(out, seed = 1, **params)
+    out.seek(0)
+    return list(pdbstream.parse_models(out, 'synth'))[0]
+
+def best_time(func, repeat):
+    ''' Return the best wall time [ms] of repeated calls. '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = 1000.0 * (time.time() - start)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run_case(case, param, value, params, repeat = 3):
+    ''' Time single benchmark case, returns (case, value, guanines, tetrads, group, twist, analyze). '''
+    params = dict(params)
+    params[param] = value
+    model = generate_model(**params)
+    (guanines, strands) = tetrad.model_guanines(model)
+    tetrads = tetrad.group_tetrads(guanines)
+    verbose = tetrad.VERBOSE
+    tetrad.VERBOSE = False
+    try:
+        times = [best_time(lambda: tetrad.group_tetrads(guanines), repeat),
+                 best_time(lambda: tetrad.analyze_twist(tetrads), repeat),
+                 best_time(lambda: tetrad.analyze(model), repeat)]
+    finally:
+        tetrad.VERBOSE = verbose
+    return [case, value, len(guanines), len(tetrads)] + times
+
+def scaling(rows, column):
+    ''' Least squares slope of log(time) over log(guanines) for each case. '''
+    slopes = {}
+    for case in sorted(set([row[0] for row in rows])):
+        points = [(math.log(row[2]), math.log(max(row[column], 1e-3))) for row in rows if row[0] == case]
+        if len(points) < 2:
+            continue
+        mean_x = sum([x for (x, y) in points]) / len(points)
+        mean_y = sum([y for (x, y) in points]) / len(points)
+        var = sum([(x - mean_x) ** 2 for (x, y) in points])
+        if var > 0:
+            slopes[case] = sum([(x - mean_x) * (y - mean_y) for (x, y) in points]) / var
+    return slopes
+
+def write_rows(rows, output):
+    ''' Write benchmark rows as TSV. '''
+    output.write(';Case\tValue\tGuanines\tTetrads\t%s\n' % '\t'.join(['%s[ms]' % metric for metric in METRICS]))
+    for row in rows:
+        output.write('%s\t%d\t%d\t%d\t%s\n' % (row[0], row[1], row[2], row[3], '\t'.join(['%.03f' % t for t in row[4:]])))
+
+def load_rows(filename):
+    ''' Load benchmark rows from TSV. '''
+    rows = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith(';') or not line.strip():
+                continue
+            cols = line.rstrip('\n').split('\t')
+            rows.append([cols[0], int(cols[1]), int(cols[2]), int(cols[3])] + [float(t) for t in cols[4:]])
+    return rows
+
+def compare(rows, baseline, tolerance):
+    ''' Compare times with the baseline, returns list of regression messages. '''
+    reference = dict([((row[0], row[1]), row) for row in baseline])
+    regressions = []
+    for row in rows:
+        base = reference.get((row[0], row[1]))
+        if base is None:
+            continue
+        if base[3] != row[3]:
+            regressions.append('%s=%d: %d tetrads found, baseline %d' % (row[0], row[1], row[3], base[3]))
+        for (i, metric) in enumerate(METRICS):
+            # Sub-millisecond times are too noisy to compare
+            if row[4 + i] > tolerance * max(base[4 + i], 1.0):
+                regressions.append('%s=%d: %s %.02f ms, baseline %.02f ms' % (row[0], row[1], metric, row[4 + i], base[4 + i]))
+    return regressions
+
+def help():
+    ''' Print help and exit. '''
+    print('Usage: %s [-b <baseline>] [-s] [-r <n>] [-t <x>]' % sys.argv[0])
+    print('Parameters:')
+    print('\t-b <baseline>, --baseline=<baseline>\tBaseline TSV (default: test/bench.tsv).')
+    print('\t-s, --save\tSave the results as a new baseline.')
+    print('\t-r <n>, --repeat=<n>\tNumber of repeated runs, the best time is taken (default: 3).')
+    print('\t-t <x>, --tolerance=<x>\tReport regression if slower than x-times the baseline (default: 2.0).')
+    sys.exit(1)
+
+if __name__ == '__main__':
+
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hb:sr:t:", ["help", "baseline=", "save", "repeat=", "tolerance="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        help()
+    baseline = BASELINE
+    save = False
+    repeat = 3
+    tolerance = 2.0
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            help()
+        elif o in ('-b', '--baseline'):
+            baseline = a
+        elif o in ('-s', '--save'):
+            save = True
+        elif o in ('-r', '--repeat'):
+            repeat = int(a)
+        elif o in ('-t', '--tolerance'):
+            tolerance = float(a)
+        else:
+            help()
+
+    rows = []
+    for (case, param, values, params) in CASES:
+        for value in values:
+            rows.append(run_case(case, param, value, params, repeat))
+    write_rows(rows, sys.stdout)
+
+    # Report superlinear scaling
+    return_code = 0
+    for (i, metric) in enumerate(METRICS):
+        for (case, slope) in sorted(scaling(rows, 4 + i).items()):
+            print('> %s scaling over %s: O(n^%.02f)' % (metric, case, slope))
+            if slope > SLOPE_MAX:
+                print('  [!!] superlinear scaling')
+                return_code = 1
+
+    if save:
+        with open(baseline, 'w') as output:
+            write_rows(rows, output)
+        print('> baseline saved to "%s"' % baseline)
+    elif os.path.isfile(baseline):
+        regressions = compare(rows, load_rows(baseline), tolerance)
+        for message in regressions:
+            print('  [!!] regression %s' % message)
+        if len(regressions) > 0:
+            return_code = 1
+        else:
+            print('> no regressions against "%s"' % baseline)
+
+    sys.exit(return_code)
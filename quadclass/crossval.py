@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+''' Stratified k-fold cross-validation of the sequence predictor and the geometric classifiers.
+    The folds are built from the structures of each class, so the models of one structure are
+    never split between the training and the testing set. The (data set, method, fold) jobs run
+    in a pool of worker processes, the accuracy and ROC AUC are printed as a TSV table. '''
+import sys, getopt, multiprocessing, itertools
+import numpy
+import gqtable
+import seqlearn
+
+# Sequence predictor method, the other methods are quadlearn classifiers
+SEQUENCE = 'seq'
+
+def make_folds(table, k = 10, seed = 0):
+    ''' Split the result table rows into k folds stratified by class, returns list of the row indices
+        of each fold. The structures of each class are shuffled and dealt to the folds in turn,
+        the class of a structure is the class of its first row. '''
+    names = table.codes('name')
+    (structures, first) = numpy.unique(names, return_index = True)
+    classes = table.codes('qclass')[first]
+    fold = numpy.zeros(len(table.values('name')), int)
+    random = numpy.random.RandomState(seed)
+    dealt = 0
+    for qclass in range(len(table.values('qclass'))):
+        members = structures[classes == qclass]
+        random.shuffle(members)
+        # Small classes continue where the previous one ended, so the folds are even
+        fold[members] = (dealt + numpy.arange(len(members))) % k
+        dealt += len(members)
+    fold = fold[names]
+    return [numpy.nonzero(fold == i)[0] for i in range(k)]
+
+def run_fold(job):
+    ''' Train the method on all but the tested fold and evaluate it on the fold, the job is
+        a (data set, method, fold, table, test rows) tuple. Returns the job key and
+        {label: (y_true, y_pred)}, the sequence predictor is evaluated for each reason. '''
+    (dataset, method, fold, table, test) = job
+    train = numpy.setdiff1d(numpy.arange(len(table)), test)
+    if method == SEQUENCE:
+        predictor = seqlearn.Predictor(seqlearn.table_classlist(table, train))
+        scores = seqlearn.evaluate(predictor, table, test)
+        scores = dict([('%s:%s' % (method, reason), scores[reason]) for reason in seqlearn.REASONS])
+    else:
+        import quadlearn
+        classifier = quadlearn.Classifier(table, train, method)
+        scores = {method: quadlearn.evaluate(classifier, table, test)}
+    return ((dataset, method, fold), scores)
+
+def fold_jobs(dataset, methods, k = 10, seed = 0):
+    ''' List jobs for the folds of the data set. '''
+    table = gqtable.load(dataset)
+    folds = make_folds(table, k, seed)
+    return [(dataset, method, i, table, test) for method in methods for (i, test) in enumerate(folds)]
+
+def run_jobs(jobs, processes = 1):
+    ''' Run fold jobs in a pool of worker processes, returns the results in the order of jobs. '''
+    pool = None
+    results = itertools.imap(run_fold, jobs)
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(run_fold, jobs)
+    try:
+        return list(results)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def score_row(dataset, label, fold, y_true, y_pred):
+    ''' Return result table row, (data set, method, fold, tested, accuracy, AUC). '''
+    if len(y_true) == 0:
+        return [dataset, label, fold, 0, float('nan'), float('nan')]
+    (fpr, tpr, thresholds) = seqlearn.roc_curve(y_true, y_pred)
+    return [dataset, label, fold, len(y_true), y_true.count(True) / float(len(y_true)), seqlearn.roc_auc(fpr, tpr)]
+
+def summarize(results):
+    ''' Return result table rows of each fold and the folds pooled together ('all'), and the pooled
+        ROC curves as {(data set, label): (fpr, tpr, thresholds)}. '''
+    rows = []
+    pooled = dict()
+    for ((dataset, method, fold), scores) in results:
+        for label in sorted(scores):
+            (y_true, y_pred) = scores[label]
+            rows.append(score_row(dataset, label, fold, y_true, y_pred))
+            (all_true, all_pred) = pooled.setdefault((dataset, label), ([], []))
+            all_true.extend(y_true)
+            all_pred.extend(y_pred)
+    curves = dict()
+    for ((dataset, label), (y_true, y_pred)) in sorted(pooled.items()):
+        rows.append(score_row(dataset, label, 'all', y_true, y_pred))
+        curves[(dataset, label)] = seqlearn.roc_curve(y_true, y_pred)
+    return (rows, curves)
+
+def write_scores(rows, out):
+    ''' Write result table. '''
+    out.write('; Dataset, Method, Fold, Tested, Accuracy, AUC\n')
+    for (dataset, label, fold, tested, accuracy, auc) in rows:
+        out.write('%s\t%s\t%s\t%d\t%.03f\t%.03f\n' % (dataset, label, fold, tested, accuracy, auc))
+
+def write_roc(curves, out):
+    ''' Write pooled ROC curves. '''
+    out.write('; Dataset, Method, FPR, TPR, Threshold\n')
+    for (dataset, label) in sorted(curves):
+        for (fpr, tpr, threshold) in zip(*curves[(dataset, label)]):
+            out.write('%s\t%s\t%.03f\t%.03f\t%.03f\n' % (dataset, label, fpr, tpr, threshold))
+
+def help():
+    ''' Print help and exit. '''
+    print('Usage: %s [-k <n>] [-m <methods>] [-s <seed>] [-j <n>] [-r <path>] [-a] <tsv> [<tsv> ...]' % sys.argv[0])
+    print('Parameters:')
+    print('\t-k <n>, --folds=<n>\tNumber of folds (default: 10).')
+    print('\t-m <methods>, --methods=<methods>\tComma-separated methods, "%s" or a quadlearn classifier (tree, knn, svm).' % SEQUENCE)
+    print('\t-s <seed>, --seed=<seed>\tSeed of the fold shuffling (default: 0).')
+    print('\t-j <n>, --jobs=<n>\tNumber of parallel worker processes (default: 1).')
+    print('\t-r <path>, --roc=<path>\tWrite the pooled ROC curves to the TSV file.')
+    print('\t-a, --all\tPrint only the folds pooled together.')
+    print('\t<tsv>\tQuadclass result data sets (TSV file).')
+    print('Notes:')
+    print('\tThe "-m" default is "%s,tree".' % SEQUENCE)
+    print('Example:')
+    print('"%s -j 8 -m seq,tree,knn gqclass.tsv" ... compare the predictors on the 10 folds' % sys.argv[0])
+    sys.exit(1)
+
+if __name__ == '__main__':
+
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hk:m:s:j:r:a", ["help", "folds=", "methods=", "seed=", "jobs=", "roc=", "all"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        help()
+
+    k = 10
+    methods = [SEQUENCE, 'tree']
+    seed = 0
+    processes = 1
+    roc_file = None
+    pooled_only = False
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            help()
+        elif o in ('-k', '--folds'):
+            k = int(a)
+        elif o in ('-m', '--methods'):
+            methods = a.split(',')
+        elif o in ('-s', '--seed'):
+            seed = int(a)
+        elif o in ('-j', '--jobs'):
+            processes = int(a)
+        elif o in ('-r', '--roc'):
+            roc_file = a
+        elif o in ('-a', '--all'):
+            pooled_only = True
+        else:
+            help()
+    if len(args) < 1 or k < 2:
+        help()
+    # The geometric classifiers require sklearn
+    if any([method != SEQUENCE for method in methods]):
+        import quadlearn
+        if not all([method == SEQUENCE or method in quadlearn.CLASSIFIERS for method in methods]):
+            help()
+
+    # Folds of all data sets and methods share the pool
+    jobs = []
+    for dataset in args:
+        jobs += fold_jobs(dataset, methods, k, seed)
+    (rows, curves) = summarize(run_jobs(jobs, processes))
+    if pooled_only:
+        rows = [row for row in rows if row[2] == 'all']
+    write_scores(rows, sys.stdout)
+    if roc_file is not None:
+        with open(roc_file, 'w') as out:
+            write_roc(curves, out)
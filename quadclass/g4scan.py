@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+''' Streaming scanner of the G-quadruplex motifs in genome-scale FASTA files.
+    The sequences are read in chunks, only the unresolved tail of a chunk is carried over to the next one.
+    The motif is four G-tracts separated by loops starting with another nucleotide, so a G run alone isn't
+    reported. Each candidate locus is reported with its coordinates and the L1-L3 fragments (G-tract followed
+    by the loop). The default is the G3+ motif, the 2-tetrad motifs are found with the 2-G tracts allowed. '''
+import sys, re, getopt, string
+
+# G-tract and loop length ranges of the motif
+TRACT = (3, 10)
+LOOP = (1, 7)
+# Nucleotides read per chunk
+CHUNK_SIZE = 1 << 20
+# Complementary nucleotides
+COMPLEMENT = string.maketrans('ACGTUN', 'TGCAAN')
+
+def motif_pattern(base, tract = TRACT, loop = LOOP, reverse = False):
+    ''' Compile pattern of four tracts of the base separated by the shortest possible loops. The loops start
+        with another nucleotide, or end with it if reverse (the tracts are read from the other strand). '''
+    run = '(%s{%d,%d})' % (base, tract[0], tract[1])
+    other = '[%s]' % ''.join([n for n in 'ACGTUN' if n != base])
+    gap = '[ACGTUN]{%d,%d}?' % (loop[0] - 1, loop[1] - 1)
+    gap = '(%s)' % (gap + other if reverse else other + gap)
+    return re.compile(run + gap + run + gap + run + gap + run)
+
+def motif_length(tract = TRACT, loop = LOOP):
+    ''' Maximum length of the motif. '''
+    return 4 * tract[1] + 3 * loop[1]
+
+def reverse_complement(seq):
+    ''' Return reverse complement of the sequence. '''
+    return seq.translate(COMPLEMENT)[::-1]
+
+def read_chunks(handle, chunk_size = CHUNK_SIZE):
+    ''' Read FASTA records in chunks, yields (record id, chunk, last chunk of the record). '''
+    pending = None
+    record = None
+    lines = []
+    size = 0
+    for line in handle:
+        if line.startswith('>'):
+            if lines:
+                if pending is not None:
+                    yield pending + (False,)
+                pending = (record, ''.join(lines))
+            if pending is not None:
+                yield pending + (True,)
+            pending = None
+            (record, lines, size) = ((line[1:].split() or [''])[0], [], 0)
+            continue
+        line = line.strip()
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            if pending is not None:
+                yield pending + (False,)
+            (pending, lines, size) = ((record, ''.join(lines)), [], 0)
+    if lines:
+        if pending is not None:
+            yield pending + (False,)
+        pending = (record, ''.join(lines))
+    if pending is not None:
+        yield pending + (True,)
+
+def scan(handle, chunk_size = CHUNK_SIZE, tract = TRACT, loop = LOOP, strands = '+-'):
+    ''' Scan FASTA stream for the G4 motifs on given strands, the C-rich motifs are reported as
+        the reverse strand loci. Yields (record id, start, end, strand, sequence, loops) ordered
+        by the position, the coordinates are 0-based and the end is exclusive. '''
+    patterns = [(strand, motif_pattern('G' if strand == '+' else 'C', tract, loop, strand == '-')) for strand in strands]
+    # Motif starting before the margin is complete within the buffer
+    margin = motif_length(tract, loop)
+    (buffer, offset, resume) = ('', 0, {})
+    for (record, chunk, last) in read_chunks(handle, chunk_size):
+        buffer += chunk.upper()
+        limit = len(buffer) if last else len(buffer) - margin
+        loci = []
+        for (strand, pattern) in patterns:
+            pos = resume.get(strand, offset) - offset
+            for found in pattern.finditer(buffer, pos):
+                if found.start() >= limit:
+                    break
+                seq = found.group(0)
+                if strand == '-':
+                    # Fragments of the reverse complement are the C-tracts preceded by the loops
+                    seq = reverse_complement(seq)
+                    loops = [reverse_complement(found.group(i - 1) + found.group(i)) for i in (7, 5, 3)]
+                else:
+                    loops = [found.group(i) + found.group(i + 1) for i in (1, 3, 5)]
+                loci.append((record, offset + found.start(), strand, seq, loops))
+                pos = found.end()
+            resume[strand] = offset + max(pos, limit)
+        loci.sort()
+        for (record, start, strand, seq, loops) in loci:
+            yield (record, start, start + len(seq), strand, seq, loops)
+        # Keep only the unresolved tail
+        if last:
+            (buffer, offset, resume) = ('', 0, {})
+        else:
+            keep = min(resume.values()) - offset
+            (buffer, offset) = (buffer[keep:], offset + keep)
+
+def write_loci(loci, output, predictor = None):
+    ''' Write loci as TSV, the topologies are predicted for all loci at once if the predictor is passed. '''
+    predicted = [None] * len(loci)
+    if predictor is not None:
+        predicted = predictor.fit_batch([loops for (record, start, end, strand, seq, loops) in loci])
+    for ((record, start, end, strand, seq, loops), candidates) in zip(loci, predicted):
+        line = '%s\t%d\t%d\t%s\t%s\t%s' % (record, start + 1, end, strand, seq, '|'.join(loops))
+        if candidates is not None:
+            line += '\t' + ' '.join(['%s:%s/%s' % (key[1], key[0], ','.join(candidates[key])) for key in candidates])
+        output.write(line + '\n')
+
+def parse_range(value):
+    ''' Parse "<min>,<max>" length range. '''
+    (low, high) = [int(x) for x in value.split(',')]
+    if low < 1 or high < low:
+        raise ValueError(value)
+    return (low, high)
+
+def help():
+    ''' Print help and exit. '''
+    print('Usage: %s [-c <n>] [-g <min>,<max>] [-l <min>,<max>] [-s <strands>] [-t <path>] <fasta> [<fasta> ...]' % sys.argv[0])
+    print('Parameters:')
+    print('\t-c <n>, --chunk=<n>\tNucleotides read at once (default: %d).' % CHUNK_SIZE)
+    print('\t-g <min>,<max>, --tract=<min>,<max>\tG-tract length range (default: %d,%d).' % TRACT)
+    print('\t-l <min>,<max>, --loop=<min>,<max>\tLoop length range (default: %d,%d).' % LOOP)
+    print('\t-s <strands>, --strands=<strands>\tScanned strands, "+", "-" or "+-" (default: +-).')
+    print('\t-t <path>, --training=<path>\tPredict the topology of each locus from the training set (TSV file).')
+    print('\t<fasta>\tFASTA file, "-" reads the standard input.')
+    print('Notes:')
+    print('\tThe loci are printed as TSV: record, start, end (1-based, inclusive), strand, sequence and loops.')
+    print('\tThe loops start with a nucleotide other than G, so a G run alone isn\'t a motif.')
+    print('Example:')
+    print('"%s -t gqclass-mono.tsv chr1.fa" ... scan chromosome and predict the topologies' % sys.argv[0])
+    print('"%s -g 2,10 chr1.fa"               ... include the 2-tetrad motifs' % sys.argv[0])
+    sys.exit(1)
+
+if __name__ == '__main__':
+
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:g:l:s:t:", ["help", "chunk=", "tract=", "loop=", "strands=", "training="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        help()
+    chunk_size = CHUNK_SIZE
+    (tract, loop) = (TRACT, LOOP)
+    strands = '+-'
+    training = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            help()
+        elif o in ('-c', '--chunk'):
+            chunk_size = int(a)
+        elif o in ('-g', '--tract', '-l', '--loop'):
+            try:
+                value = parse_range(a)
+            except ValueError:
+                help()
+            if o in ('-g', '--tract'):
+                tract = value
+            else:
+                loop = value
+        elif o in ('-s', '--strands'):
+            strands = a
+        elif o in ('-t', '--training'):
+            training = a
+        else:
+            help()
+    if len(args) < 1 or len(strands) < 1 or set(strands) - set('+-'):
+        help()
+
+    predictor = None
+    if training is not None:
+        import seqlearn
+        predictor = seqlearn.load_predictor(training)
+
+    for path in args:
+        handle = sys.stdin if path == '-' else open(path)
+        loci = []
+        for locus in scan(handle, chunk_size, tract, loop, strands):
+            loci.append(locus)
+            # Predict in batches
+            if len(loci) >= 1024:
+                write_loci(loci, sys.stdout, predictor)
+                loci = []
+        write_loci(loci, sys.stdout, predictor)
+        if handle is not sys.stdin:
+            handle.close()
@@ -0,0 +1,29 @@
+import StringIO
+import g4scan
+import unittest
+
+class ScanTestCase(unittest.TestCase):
+
+    def scan(self, seq, **params):
+        ''' Scan the sequence as a single FASTA record, returns the found loci. '''
+        return list(g4scan.scan(StringIO.StringIO('>test\n%s\n' % seq), **params))
+
+    def test_two_tetrads(self):
+        seq = 'AAGGTTGGTGTGGTTGGAA'
+        self.assertEqual(self.scan(seq), [])
+        loci = self.scan(seq, tract = (2, 10))
+        self.assertEqual(loci, [('test', 2, 17, '+', 'GGTTGGTGTGGTTGG', ['GGTT', 'GGTGT', 'GGTT'])])
+        # Same locus on the reverse strand
+        loci = self.scan(g4scan.reverse_complement(seq), tract = (2, 10))
+        self.assertEqual(loci, [('test', 2, 17, '-', 'GGTTGGTGTGGTTGG', ['GGTT', 'GGTGT', 'GGTT'])])
+
+    def test_g_run(self):
+        for tract in ((3, 10), (2, 10)):
+            self.assertEqual(self.scan('AA' + 'G' * 24 + 'AA', tract = tract), [])
+            self.assertEqual(self.scan('AA' + 'C' * 24 + 'AA', tract = tract), [])
+        # The run is a single tract, the loops start at the other nucleotides
+        loci = self.scan('AGGGGGGTGGGAGGGAGGG')
+        self.assertEqual(loci, [('test', 1, 19, '+', 'GGGGGGTGGGAGGGAGGG', ['GGGGGGT', 'GGGA', 'GGGA'])])
+
+if __name__ == '__main__':
+    unittest.main()
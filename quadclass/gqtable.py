@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+''' Columnar store of the quadclass results.
+    The result table is kept as a NumPy .npz file of typed columns, the metrics as float arrays
+    and the string columns (name, class, topology, loops) dictionary-encoded as integer codes
+    into the list of distinct values in the order of the first appearance. The tools load the
+    whole columns at once, the TSV is parsed only if its columnar copy is missing or outdated. '''
+import sys, os, getopt
+import numpy
+
+# Result table columns in the TSV order
+COLUMNS = ('name', 'qclass', 'planarity', 'planarity_std', 'twist', 'twist_std', 'chains', 'topology', 'loops')
+# Dictionary-encoded columns
+CATEGORIES = ('name', 'qclass', 'topology', 'loops')
+# Column types of the other columns
+TYPES = {'planarity': 'f8', 'planarity_std': 'f8', 'twist': 'f8', 'twist_std': 'f8', 'chains': 'i4'}
+# Rows of the tables read in chunks
+CHUNK_SIZE = 65536
+
+class Table:
+    ''' Result table of typed columns, the dictionary-encoded columns are stored as codes
+        ('<column>') and distinct values ('<column>_values'). '''
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays['planarity'])
+
+    def __getitem__(self, column):
+        ''' Return column, the dictionary-encoded columns are decoded. '''
+        if column in CATEGORIES:
+            return self.values(column)[self.codes(column)]
+        return self.arrays[column]
+
+    def take(self, rows):
+        ''' Return table of the selected rows, the distinct values are kept. '''
+        arrays = dict(self.arrays)
+        for column in COLUMNS:
+            arrays[column] = self.arrays[column][rows]
+        return Table(arrays)
+
+    def codes(self, column):
+        ''' Return codes of the dictionary-encoded column. '''
+        return self.arrays[column]
+
+    def values(self, column):
+        ''' Return distinct values of the dictionary-encoded column. '''
+        return self.arrays[column + '_values']
+
+def encode(values):
+    ''' Dictionary-encode values, returns (codes, distinct values in the order of the first appearance). '''
+    values = numpy.asarray(values, 'S')
+    if len(values) == 0:
+        return (numpy.zeros(0, 'i4'), values)
+    (distinct, first, inverse) = numpy.unique(values, return_index = True, return_inverse = True)
+    order = numpy.argsort(first, kind = 'mergesort')
+    rank = numpy.empty(len(order), 'i4')
+    rank[order] = numpy.arange(len(order))
+    return (rank[inverse], distinct[order])
+
+def read_tsv(path):
+    ''' Read result table from the quadclass TSV file. '''
+    with open(path) as datafile:
+        return make_table([line.rstrip('\r\n').split('\t') for line in datafile
+                           if not line.startswith(';') and line.strip()])
+
+def read_tsv_chunks(path, size = CHUNK_SIZE):
+    ''' Read result table from the quadclass TSV file as tables of at most size rows,
+        the file is never loaded at once. '''
+    rows = []
+    with open(path) as datafile:
+        for line in datafile:
+            # Skip header
+            if line.startswith(';') or not line.strip():
+                continue
+            rows.append(line.rstrip('\r\n').split('\t'))
+            if len(rows) == size:
+                yield make_table(rows)
+                rows = []
+    if len(rows) > 0:
+        yield make_table(rows)
+
+def make_table(rows):
+    ''' Return table of the TSV rows split to columns. '''
+    columns = zip(*rows) if len(rows) > 0 else [()] * len(COLUMNS)
+    arrays = {}
+    for (column, values) in zip(COLUMNS, columns):
+        if column in CATEGORIES:
+            (arrays[column], arrays[column + '_values']) = encode(values)
+        else:
+            arrays[column] = numpy.array(values, TYPES[column]) if len(values) > 0 else numpy.zeros(0, TYPES[column])
+    return Table(arrays)
+
+def save(table, path):
+    ''' Write table to the .npz file, the file is replaced at once. '''
+    with open(path + '.tmp', 'wb') as f:
+        numpy.savez(f, **table.arrays)
+    os.rename(path + '.tmp', path)
+
+def load_npz(path):
+    ''' Read table from the .npz file. '''
+    with numpy.load(path) as data:
+        return Table(dict([(key, data[key]) for key in data.files]))
+
+def table_path(path):
+    ''' Return path of the columnar copy of the TSV file. '''
+    return os.path.splitext(path)[0] + '.npz'
+
+def load(path):
+    ''' Load result table from the .npz file or the TSV file. The columnar copy of the TSV file
+        is used instead if it's not older than the TSV file. '''
+    if path.endswith('.npz'):
+        return load_npz(path)
+    columnar = table_path(path)
+    if os.path.isfile(columnar) and os.path.getmtime(columnar) >= os.path.getmtime(path):
+        return load_npz(columnar)
+    return read_tsv(path)
+
+def load_chunks(path, size = CHUNK_SIZE):
+    ''' Load result table as tables of at most size rows, the TSV file is streamed
+        unless its columnar copy is up to date. '''
+    columnar = table_path(path)
+    if path.endswith('.npz') or (os.path.isfile(columnar) and os.path.getmtime(columnar) >= os.path.getmtime(path)):
+        table = load(path)
+        for start in range(0, len(table), size):
+            yield table.take(slice(start, start + size))
+        return
+    for table in read_tsv_chunks(path, size):
+        yield table
+
+def convert(path):
+    ''' Write columnar copy of the TSV file, returns its path. '''
+    columnar = table_path(path)
+    save(read_tsv(path), columnar)
+    return columnar
+
+def help():
+    ''' Print help and exit. '''
+    print('Usage: %s <tsv> [<tsv> ...]' % sys.argv[0])
+    print('Parameters:')
+    print('\t<tsv>\tQuadclass result TSV file, its columnar copy is written to the .npz file next to it.')
+    print('Example:')
+    print('"%s gqclass-all.tsv" ... write gqclass-all.npz' % sys.argv[0])
+    sys.exit(1)
+
+if __name__ == '__main__':
+
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        help()
+    for o, a in opts:
+        help()
+    if len(args) < 1:
+        help()
+
+    for path in args:
+        print('> written "%s"' % convert(path))
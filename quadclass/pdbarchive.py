@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+''' Single-file archive of PDB structures.
+    Each distinct file content is stored once as a separate gzip member, followed by a gzip-compressed
+    JSON index and a fixed size footer. The index maps structure names to the SHA-1 of the content
+    and the content to its member, so any structure can be read without scanning the archive. '''
+import sys, os, struct, json, zlib, hashlib, getopt, glob
+from io import BytesIO
+
+# Archive file name in the class directory
+ARCHIVE_NAME = 'structures.pdbz'
+# Footer is the magic, index offset and index length
+MAGIC = 'GQPDBZ01'
+FOOTER = struct.Struct('>8sQQ')
+
+class ArchiveError(Exception):
+    ''' Broken or foreign archive file. '''
+    pass
+
+def compress(data):
+    ''' Compress data as a single gzip member. '''
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return encoder.compress(data) + encoder.flush()
+
+def decompress(data):
+    ''' Decompress single gzip member. '''
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+class Archive:
+    ''' Read access to the archive, the index is loaded at once. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.names = {}
+        self.members = {}
+        self.end = 0
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.load(f)
+
+    def load(self, f):
+        ''' Load index from the archive file. '''
+        f.seek(0, os.SEEK_END)
+        if f.tell() < FOOTER.size:
+            raise ArchiveError('"%s" is not an archive' % self.path)
+        f.seek(-FOOTER.size, os.SEEK_END)
+        (magic, offset, length) = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ArchiveError('"%s" is not an archive' % self.path)
+        f.seek(offset)
+        index = json.loads(decompress(f.read(length)))
+        self.names = index['names']
+        self.members = index['members']
+        self.end = offset
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def list(self):
+        ''' Return sorted list of structure names. '''
+        return sorted(self.names.keys())
+
+    def content_hash(self, name):
+        ''' Return SHA-1 of the structure content. '''
+        return self.names[name]
+
+    def read(self, name):
+        ''' Return structure content. '''
+        (offset, length) = self.members[self.names[name]]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return decompress(f.read(length))
+
+    def open(self, name):
+        ''' Return structure content as a file object. '''
+        return BytesIO(self.read(name))
+
+class ArchiveWriter(Archive):
+    ''' Add structures to the archive. The archive is written to a temporary file and replaced
+        when closed, so the readers never see an incomplete archive. '''
+
+    def __init__(self, path):
+        Archive.__init__(self, path)
+        self.output = open(path + '.tmp', 'wb')
+        # Copy existing members, the index is written anew
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                remaining = self.end
+                while remaining > 0:
+                    block = f.read(min(remaining, 1 << 20))
+                    if not block:
+                        raise ArchiveError('"%s" is truncated' % path)
+                    self.output.write(block)
+                    remaining -= len(block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, name, data):
+        ''' Add structure content under the name, same content is stored only once. '''
+        digest = hashlib.sha1(data).hexdigest()
+        if digest not in self.members:
+            member = compress(data)
+            self.members[digest] = (self.end, len(member))
+            self.output.write(member)
+            self.end += len(member)
+        self.names[name] = digest
+
+    def close(self):
+        ''' Write index and replace the archive. '''
+        index = compress(json.dumps({'names': self.names, 'members': self.members}, sort_keys = True))
+        self.output.write(index)
+        self.output.write(FOOTER.pack(MAGIC, self.end, len(index)))
+        self.output.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def abort(self):
+        ''' Discard changes. '''
+        self.output.close()
+        os.remove(self.path + '.tmp')
+
+# Opened archives, shared between the files read from the same archive
+archives = {}
+
+def archive_path(dirname):
+    ''' Return path of the archive in the class directory. '''
+    return os.path.join(dirname, ARCHIVE_NAME)
+
+def open_archive(path):
+    ''' Return opened archive, it is reloaded when the archive file changes. '''
+    key = os.stat(path).st_mtime
+    if path not in archives or archives[path][0] != key:
+        archives[path] = (key, Archive(path))
+    return archives[path][1]
+
+def split_path(pdbfile):
+    ''' Split path of a structure inside the archive (f.e. "basket/structures.pdbz/143D.pdb")
+        into the archive path and structure name, or return None for regular files. '''
+    (dirname, filename) = os.path.split(pdbfile)
+    if os.path.basename(dirname) != ARCHIVE_NAME or not os.path.isfile(dirname):
+        return None
+    return (dirname, os.path.splitext(filename)[0])
+
+def open_structure(pdbfile):
+    ''' Open PDB file, or a structure inside the archive. '''
+    archived = split_path(pdbfile)
+    if archived is None:
+        return open(pdbfile)
+    (path, name) = archived
+    archive = open_archive(path)
+    if name not in archive:
+        raise IOError('"%s" not found in "%s"' % (name, path))
+    return archive.open(name)
+
+def list_structures(dirname):
+    ''' List PDB files in the class directory, structures in the archive take precedence over
+        the loose files with the same name. Returns sorted list of paths. '''
+    files = {}
+    for pdbfile in glob.glob(os.path.join(dirname, '*.pdb')):
+        files[os.path.splitext(os.path.basename(pdbfile))[0]] = pdbfile
+    path = archive_path(dirname)
+    if os.path.isfile(path):
+        for name in open_archive(path).list():
+            files[name] = os.path.join(path, name + '.pdb')
+    return [files[name] for name in sorted(files.keys())]
+
+def pack(dirname, remove = False):
+    ''' Pack loose PDB files in the directory into its archive. '''
+    pdb_files = sorted(glob.glob(os.path.join(dirname, '*.pdb')))
+    with ArchiveWriter(archive_path(dirname)) as archive:
+        for pdbfile in pdb_files:
+            with open(pdbfile, 'rb') as f:
+                archive.add(os.path.splitext(os.path.basename(pdbfile))[0], f.read())
+    print('> packed %d file(s) into "%s"' % (len(pdb_files), archive_path(dirname)))
+    if remove:
+        for pdbfile in pdb_files:
+            os.remove(pdbfile)
+
+def help():
+    ''' Print help and exit. '''
+    print('Usage: %s [-l] [-r] <directory>' % sys.argv[0])
+    print('Parameters:')
+    print('\t-l, --list\tList structures in the archive.')
+    print('\t-r, --remove\tRemove the loose PDB files once packed.')
+    print('\t<directory>\tPath to a GQ family directory, its PDB files are packed into the %s archive.' % ARCHIVE_NAME)
+    print('Example:')
+    print('"%s -r 3_plus_1" ... pack 3_plus_1/*.pdb into 3_plus_1/%s' % (sys.argv[0], ARCHIVE_NAME))
+    sys.exit(1)
+
+if __name__ == '__main__':
+
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hlr", ["help", "list", "remove"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        help()
+    show = False
+    remove = False
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            help()
+        elif o in ('-l', '--list'):
+            show = True
+        elif o in ('-r', '--remove'):
+            remove = True
+        else:
+            help()
+    if len(args) < 1:
+        help()
+
+    for dirname in args:
+        if show:
+            archive = Archive(archive_path(dirname))
+            for name in archive.list():
+                print('%s\t%s' % (name, archive.content_hash(name)))
+        else:
+            pack(dirname, remove)
@@ -1,39 +1,225 @@
 #!/usr/bin/env python
-import urllib2
-import sys, os
+import httplib, urlparse, socket, zlib
+import threading, Queue
+import sys, os, time, getopt
+import pdbarchive
 
 PDB_PATH = "http://www.rcsb.org/pdb/files/%s"
 
+# Number of attempts to fetch a file, the delay between them doubles [s]
+RETRIES = 4
+BACKOFF = 1.0
+# Maximum redirects followed per request
+REDIRECTS = 5
+# Socket timeout [s]
+TIMEOUT = 60.0
+
+class FetchError(Exception):
+    ''' Permanent failure, the request is not retried. '''
+    pass
+
+class Fetcher:
+    ''' Fetch files over HTTP, the connections are kept alive and reused for the same host.
+        Each worker thread needs its own fetcher. '''
+
+    def __init__(self, url = PDB_PATH, timeout = TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.connections = {}
+
+    def connection(self, scheme, netloc):
+        ''' Return open connection for the host. '''
+        key = (scheme, netloc)
+        if key not in self.connections:
+            if scheme == 'https':
+                self.connections[key] = httplib.HTTPSConnection(netloc, timeout = self.timeout)
+            else:
+                self.connections[key] = httplib.HTTPConnection(netloc, timeout = self.timeout)
+        return self.connections[key]
+
+    def close(self, scheme = None, netloc = None):
+        ''' Close connection for the host, or all of them. '''
+        for key in self.connections.keys():
+            if scheme is None or key == (scheme, netloc):
+                self.connections.pop(key).close()
+
+    def fetch(self, pdbname, output):
+        ''' Fetch remote file into the output file object, the gzip transfer is decompressed on the fly. '''
+        url = self.url % pdbname
+        for redirect in range(REDIRECTS + 1):
+            (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+            if query:
+                path += '?' + query
+            conn = self.connection(scheme, netloc)
+            try:
+                conn.request('GET', path, headers = {'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # Stale keep-alive connection, reconnect on the next attempt
+                self.close(scheme, netloc)
+                raise
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status != 200:
+                response.read()
+                message = 'HTTP %d %s' % (response.status, response.reason)
+                # Server errors may be temporary
+                if response.status >= 500:
+                    raise IOError(message)
+                raise FetchError(message)
+            decoder = None
+            if response.getheader('content-encoding', '').lower() == 'gzip':
+                decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                for block in iter(lambda: response.read(1 << 16), ''):
+                    if decoder is not None:
+                        block = decoder.decompress(block)
+                    output.write(block)
+                if decoder is not None:
+                    output.write(decoder.flush())
+                # Connection closed before the whole body was read
+                if response.length:
+                    raise httplib.IncompleteRead('', response.length)
+            except (httplib.HTTPException, socket.error, zlib.error):
+                self.close(scheme, netloc)
+                raise
+            if response.will_close:
+                self.close(scheme, netloc)
+            return
+        raise FetchError('too many redirects')
+
+def fetch_file(fetcher, pdbname, filename, retries = RETRIES, backoff = BACKOFF):
+    ''' Fetch PDB file, the file is written to a temporary file and renamed once complete,
+        so an interrupted transfer never leaves a partial file behind. Failed attempts are
+        retried with an exponential backoff. Returns None or an error message. '''
+    partial = filename + '.part'
+    error = None
+    for attempt in range(retries):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            with open(partial, 'wb') as output:
+                fetcher.fetch(pdbname, output)
+            os.rename(partial, filename)
+            return None
+        except FetchError as err:
+            error = str(err)
+            break
+        except (IOError, OSError, httplib.HTTPException, socket.error, zlib.error) as err:
+            error = str(err) or err.__class__.__name__
+    if os.path.isfile(partial):
+        os.remove(partial)
+    return error
+
+def fetch_worker(queue, url, errors, lock, archive = None):
+    ''' Fetch files from the queue until it's empty. The fetched files are moved to the archive if passed. '''
+    fetcher = Fetcher(url)
+    try:
+        while True:
+            try:
+                (pdbname, filename) = queue.get_nowait()
+            except Queue.Empty:
+                break
+            error = fetch_file(fetcher, pdbname, filename)
+            with lock:
+                if error is None and archive is not None:
+                    with open(filename, 'rb') as f:
+                        archive.add(os.path.splitext(pdbname)[0], f.read())
+                    os.remove(filename)
+                if error is None:
+                    print('>  fetched "%s"' % filename)
+                else:
+                    print('>  failed "%s": %s' % (filename, error))
+                    errors.append(filename)
+    finally:
+        fetcher.close()
+
+def fetch_list(local_dir, url = PDB_PATH, workers = 4, archived = False):
+    ''' Fetch missing PDB files for names in the directory list file in a pool of worker threads.
+        The files are either stored in the directory or added to its archive.
+        Returns the list of files that failed to download. '''
+    print('> updating "%s"' % local_dir)
+    archive = None
+    if archived:
+        archive = pdbarchive.Archive(pdbarchive.archive_path(local_dir))
+    queue = Queue.Queue()
+    # Read PDB file list
+    with open(os.path.join(local_dir, 'list')) as listfile:
+        for pdbname in listfile:
+            pdbname = '%s.pdb' % (pdbname.strip())
+            filename = os.path.join(local_dir, pdbname)
+            if os.path.isfile(filename) or (archive is not None and pdbname[:-4] in archive):
+                print('>  exists "%s"' % pdbname)
+                continue
+            queue.put((pdbname, filename))
+    errors = []
+    if queue.empty():
+        return errors
+    if archived:
+        archive = pdbarchive.ArchiveWriter(pdbarchive.archive_path(local_dir))
+    lock = threading.Lock()
+    threads = [threading.Thread(target = fetch_worker, args = (queue, url, errors, lock, archive)) for i in range(min(workers, queue.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            # Join with a timeout, so the main thread stays interruptible
+            while thread.is_alive():
+                thread.join(1.0)
+    finally:
+        # Keep the files fetched so far
+        if archive is not None:
+            with lock:
+                archive.close()
+    return errors
+
 def help():
     ''' Print help and exit. '''
-    print('Usage: %s <directory>' % sys.argv[0])
+    print('Usage: %s [-j <n>] [-u <url>] [-a] <directory>' % sys.argv[0])
     print('Parameters:')
+    print('\t-j <n>, --jobs=<n>\tNumber of parallel downloads (default: 4).')
+    print('\t-u <url>, --url=<url>\tRemote file URL, %%s is replaced by the file name (default: %s).' % PDB_PATH)
+    print('\t-a, --archive\tAdd the files to the directory archive (%s) instead.' % pdbarchive.ARCHIVE_NAME)
     print('\t<directory> pointing to a path with \'list\' file of PDB structure names')
     print('Example:')
     print('"%s 3_plus_1" ... fetch PDB files for names in 3_plus_1/list' % sys.argv[0])
     sys.exit(1)
 
-if len(sys.argv) < 2:
-    help()
-if '-h' in sys.argv or '--help' in sys.argv:
-    help()
-
-for local_dir in sys.argv[1:]:
-    print '> updating "%s"' % local_dir
-    basedir = os.getcwd()
-    os.chdir(local_dir)
-
-    ''' Read PDB file list '''
-    with open('list') as listfile:
-	for pdbname in listfile:
-		pdbname = '%s.pdb' % (pdbname.strip())
-		if os.path.isfile(pdbname):
-			print '>  exists "%s"' % pdbname
-			continue
-		print '>  fetching "%s"' % pdbname
-		remote_file = urllib2.urlopen(PDB_PATH % pdbname)
-		output = open(pdbname,'w')
-		output.write(remote_file.read())
-		output.close()
-
-    os.chdir(basedir)
+if __name__ == '__main__':
+
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hj:u:a", ["help", "jobs=", "url=", "archive"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        help()
+    workers = 4
+    url = PDB_PATH
+    archived = False
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            help()
+        elif o in ('-j', '--jobs'):
+            workers = int(a)
+        elif o in ('-u', '--url'):
+            url = a
+            if '%s' not in url:
+                url = url.rstrip('/') + '/%s'
+        elif o in ('-a', '--archive'):
+            archived = True
+        else:
+            help()
+    if len(args) < 1:
+        help()
+
+    return_code = 0
+    for local_dir in args:
+        errors = fetch_list(local_dir, url, workers, archived)
+        if len(errors) > 0:
+            print('> %d file(s) failed in "%s"' % (len(errors), local_dir))
+            return_code = 1
+
+    sys.exit(return_code)
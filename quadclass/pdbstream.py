@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+''' Lightweight streaming PDB reader.
+    Only nucleotide residues and the guanine core atoms are kept, the coordinates of each model
+    are stored in a single compact array. The entities implement the part of the Bio.PDB interface
+    used by the tetrad library, the models are yielded one at a time as soon as they are complete. '''
+import numpy
+from Bio.PDB import Vector
+import tetrad
+
+class Atom:
+    ''' Core atom, the coordinates are a row in the model coordinate array. '''
+
+    def __init__(self, parent, name, fullname, row, occupancy):
+        self.parent = parent
+        self.name = name
+        self.fullname = fullname
+        self.row = row
+        self.occupancy = occupancy
+        self.disordered = False
+
+    @property
+    def coord(self):
+        return self.parent.parent.parent.coord[self.row]
+
+    def __sub__(self, other):
+        ''' Calculate distance between two atoms. '''
+        diff = self.coord - other.coord
+        return numpy.sqrt(numpy.dot(diff, diff))
+
+    def __repr__(self):
+        return '<Atom %s>' % self.name
+
+    def get_id(self):
+        return self.name
+
+    def get_name(self):
+        return self.name
+
+    def get_parent(self):
+        return self.parent
+
+    def get_coord(self):
+        return self.coord
+
+    def get_vector(self):
+        (x, y, z) = self.coord
+        return Vector(x, y, z)
+
+class Residue:
+    ''' Nucleotide residue with the core atoms. '''
+
+    def __init__(self, parent, id, resname):
+        self.parent = parent
+        self.id = id
+        self.resname = resname
+        self.atoms = {}
+        self.ordered = False
+
+    def __contains__(self, name):
+        return name in self.atoms
+
+    def __getitem__(self, name):
+        return self.atoms[name]
+
+    def __repr__(self):
+        (hetflag, resseq, icode) = self.id
+        return '<Residue %s het=%s resseq=%s icode=%s>' % (self.resname, hetflag, resseq, icode)
+
+    def get_id(self):
+        return self.id
+
+    def get_resname(self):
+        return self.resname
+
+    def get_parent(self):
+        return self.parent
+
+    def get_full_id(self):
+        return self.parent.get_full_id() + (self.id,)
+
+class Chain:
+    ''' Chain of nucleotide residues in the order of appearance. '''
+
+    def __init__(self, parent, id):
+        self.parent = parent
+        self.id = id
+        self.residues = []
+        self.index = {}
+
+    def __iter__(self):
+        return iter(self.residues)
+
+    def __len__(self):
+        return len(self.residues)
+
+    def __repr__(self):
+        return '<Chain id=%s>' % self.id
+
+    def get_id(self):
+        return self.id
+
+    def get_parent(self):
+        return self.parent
+
+    def get_full_id(self):
+        return self.parent.get_full_id() + (self.id,)
+
+class Model:
+    ''' Single model, the core atom coordinates are kept in a (atoms x 3) array. '''
+
+    def __init__(self, structure_id, id, serial_num = None):
+        self.structure_id = structure_id
+        self.id = id
+        self.serial_num = serial_num
+        self.chains = []
+        self.index = {}
+        self.coord = None
+
+    def __iter__(self):
+        return iter(self.chains)
+
+    def __len__(self):
+        return len(self.chains)
+
+    def __repr__(self):
+        return '<Model id=%s>' % self.id
+
+    def get_id(self):
+        return self.id
+
+    def get_full_id(self):
+        return (self.structure_id, self.id)
+
+class ModelBuilder:
+    ''' Build model from the coordinate records, following the Bio.PDB.PDBParser rules
+        for the chain and residue continuity and the alternative atom locations. '''
+
+    def __init__(self, structure_id, id, serial_num = None):
+        self.model = Model(structure_id, id, serial_num)
+        self.coords = []
+        self.chain = None
+        self.residue = None
+
+    def init_chain(self, chain_id):
+        ''' Open chain, discontinuous chains are merged. '''
+        if chain_id not in self.model.index:
+            self.model.index[chain_id] = Chain(self.model, chain_id)
+            self.model.chains.append(self.model.index[chain_id])
+        self.chain = self.model.index[chain_id]
+
+    def init_residue(self, resname, res_id):
+        ''' Open residue, only nucleotides are kept. Redefined residue is reused, a point mutation
+            of completely disordered residue is replaced by the last residue variant (the default
+            Bio.PDB selection), otherwise the mutation is ignored. '''
+        self.residue = None
+        if tetrad.nucleotide_translate(resname.strip()) not in tetrad.NUCLEOTIDE:
+            return
+        residue = self.chain.index.get(res_id)
+        if residue is None:
+            residue = Residue(self.chain, res_id, resname)
+            self.chain.index[res_id] = residue
+            self.chain.residues.append(residue)
+        elif res_id[0] != ' ':
+            # Hetero residue defined twice is ignored
+            return
+        elif residue.resname != resname:
+            if residue.ordered:
+                return
+            residue.resname = resname
+            residue.atoms = {}
+        self.residue = residue
+
+    def init_atom(self, name, fullname, altloc, occupancy, coord):
+        ''' Add core atom, the alternative location with highest occupancy is selected. '''
+        residue = self.residue
+        if residue is None:
+            return
+        if altloc == ' ':
+            residue.ordered = True
+        if name not in tetrad.CORE_ATOMS:
+            return
+        duplicate = residue.atoms.get(name)
+        if duplicate is not None and duplicate.fullname != fullname:
+            # Atom names differ only in spaces, not a core atom
+            return
+        if duplicate is None:
+            residue.atoms[name] = Atom(residue, name, fullname, len(self.coords), occupancy)
+            residue.atoms[name].disordered = (altloc != ' ')
+            self.coords.append(coord)
+        elif altloc != ' ':
+            # Blank altloc followed by a disordered atom selects the disordered one
+            # unless the blank one has strictly higher occupancy
+            if not duplicate.disordered:
+                duplicate.disordered = True
+                if not (duplicate.occupancy > occupancy):
+                    self.coords[duplicate.row] = coord
+                    duplicate.occupancy = occupancy
+            elif occupancy > duplicate.occupancy:
+                self.coords[duplicate.row] = coord
+                duplicate.occupancy = occupancy
+
+    def finish(self):
+        ''' Pack coordinates and return the complete model. '''
+        self.model.coord = numpy.array(self.coords, 'f').reshape((-1, 3))
+        return self.model
+
+def parse_models(source, structure_id = None):
+    ''' Stream models from the PDB file (path or file object).
+        Each model is yielded as soon as it's complete, the coordinate section ends with
+        the END or CONECT record, same as in the Bio.PDB.PDBParser. '''
+    handle = source
+    if not hasattr(source, 'read'):
+        handle = open(source)
+    try:
+        builder = None
+        model_id = 0
+        chain_id = None
+        residue_key = None
+        for line in handle:
+            line = line.rstrip('\n')
+            record_type = line[0:6]
+            if record_type == 'ATOM  ' or record_type == 'HETATM':
+                # Initialize the Model - there was no explicit MODEL record
+                if builder is None:
+                    builder = ModelBuilder(structure_id, model_id)
+                    model_id += 1
+                    (chain_id, residue_key) = (None, None)
+                fullname = line[12:16]
+                name = fullname
+                if len(fullname.split()) == 1:
+                    name = fullname.strip()
+                resname = line[17:20]
+                hetflag = ' '
+                if record_type == 'HETATM':
+                    hetflag = 'W' if resname in ('HOH', 'WAT') else 'H_' + resname
+                res_id = (hetflag, int(line[22:26].split()[0]), line[26])
+                if chain_id != line[21]:
+                    chain_id = line[21]
+                    builder.init_chain(chain_id)
+                    residue_key = None
+                if residue_key != (res_id, resname):
+                    residue_key = (res_id, resname)
+                    builder.init_residue(resname, res_id)
+                if builder.residue is None:
+                    continue
+                try:
+                    occupancy = float(line[54:60])
+                except ValueError:
+                    occupancy = None
+                coord = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+                builder.init_atom(name, fullname, line[16], occupancy, coord)
+            elif record_type == 'MODEL ':
+                if builder is not None:
+                    yield builder.finish()
+                try:
+                    serial_num = int(line[10:14])
+                except ValueError:
+                    serial_num = 0
+                builder = ModelBuilder(structure_id, model_id, serial_num)
+                model_id += 1
+                (chain_id, residue_key) = (None, None)
+            elif record_type == 'ENDMDL':
+                if builder is not None:
+                    yield builder.finish()
+                builder = None
+            elif record_type == 'END   ' or record_type == 'CONECT':
+                break
+        if builder is not None:
+            yield builder.finish()
+    finally:
+        if handle is not source:
+            handle.close()
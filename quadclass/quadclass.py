@@ -1,12 +1,36 @@
 #!/usr/bin/env python
-import sys, os, glob, getopt
+import sys, os, getopt
+import multiprocessing, itertools, hashlib, json
+from StringIO import StringIO
 import tetrad
+import pdbstream
+import pdbarchive
+import gqtable
 from Bio.PDB import *
 
-def analyze_model(name, model, qclass, result_file):
+def analyze_model(name, model, qclass, result_file, profile_file = None, stats = None):
     ''' Spatial analysis of model chains. '''
+    if stats is None:
+        stats = tetrad.Stats()
     # Analyze guanine tetrads
-    result = tetrad.analyze(model)
+    write_result(name, qclass, tetrad.analyze(model, stats = stats), result_file)
+    write_profile(name, qclass, model.get_id(), stats, profile_file)
+
+def write_profile(name, qclass, model_id, stats, profile_file):
+    ''' Write stage times and counters of the model analysis. '''
+    if profile_file:
+        row = stats.row()
+        profile_file.write('%s\t%s\t%s\t' % (name, qclass, model_id))
+        profile_file.write('\t'.join(['%.03f' % value for value in row[:len(tetrad.PROFILE_STAGES) + 1]] + \
+                                     ['%d' % value for value in row[len(tetrad.PROFILE_STAGES) + 1:]]) + '\n')
+
+def profile_header():
+    ''' Return header of the profile table. '''
+    return ';Model\t%s\ttotal[ms]\t%s\n' % ('\t'.join(['%s[ms]' % stage for stage in tetrad.PROFILE_STAGES]),
+                                           '\t'.join(tetrad.PROFILE_COUNTS))
+
+def write_result(name, qclass, result, result_file):
+    ''' Write model analysis result. '''
     if result is None:
         return
     if result_file:
@@ -14,17 +38,56 @@ def analyze_model(name, model, qclass, result_file):
         result_file.write('%s\t%s\t%.02f\t%.02f\t%.02f\t%.02f\t%d\t%s\t%s\n' % \
                           (name, qclass, planarity, planarity_std, twist, twist_std, chains, topology, loops))
 
+def analyze_ensemble(name, models, qclass, result_file, ensemble_file, profile_file = None, stats = None):
+    ''' Spatial analysis of all models in the ensemble, the per-model results are written
+        same as for the separate models and the summary goes to the ensemble file.
+        The profile is recorded for the whole ensemble (model "*"). '''
+    if stats is None:
+        stats = tetrad.Stats()
+    results = tetrad.analyze_ensemble(models, stats)
+    for result in results:
+        write_result(name, qclass, result, result_file)
+    write_profile(name, qclass, '*', stats, profile_file)
+    summary = tetrad.summarize_ensemble(results)
+    if summary is None:
+        return
+    (models, planarity, planarity_spread, twist, twist_spread, topology, loops) = summary
+    tetrad.log('  = ensemble: %d models, planarity %.02f A (spread %.02f A), twist %.02f deg (spread %.02f deg)' % \
+          (models, planarity, planarity_spread, twist, twist_spread))
+    if ensemble_file:
+        ensemble_file.write('%s\t%s\t%d\t%.02f\t%.02f\t%.02f\t%.02f\t%s\t%s\n' % \
+                            (name, qclass, models, planarity, planarity_spread, twist, twist_spread, topology, loops))
 
-def process_file(pdbfile, qclass = None, result_file = None):
-    ''' Process and analyze models found in given PDB file. '''
-    print('> processing "%s"' % pdbfile)
-    parser = PDBParser()
+def process_file(pdbfile, qclass = None, result_file = None, fast = False, ensemble = False, ensemble_file = None,
+                 profile_file = None):
+    ''' Process and analyze models found in given PDB file.
+        The fast reader streams the models and keeps only the atoms needed for the analysis.
+        In the ensemble mode, all models are analyzed at once and summarized.
+        Parsing time is profiled along with the analysis, streamed models are timed separately. '''
+    tetrad.log('> processing "%s"' % pdbfile)
     try:
         name = os.path.splitext(os.path.basename(pdbfile))[0]
-        structure = parser.get_structure(name, pdbfile)
-        # Analyze each model separately
-        for model in structure:
-            analyze_model(structure.get_id(), model, qclass, result_file)
+        stats = tetrad.Stats()
+        with pdbarchive.open_structure(pdbfile) as handle:
+            with stats.timer('parse'):
+                if fast:
+                    models = pdbstream.parse_models(handle, name)
+                else:
+                    models = PDBParser().get_structure(name, handle)
+                models = iter(models)
+                if ensemble:
+                    models = list(models)
+            if ensemble:
+                analyze_ensemble(name, models, qclass, result_file, ensemble_file, profile_file, stats)
+                return 0
+            # Analyze each model separately
+            while True:
+                with stats.timer('parse'):
+                    model = next(models, None)
+                if model is None:
+                    break
+                analyze_model(name, model, qclass, result_file, profile_file, stats)
+                stats = tetrad.Stats()
         # Return success
         return 0
     # Failed to open PDB file for reading
@@ -32,21 +95,134 @@ def process_file(pdbfile, qclass = None, result_file = None):
         print('> could not open file "%s"' % pdbfile)
         return 1
 
-def process_path(dirname, result_file = None):
-    ''' Process PDB files in a path. '''
-    return_code = 0
+def process_job(job):
+    ''' Process single PDB file, the job is a (pdbfile, qclass, fast, ensemble) tuple.
+        Output is captured, so the jobs may run in parallel, returns the
+        (return code, stdout, stderr, results, ensemble results, profile) tuple. '''
+    (pdbfile, qclass, fast, ensemble) = job
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    (sys.stdout, sys.stderr) = (StringIO(), StringIO())
+    result_file = StringIO()
+    ensemble_file = StringIO()
+    profile_file = StringIO()
+    try:
+        return_code = process_file(pdbfile, qclass, result_file, fast, ensemble, ensemble_file, profile_file)
+    # Failed to analyze the file, report and carry on with others
+    except Exception as err:
+        print('> failed to process file "%s": %s' % (pdbfile, err))
+        return_code = 1
+    finally:
+        output = (sys.stdout.getvalue(), sys.stderr.getvalue())
+        (sys.stdout, sys.stderr) = (stdout, stderr)
+    return (return_code,) + output + (result_file.getvalue(), ensemble_file.getvalue(), profile_file.getvalue())
+
+def path_jobs(dirname, fast = False, ensemble = False):
+    ''' List jobs for PDB files in a path (sorted by file name), or None for an empty directory.
+        Structures in the directory archive are listed as "<directory>/structures.pdbz/<name>.pdb". '''
     if os.path.isdir(dirname):
-        pdb_files = glob.glob(dirname + '/*.pdb')
+        pdb_files = pdbarchive.list_structures(dirname)
         if len(pdb_files) == 0:
             print('> \'%s\' is empty\n  * missing \'./pdbfetch.py %s\' ?' % (dirname, dirname))
-            return 1
-        for filename in pdb_files:
-            return_code = process_file(filename, qclass = dirname, result_file = result_file)
+            return None
+        return [(filename, dirname, fast, ensemble) for filename in pdb_files]
+    # Results of a single file are not written
+    return [(dirname, None, fast, ensemble)]
+
+def file_hash(pdbfile):
+    ''' Calculate SHA-1 hash of the file content, the archived structures have it in the index. '''
+    archived = pdbarchive.split_path(pdbfile)
+    if archived is not None:
+        (path, name) = archived
+        return pdbarchive.open_archive(path).content_hash(name)
+    digest = hashlib.sha1()
+    with open(pdbfile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(path):
+    ''' Load manifest of the processed files, the entries are keyed by the file path.
+        Manifest written by other analyzer version is ignored. '''
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if manifest.get('version') != tetrad.VERSION:
+        return {}
+    return manifest.get('files', {})
+
+def save_manifest(path, files):
+    ''' Write manifest of the processed files, the previous one is replaced at once. '''
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'version': tetrad.VERSION, 'files': files}, f, indent = 1, sort_keys = True)
+    os.rename(path + '.tmp', path)
+
+def process_jobs(jobs, result_file = None, ensemble_file = None, processes = 1, manifest = None, profile_file = None):
+    ''' Process jobs in a pool of worker processes. Results are written in the order of jobs,
+        failed jobs are reported and don't stop the others. Returns the number of failed jobs.
+        If the manifest is passed, files with the same content reuse the cached results, and
+        the manifest is updated to contain only the processed jobs. Cached files are not profiled. '''
+    # Reuse results of the unchanged files
+    cached = {}
+    if manifest is not None:
+        for job in jobs:
+            (pdbfile, qclass, fast, ensemble) = job
+            if qclass is None:
+                continue
+            try:
+                content_hash = file_hash(pdbfile)
+            except (IOError, OSError, KeyError):
+                continue
+            entry = {'hash': content_hash, 'qclass': qclass, 'ensemble': ensemble}
+            previous = manifest.get(pdbfile, {})
+            if all([previous.get(key) == entry[key] for key in entry]):
+                entry = previous
+            cached[pdbfile] = entry
+    pending = [job for job in jobs if 'rows' not in cached.get(job[0], {})]
+    pool = None
+    results = itertools.imap(process_job, pending)
+    if processes > 1 and len(pending) > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(process_job, pending)
+    failed = []
+    try:
+        for job in jobs:
+            entry = cached.get(job[0], {})
+            if 'rows' in entry:
+                (return_code, stdout, stderr) = (0, '', '')
+                (rows, ensemble_rows, profile_rows) = (entry['rows'], entry['ensemble_rows'], '')
+                if tetrad.VERBOSE:
+                    stdout = '> cached "%s"\n' % job[0]
+            else:
+                (return_code, stdout, stderr, rows, ensemble_rows, profile_rows) = results.next()
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            # Partial results of the failed file are dropped
             if return_code != 0:
-                break
-    else:
-        process_file(dirname)
-    return return_code
+                failed.append(job[0])
+                entry.clear()
+                continue
+            if job[1] is None:
+                continue
+            if result_file:
+                result_file.write(rows)
+            if ensemble_file:
+                ensemble_file.write(ensemble_rows)
+            if profile_file:
+                profile_file.write(profile_rows)
+            if job[0] in cached:
+                entry.update({'rows': rows, 'ensemble_rows': ensemble_rows})
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if len(failed) > 0:
+        print('> %d of %d file(s) failed: %s' % (len(failed), len(jobs), ' '.join(failed)))
+    # Obsolete and failed files are dropped from the manifest
+    if manifest is not None:
+        manifest.clear()
+        manifest.update([(path, entry) for (path, entry) in cached.items() if 'rows' in entry])
+    return len(failed)
 
 def class_description(dirname):
     ''' Read DESCRIPTION file for given quadruplex class. '''
@@ -55,9 +231,17 @@ def class_description(dirname):
 
 def help():
     ''' Print help and exit. '''
-    print('Usage: %s [-o] [directory]' % sys.argv[0])
+    print('Usage: %s [-o] [-f] [-e] [-j <n>] [-i] [-p] [-q] [-c] [directory]' % sys.argv[0])
     print('Parameters:')
     print('\t-o <output>, --output=<output>\tOutput for the analysis results (TSV) (default: gqclass.tsv)')
+    print('\t-f, --fast\tUse streaming PDB reader, which reads only the guanine core atoms.')
+    print('\t-e, --ensemble\tAnalyze all models of a structure at once and write the ensemble summary')
+    print('\t              \tto the <output>-ensemble.tsv file.')
+    print('\t-j <n>, --jobs=<n>\tNumber of parallel worker processes (default: 1).')
+    print('\t-i, --incremental\tReuse results of the unchanged files from the <output>.manifest file.')
+    print('\t-p, --profile\tWrite stage times and counters of each model to the <output>-profile.tsv file.')
+    print('\t-q, --quiet\tDon\'t print the per-model analysis progress.')
+    print('\t-c, --columnar\tAlso write the results as typed columns to the <output>.npz file.')
     print('\t[directory]\tOptional path to a GQ family directory.')
     print('Notes:')
     print('\tIf the directory is not set, all monomeric GQ families are processed and the result')
@@ -73,31 +257,84 @@ if __name__ == '__main__':
 
     # Process parameters
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "ho:", ["help", "output="])
+        opts, args = getopt.getopt(sys.argv[1:], "ho:fej:ipqc", ["help", "output=", "fast", "ensemble", "jobs=", "incremental", "profile", "quiet", "columnar"])
     except getopt.GetoptError as err:
         print str(err)
         help()
     output = 'gqclass.tsv'
+    fast = False
+    ensemble = False
+    processes = 1
+    incremental = False
+    profile = False
+    columnar = False
     for o, a in opts:
         if o in ('-h', '--help'):
             help()
         elif o in ('-o', '--output'):
             output = a
+        elif o in ('-f', '--fast'):
+            fast = True
+        elif o in ('-e', '--ensemble'):
+            ensemble = True
+        elif o in ('-j', '--jobs'):
+            processes = int(a)
+        elif o in ('-i', '--incremental'):
+            incremental = True
+        elif o in ('-p', '--profile'):
+            profile = True
+        elif o in ('-q', '--quiet'):
+            tetrad.VERBOSE = False
+        elif o in ('-c', '--columnar'):
+            columnar = True
         else:
             help()
 
+    # Ensemble summary is written next to the results
+    ensemble_file = None
+    if ensemble:
+        ensemble_file = open(os.path.splitext(output)[0] + '-ensemble.tsv', 'w')
+        ensemble_file.write(';Models\tPlanarity[A]\tPlanarity spread[A]\tTwist[deg]\tTwist spread[deg]\tTopology\tLoops\n')
+
+    # Profile is written next to the results
+    profile_file = None
+    if profile:
+        profile_file = open(os.path.splitext(output)[0] + '-profile.tsv', 'w')
+        profile_file.write(profile_header())
+
+    # Cached results of the previous run
+    manifest = None
+    manifest_path = os.path.splitext(output)[0] + '.manifest'
+    if incremental:
+        manifest = load_manifest(manifest_path)
+
     # Process predefined GQ classes or set/single PDB files
     with open(output, 'w') as result_file:
         # Write header
         result_file.write(';Planarity[A]\tPlanarity std[A]\tTwist[deg]\tTwist std[deg]\tChains\tTopology\tLoops\n')
         # Process parameters
-        if len(args) > 0:
-            for arg in args:
-                process_path(arg, result_file)
-        else:
-            # Write results
-            for qclass in ['basket', 'chair_type', '3_plus_1', '2_plus_2', 'propeller', 'pdl', 'pplp']:
-                process_path(qclass, result_file)
+        paths = args
+        if len(paths) == 0:
+            paths = ['basket', 'chair_type', '3_plus_1', '2_plus_2', 'propeller', 'pdl', 'pplp']
+        # Collect jobs from all paths, so the workers are busy across the classes
+        jobs = []
+        for path in paths:
+            found = path_jobs(path, fast, ensemble)
+            if found is None:
+                return_code = 1
+            else:
+                jobs += found
+        # Write results
+        if process_jobs(jobs, result_file, ensemble_file, processes, manifest, profile_file) > 0:
+            return_code = 1
+    if ensemble_file:
+        ensemble_file.close()
+    if profile_file:
+        profile_file.close()
+    if manifest is not None:
+        save_manifest(manifest_path, manifest)
+    if columnar:
+        gqtable.convert(output)
 
     # Return proper code
     sys.exit(return_code)
@@ -1,145 +1,273 @@
 #!/usr/bin/env python
-import sys, getopt
+import sys, os, getopt
+import cPickle as pickle
 import numpy as np
-import pylab as pl
+import sklearn
 from sklearn import datasets, preprocessing, metrics, svm, neighbors
 from sklearn.tree import DecisionTreeClassifier
-import matplotlib.pyplot as plt
+import gqtable
 
-X = []
-Y = []
-weights = []
-class_weights = dict()
-class_ids = dict()
-class_names = dict()
-show_graph = False
+# Decision surface mesh step, the coarse grid cell size (mesh steps, a power of two) and the cap on the predicted points
+SURFACE_STEP = .01
+SURFACE_CELL = 16
+SURFACE_EVALS = 250000
+# Classifier artifact format version, bump when the Classifier changes
+MODEL_VERSION = 1
 
-def get_line_marker(line):
-    # Unpack rows of data
-    (name, qclass, planarity, planarity_std, twist, twist_std, chains, config, loops) = line.strip().split('\t')
+# Geometric classifiers by name
+CLASSIFIERS = {
+    'tree': lambda: DecisionTreeClassifier(),
+    'knn': lambda: neighbors.KNeighborsClassifier(),
+    'svm': lambda: svm.SVC(C=1.0, kernel='linear', probability=True),
+}
 
+def get_markers(table):
+    ''' Return markers of the result table rows. '''
     # Separate structures by strand count
-    planarity_coeff = float(planarity) + int(chains)*2.0
-    twist_coeff = float(twist_std)**2 + int(chains)*10.0
+    planarity_coeff = table['planarity'] + table['chains']*2.0
+    twist_coeff = table['twist_std']**2 + table['chains']*10.0
 
-    return (qclass, [twist_coeff, planarity_coeff])
+    return np.column_stack((twist_coeff, planarity_coeff))
 
-def register_class(qclass):
-        # Calculate class weights
-        if qclass not in class_names:
-            class_names[qclass] = len(class_names)
-            class_ids[class_names[qclass]] = qclass
-            class_weights[class_names[qclass]] = 0
-        class_weights[class_names[qclass]] += 1
+class Classifier:
+    ''' Geometric GQ class classifier. The markers are scaled with the training set statistics,
+        the labels are indices into the training set classes. Without the table the classifier is
+        left empty, so its saved state can be restored. '''
+
+    def __init__(self, table = None, rows = None, method = 'tree'):
+        if table is None:
+            return
+        X = get_markers(table)
+        Y = table.codes('qclass')
+        if rows is not None:
+            (X, Y) = (X[rows], Y[rows])
+        self.method = method
+        self.classes = list(table.values('qclass'))
+        self.scaler = preprocessing.StandardScaler().fit(X)
+        X = self.scaler.transform(X)
+        # Scaled marker bounds for the decision surface
+        self.bounds = (X[:, 0].min() - .5, X[:, 0].max() + .5, X[:, 1].min() - .5, X[:, 1].max() + .5)
+        self.clf = CLASSIFIERS[method]()
+        self.clf.fit(X, Y)
+
+    def labels(self, table):
+        ''' Return labels of the table rows, -1 for the classes not in the training set. '''
+        index = dict([(qclass, i) for (i, qclass) in enumerate(self.classes)])
+        lookup = np.array([index.get(qclass, -1) for qclass in table.values('qclass')], int)
+        return lookup[table.codes('qclass')]
+
+    def predict(self, table, rows = None):
+        ''' Predict labels of the table rows (default: all), returns (labels, probabilities).
+            The labels are the classifier predictions, the probability is the one of the predicted label. '''
+        X = get_markers(table)
+        if rows is not None:
+            X = X[rows]
+        if len(X) == 0:
+            return (np.zeros(0, int), np.zeros(0))
+        X = self.scaler.transform(X)
+        # SVC probabilities are calibrated separately, so their argmax may differ from the prediction
+        labels = self.clf.predict(X)
+        proba = self.clf.predict_proba(X)
+        column = np.searchsorted(self.clf.classes_, labels)
+        return (labels, proba[np.arange(len(X)), column])
+
+def evaluate(classifier, table, rows = None):
+    ''' Evaluate the classifier on the result table rows (default: all).
+        Returns (y_true, y_pred) of the correct predictions and their probabilities. '''
+    Y = classifier.labels(table)
+    if rows is not None:
+        Y = Y[rows]
+    (pred_Y, proba) = classifier.predict(table, rows)
+    return (list(pred_Y == Y), list(proba))
+
+def model_path(source):
+    ''' Return path of the classifier artifact for the training set. '''
+    return os.path.splitext(source)[0] + '-quadlearn.model'
+
+def read_model(path):
+    ''' Read classifier artifact, returns None if it's missing, broken or built by a different version. '''
+    try:
+        with open(path, 'rb') as f:
+            (version, sklearn_version, state) = pickle.load(f)
+    except (IOError, EOFError, ValueError, TypeError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+    if version != MODEL_VERSION or sklearn_version != sklearn.__version__:
+        return None
+    classifier = Classifier()
+    classifier.__dict__.update(state)
+    return classifier
+
+def save_model(path, classifier):
+    ''' Write classifier artifact, the file is replaced at once. '''
+    with open(path + '.tmp', 'wb') as f:
+        # Only the state is stored, so the artifact doesn't depend on the module name
+        pickle.dump((MODEL_VERSION, sklearn.__version__, classifier.__dict__), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+def predict_file(classifier, path, out = None):
+    ''' Predict the result table in chunks, the predictions are written to the output if passed.
+        Returns (correct, tested) counts of the rows with a class in the training set. '''
+    (correct, tested) = (0, 0)
+    for table in gqtable.load_chunks(path):
+        expect_Y = classifier.labels(table)
+        (pred_Y, proba) = classifier.predict(table)
+        selected = (expect_Y >= 0)
+        correct += np.count_nonzero(pred_Y[selected] == expect_Y[selected])
+        tested += np.count_nonzero(selected)
+        if out is not None:
+            for (name, qclass, label, p) in zip(table['name'], table['qclass'], pred_Y, proba):
+                out.write('%s\t%s\t%s\t%.03f\n' % (name, qclass, classifier.classes[label], p))
+    return (correct, tested)
+
+def decision_surface(classifier, h = SURFACE_STEP, cell = SURFACE_CELL, max_evals = SURFACE_EVALS):
+    ''' Return mesh (xx, yy, Z) of the predicted labels over the classifier bounds. The labels are predicted
+        on the corners of a coarse grid, the cells with all corners of the same label are filled with it and the
+        others are split in four until the cells are a single mesh step. Once max_evals points are predicted,
+        the unresolved cells are filled with their first corner label. '''
+    (x_min, x_max, y_min, y_max) = classifier.bounds
+    (xs, ys) = (np.arange(x_min, x_max, h), np.arange(y_min, y_max, h))
+    Z = np.zeros((len(ys), len(xs)), int)
+    known = np.zeros(Z.shape, bool)
+    evals = 0
+    # Cells as (row, column) of the top left corners
+    cells = np.array([(y, x) for y in range(0, max(len(ys) - 1, 1), cell) for x in range(0, max(len(xs) - 1, 1), cell)], int)
+    while len(cells) > 0:
+        (y0, x0) = (cells[:, 0], cells[:, 1])
+        (y1, x1) = (np.minimum(y0 + cell, len(ys) - 1), np.minimum(x0 + cell, len(xs) - 1))
+        corners = [(y0, x0), (y0, x1), (y1, x0), (y1, x1)]
+        # Predict the corners not known yet, all at once
+        if evals < max_evals:
+            points = np.unique(np.concatenate([y * len(xs) + x for (y, x) in corners]))
+            points = points[~known.ravel()[points]]
+            (py, px) = (points // len(xs), points % len(xs))
+            Z[py, px] = classifier.clf.predict(np.column_stack((xs[px], ys[py])))
+            known[py, px] = True
+            evals += len(points)
+        labels = [Z[y, x] for (y, x) in corners]
+        uniform = (labels[0] == labels[1]) & (labels[0] == labels[2]) & (labels[0] == labels[3])
+        # Fill the uniform cells and all cells once the predictions run out or the cells can't be split
+        done = uniform | (cell == 1) | (evals >= max_evals)
+        for i in np.nonzero(done)[0]:
+            area = (slice(y0[i], y1[i] + 1), slice(x0[i], x1[i] + 1))
+            Z[area][~known[area]] = labels[0][i]
+        if cell == 1 or evals >= max_evals:
+            break
+        # Split the others in four
+        cell //= 2
+        split = cells[~done]
+        cells = np.concatenate([split + (dy, dx) for dy in (0, cell) for dx in (0, cell)])
+        cells = cells[(cells[:, 0] < len(ys) - 1) & (cells[:, 1] < len(xs) - 1)]
+    (xx, yy) = np.meshgrid(xs, ys)
+    return (xx, yy, Z)
 
 def help():
     ''' Print help and exit. '''
-    print('Usage: %s [-t <path>] [-g] [directory] ' % sys.argv[0])
+    print('Usage: %s [-t <path>] [-m <classifier>] [-s <path>] [-l <path>] [-p] [-g <path>] [tsv] ' % sys.argv[0])
     print('Parameters:')
     print('\t-t <path>, --training=<path>\tTraining dataset (TSV file).')
-    print('\t-g, --graph\tShow decision surface plot.')
-    print('\t[directory]\tDirectories with GQ class families.')
+    print('\t-m <name>, --method=<name>\tClassifier (%s).' % ', '.join(sorted(CLASSIFIERS)))
+    print('\t-s <path>, --save=<path>\tSave the trained classifier.')
+    print('\t-l <path>, --load=<path>\tLoad the saved classifier instead of training.')
+    print('\t-p, --predictions\tPrint predicted class of each row.')
+    print('\t-g <path>, --graph=<path>\tWrite decision surface plot (f.e. PNG or PDF file).')
+    print('\t[tsv]\tQuadclass result data sets to predict (TSV file).')
     print('Notes:')
-    print('\tThe "-t" default is "gqclass.tsv".')
+    print('\tThe "-t" default is "gqclass.tsv", the "-m" default is "tree".')
+    print('\tThe "-s" and "-l" path is "<training>-quadlearn.model" if it\'s "-".')
     print('Example:')
-    print('"%s -t training.tsv newset" ... process spatial data from quadclass results' % sys.argv[0])
+    print('"%s -t training.tsv newset.tsv" ... process spatial data from quadclass results' % sys.argv[0])
+    print('"%s -t training.tsv -s -"       ... train once and save the classifier' % sys.argv[0])
+    print('"%s -l training-quadlearn.model -p newset.tsv" ... predict with the saved classifier' % sys.argv[0])
     sys.exit(1)
 
-# Process parameters
-try:
-    opts, args = getopt.getopt(sys.argv[1:], "hgt:", ["help", "graph", "training="])
-except getopt.GetoptError as err:
-    print str(err)
-    help()
+if __name__ == '__main__':
 
-training_file = 'gqclass.tsv'
-for o, a in opts:
-    if o in ('-h', '--help'):
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hg:t:m:s:l:p", ["help", "graph=", "training=", "method=", "save=", "load=", "predictions"])
+    except getopt.GetoptError as err:
+        print str(err)
         help()
-    elif o in ('-g', '--graph'):
-        show_graph = True 
-    elif o in ('-t', '--training'):
-        training_file = a
+
+    training_file = 'gqclass.tsv'
+    method = 'tree'
+    save_file = None
+    load_file = None
+    show_predictions = False
+    graph_file = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            help()
+        elif o in ('-g', '--graph'):
+            graph_file = a
+        elif o in ('-t', '--training'):
+            training_file = a
+        elif o in ('-m', '--method'):
+            if a not in CLASSIFIERS:
+                help()
+            method = a
+        elif o in ('-s', '--save'):
+            save_file = a
+        elif o in ('-l', '--load'):
+            load_file = a
+        elif o in ('-p', '--predictions'):
+            show_predictions = True
+        else:
+            help()
+
+    # Load the saved classifier or fit it on the training set
+    training = None
+    if load_file is not None:
+        if load_file == '-':
+            load_file = model_path(training_file)
+        classifier = read_model(load_file)
+        if classifier is None:
+            print('> can\'t load classifier "%s", missing or saved by a different version' % load_file)
+            sys.exit(1)
     else:
-        help()
+        training = gqtable.load(training_file)
+        classifier = Classifier(training, method = method)
+    if save_file is not None:
+        if save_file == '-':
+            save_file = model_path(training_file)
+        save_model(save_file, classifier)
+        print('> saved "%s"' % save_file)
+
+    # Prediction
+    for input_set in args:
+        print '> predicting', input_set
+        if show_predictions:
+            print('; Name, Class, Predicted class, Probability')
+        (correct, tested) = predict_file(classifier, input_set, sys.stdout if show_predictions else None)
+        # Print metrics, skip classes not in the training set
+        print 'Accuracy: %d/%d' % (correct, tested)
+        print 'Accuracy: %f (normalized)' % (correct / float(tested) if tested > 0 else float('nan'))
+
+    # Plot the decision boundary
+    if graph_file is not None:
+        # Render without a display
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as pl
+        dpi = 96.0
+        colors = pl.cm.Paired(np.linspace(0,1,len(classifier.classes)))
+        xx, yy, Z = decision_surface(classifier)
+        fig = pl.figure(1, figsize=(round(1000/dpi), round(600/dpi)))
+        pl.pcolormesh(xx, yy, Z, cmap = pl.cm.Paired)
 
-# Load classification markers
-with open(training_file) as datafile:
-    for line in datafile:
-
-        # Skip header
-        if line.startswith(';'):
-            continue
-        # Get geometric properties from the TSV line
-        qclass, marker = get_line_marker(line)
-        register_class(qclass)
-
-        X.append(marker)
-        Y.append(class_names[qclass])
-
-# Recalculate weights
-for i in xrange(0, len(Y)):
-    weights.append( class_weights[ Y[i] ] )
-
-# Normalize data
-h = .01  # step size in the mesh
-X = preprocessing.scale(np.array(X))
-Y = np.array(Y)
-
-# Fit the models
-clf = DecisionTreeClassifier()
-#clf = neighbors.KNeighborsClassifier()
-#clf = svm.SVC(C=1.0, kernel='linear')
-clf.fit(X, Y)
-
-x_min, x_max = X[:, 0].min() - .5, X[:, 0].max() + .5
-y_min, y_max = X[:, 1].min() - .5, X[:, 1].max() + .5
-
-# Prediction
-for input_set in args:
-    print '> predicting', input_set
-    with open(input_set) as fit_data:
-        pred_X = []
-        expect_Y = []
-        for line in fit_data:
-            # Skip header
-            if line.startswith(';'):
-                continue
-            # Get geometric properties from the TSV line
-            qclass, marker = get_line_marker(line)
-            if qclass not in class_names:
-                continue
-            pred_X.append(marker)
-            expect_Y.append(class_names[qclass])
-        # Predict
-        expect_Y = np.array(expect_Y)
-        pred_X = preprocessing.scale(np.array(pred_X))
-        pred_Y = clf.predict(pred_X)
-        # Print metrics
-        print 'Accuracy: %d/%d' % (metrics.accuracy_score(expect_Y, pred_Y, normalize=False), len(pred_Y))
-        print 'Accuracy: %f (normalized)' % metrics.accuracy_score(expect_Y, pred_Y)
-
-
-# Plot the decision boundary
-if show_graph:
-    dpi = 96.0
-    colors = pl.cm.Paired(np.linspace(0,1,len(class_names)))
-    xx, yy = np.meshgrid(np.arange(x_min, x_max, h), np.arange(y_min, y_max, h))
-    Z = clf.predict(np.c_[xx.ravel(), yy.ravel()])
-    Z = Z.reshape(xx.shape)
-    fig = pl.figure(1, figsize=(round(1000/dpi), round(600/dpi)))
-    pl.pcolormesh(xx, yy, Z, cmap = pl.cm.Paired)
-
-    # Plot also the training points
-    for i in range(len(class_names)):
-        idx = np.where(Y == i)
-        pl.scatter(X[idx, 0], X[idx, 1], c = colors[i], label = class_ids[i])
-    pl.xlabel('Twist')
-    pl.ylabel('Planarity')
-    pl.xlim(xx.min(), xx.max())
-    pl.ylim(yy.min(), yy.max())
-    pl.xticks(())
-    pl.yticks(())
-    pl.legend()
-    pl.show()
-    fig.savefig('decision-surface.png')
+        # Plot also the training points
+        if training is not None:
+            X = classifier.scaler.transform(get_markers(training))
+            Y = training.codes('qclass')
+            for i in range(len(classifier.classes)):
+                idx = np.where(Y == i)
+                pl.scatter(X[idx, 0], X[idx, 1], c = colors[i], label = classifier.classes[i])
+        pl.xlabel('Twist')
+        pl.ylabel('Planarity')
+        pl.xlim(xx.min(), xx.max())
+        pl.ylim(yy.min(), yy.max())
+        pl.xticks(())
+        pl.yticks(())
+        pl.legend()
+        fig.savefig(graph_file)
+        print('> written "%s"' % graph_file)
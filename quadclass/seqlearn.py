@@ -1,25 +1,39 @@
 #!/usr/bin/env python
 import re
-import sys, getopt
-import pylab as pl
-from sklearn.metrics import roc_curve, auc
-from matplotlib.lines import Line2D
+import sys, os, getopt, hashlib
+import cPickle as pickle
+import numpy
+import gqtable
+
+# Number of queries compared with the training set at once
+BATCH_SIZE = 1024
+# Loop k-mer length and the number of most similar known loops reported
+KMER = 3
+SIMILAR_TOP = 3
+# Predictor reasons in the evaluation order
+REASONS = ('length_match', 'length_dt', 'composition', 'similarity')
 
 def load_classlist(source = 'gqclass.tsv'):
-    ''' Load sequence classlist. '''
+    ''' Load sequence classlist from the result table (TSV or its columnar copy). '''
+    return table_classlist(gqtable.load(source))
+
+def table_classlist(table, rows = None):
+    ''' Build sequence classlist from the result table rows (default: all). '''
     gq_classlist = dict()
-    with open(source) as datafile:
-        for line in datafile:
-            # Skip header
-            if line.startswith(';'):
-                continue
-            # Unpack rows of data
-            (name, qclass, planarity, planarity_std, twist, twist_std, chains, topology, loops) = line.strip().split('\t')
-            if not qclass in gq_classlist:
-                gq_classlist[qclass] = {'id': qclass, 'topology': set([])}
-            # Inosine -> Guanine ambiguity
-            loops = '|'.join(loops.replace('I', 'G').split('|')[0:3])
-            gq_classlist[qclass]['topology'].add((topology, loops))
+    # Inosine -> Guanine ambiguity
+    loop_values = ['|'.join(loops.replace('I', 'G').split('|')[0:3]) for loops in table.values('loops')]
+    # Distinct (class, topology, loops) in the order of the first appearance
+    (qclasses, topologies, loops) = (table.codes('qclass'), table.codes('topology'), table.codes('loops'))
+    if rows is not None:
+        (qclasses, topologies, loops) = (qclasses[rows], topologies[rows], loops[rows])
+    keys = (qclasses.astype('i8') * len(table.values('topology')) + topologies) * len(loop_values) + loops
+    (unique, first) = numpy.unique(keys, return_index = True)
+    first = numpy.sort(first)
+    for (qclass, topology, loops) in zip(qclasses[first], topologies[first], loops[first]):
+        (qclass, topology, loops) = (str(table.values('qclass')[qclass]), str(table.values('topology')[topology]), loop_values[loops])
+        if not qclass in gq_classlist:
+            gq_classlist[qclass] = {'id': qclass, 'topology': set([])}
+        gq_classlist[qclass]['topology'].add((topology, loops))
     return gq_classlist
 
 def loop_len_config(loops):
@@ -59,6 +73,11 @@ def loop_composition(loops):
     norm = 1.0 / n_sum
     return {n: round(composition[n] * norm, 2) for n in composition}
 
+def loop_kmers(loops, k = KMER):
+    ''' Return set of k-mers of the loop sequences, the G-tracts are left out and the loop boundaries kept. '''
+    seq = '|%s|' % '|'.join([loop.lstrip('G') for loop in loops])
+    return set([seq[i:i + k] for i in range(len(seq) - k + 1)])
+
 def find_fragments(seq):
     ''' Identify L{1,2,3} loops in sequence. '''
     loops = []
@@ -120,44 +139,191 @@ def calc_pval(clslist):
                 ins_pval(pval['config'], loop_len_config(loops.split('|')), qclass)
         return pval
 
-def fit(gq_classlist, loops, pval_table):
-    ''' Decompose input sequence and attempt to fit it to the identified GQ classes. '''
-    if len(loops) == 0:
-        return set([])
-    config = loop_len_config(loops)
-    len_dt = loop_len_dt(loops)
-    n_freq = loop_composition(loops)
-    candidates = dict()
-
-    # Calculate least error composition
-    k3best = 1.0
-    k3best_match = (None, None, None)
-
-    for qclass, info in gq_classlist.items():
-        for (gq_topology, gq_loops) in info['topology']:
-            # Match based on L1-L3 length configuration
-            candidate_config = loop_len_config(gq_loops.split('|'))
-            if config == candidate_config:
+class Predictor:
+    ''' GQ class predictor compiled from the classlist. The known loop length configurations and
+        derivations are indexed with the matching (class, topology) reasons and p-values, the loop
+        compositions are kept in a (topologies x nucleotides) matrix. '''
+
+    def __init__(self, gq_classlist, pval_table = None):
+        if pval_table is None:
+            pval_table = calc_pval(gq_classlist)
+        self.classlist = gq_classlist
+        self.pval_table = pval_table
+        self.digest = None
+        self.config = dict()
+        self.dt = dict()
+        self.topologies = []
+        self.nucleotides = None
+        composition = []
+        # Entries keep the classlist iteration order, so the ties are resolved the same way
+        for qclass, info in gq_classlist.items():
+            for (gq_topology, gq_loops) in info['topology']:
+                row = len(self.topologies)
+                self.topologies.append((qclass, gq_topology, gq_loops))
+                gq_loops = gq_loops.split('|')
+                config = loop_len_config(gq_loops)
                 pval = get_pval(pval_table['config'], config, qclass)
-                fit_candidate(candidates, qclass, gq_topology, 'length_match', config, pval)
-            # Match based on length sequence derivation
-            gq_len_dt = loop_len_dt(gq_loops.split('|'))
-            if len_dt == gq_len_dt:
+                self.config.setdefault(config, []).append((row, 0, qclass, gq_topology, 'length_match', config, pval))
+                len_dt = loop_len_dt(gq_loops)
                 pval = get_pval(pval_table['dt'], len_dt, qclass)
-                fit_candidate(candidates, qclass, gq_topology, 'length_dt', len_dt, pval)
-            # Match based on sequence composition
-            gq_n_freq = loop_composition(gq_loops.split('|'))
-            k3err = sum([abs(n_freq[n] - gq_n_freq[n]) for n in gq_n_freq.keys()]) / 5.0
-            if k3err < k3best:
-                k3best = k3err
-                k3best_match = (qclass, gq_topology, gq_loops)
+                self.dt.setdefault(len_dt, []).append((row, 1, qclass, gq_topology, 'length_dt', len_dt, pval))
+                gq_n_freq = loop_composition(gq_loops)
+                if self.nucleotides is None:
+                    self.nucleotides = gq_n_freq.keys()
+                composition.append([gq_n_freq[n] for n in self.nucleotides])
+        self.composition = numpy.array(composition, 'f8').reshape((len(composition), len(self.nucleotides or [])))
+        # Inverted index of the loop k-mers
+        index = dict()
+        self.kmer_counts = numpy.zeros(len(self.topologies), int)
+        for (row, (qclass, gq_topology, gq_loops)) in enumerate(self.topologies):
+            kmers = loop_kmers(gq_loops.split('|'))
+            self.kmer_counts[row] = len(kmers)
+            for kmer in kmers:
+                index.setdefault(kmer, []).append(row)
+        self.kmers = dict([(kmer, numpy.array(rows, int)) for (kmer, rows) in index.items()])
+
+    def fit(self, loops):
+        ''' Fit loops decomposed from the input sequence to the identified GQ classes. '''
+        return self.fit_batch([loops])[0]
+
+    def fit_batch(self, queries):
+        ''' Fit a batch of queries, each is either a sequence or the list of its loops.
+            The exact matches are looked up once per distinct configuration and derivation, the loop
+            compositions of all queries are compared with the training set at once. The queries with
+            an unknown nucleotide in the loops get no composition match. Returns list of candidates. '''
+        queries = [find_fragments(query) if isinstance(query, basestring) else query for query in queries]
+        results = [set([]) if len(loops) == 0 else dict() for loops in queries]
+        fitted = [i for (i, loops) in enumerate(queries) if len(loops) > 0]
+        # Group the queries by the L1-L3 length configuration and length sequence derivation
+        groups = dict()
+        for i in fitted:
+            groups.setdefault((loop_len_config(queries[i]), loop_len_dt(queries[i])), []).append(i)
+        for ((config, len_dt), members) in groups.items():
+            matches = sorted(self.config.get(config, []) + self.dt.get(len_dt, []))
+            for i in members:
+                for (row, order, qclass, gq_topology, reason, val, pval) in matches:
+                    fit_candidate(results[i], qclass, gq_topology, reason, val, pval)
+        # Pick least sequence composition error match
+        if len(self.topologies) > 0 and len(fitted) > 0:
+            (composition, valid) = self.compose([queries[i] for i in fitted])
+            for start in range(0, len(fitted), BATCH_SIZE):
+                block = composition[start:start + BATCH_SIZE]
+                k3err = numpy.abs(block[:, numpy.newaxis, :] - self.composition[numpy.newaxis, :, :]).sum(axis = 2) / 5.0
+                best = numpy.argmin(k3err, axis = 1)
+                for (j, row) in enumerate(best):
+                    if valid[start + j] and k3err[j, row] < 1.0:
+                        (qclass, gq_topology, gq_loops) = self.topologies[row]
+                        fit_candidate(results[fitted[start + j]], qclass, gq_topology, 'composition', 'match', k3err[j, row])
+        # Pick most similar known loops
+        similar = dict()
+        for i in fitted:
+            key = '|'.join(queries[i])
+            if key not in similar:
+                similar[key] = self.similar(queries[i])
+            for (row, score) in similar[key]:
+                (qclass, gq_topology, gq_loops) = self.topologies[row]
+                fit_candidate(results[i], qclass, gq_topology, 'similarity', gq_loops, 1.0 - score)
+        return results
 
-    # Pick least sequence composition error match
-    if k3best < 1.0:
-        (qclass, gq_topology, gq_loops) = k3best_match
-        fit_candidate(candidates, qclass, gq_topology, 'composition', 'match', k3best)
+    def similar(self, loops, top = SIMILAR_TOP):
+        ''' Return the most similar known loops as [(row, score)], the score is the Dice coefficient
+            of the loop k-mer sets. Only the topologies sharing at least one k-mer are scored. '''
+        kmers = loop_kmers(loops)
+        postings = [self.kmers[kmer] for kmer in kmers if kmer in self.kmers]
+        if len(postings) == 0:
+            return []
+        (rows, shared) = numpy.unique(numpy.concatenate(postings), return_counts = True)
+        scores = 2.0 * shared / (len(kmers) + self.kmer_counts[rows])
+        best = numpy.argsort(-scores, kind = 'mergesort')[:top]
+        return zip(rows[best], scores[best])
+
+    def compose(self, queries):
+        ''' Return (queries x nucleotides) matrix of the loop compositions rounded same as
+            in the loop_composition(), and the mask of queries with a known composition. '''
+        joined = [''.join(loops) for loops in queries]
+        lengths = numpy.array([len(loops) for loops in joined], int)
+        codes = numpy.full(256, -1, int)
+        for (col, n) in enumerate(self.nucleotides):
+            codes[ord(n)] = col
+        codes = codes[numpy.frombuffer(''.join(joined), numpy.uint8)]
+        owner = numpy.repeat(numpy.arange(len(queries)), lengths)
+        valid = (lengths > 0)
+        valid[owner[codes < 0]] = False
+        counts = numpy.bincount(owner[codes >= 0] * len(self.nucleotides) + codes[codes >= 0],
+                                minlength = len(queries) * len(self.nucleotides)).reshape((len(queries), -1))
+        composition = counts * (1.0 / numpy.maximum(lengths, 1))[:, numpy.newaxis]
+        # Python rounds the exact half-way cases differently
+        scaled = composition * 100.0
+        rounded = numpy.round(composition, 2)
+        for (i, col) in zip(*numpy.nonzero(numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6)):
+            rounded[i, col] = round(composition[i, col], 2)
+        return (rounded, valid)
+
+def fit(gq_classlist, loops, pval_table):
+    ''' Decompose input sequence and attempt to fit it to the identified GQ classes.
+        Use the Predictor for repeated queries, it's compiled on each call. '''
+    return Predictor(gq_classlist, pval_table).fit(loops)
 
-    return candidates
+# Predictor artifact format version, bump when the Predictor changes
+MODEL_VERSION = 2
+# Predictors loaded in this process as {source: ((mtime, size), predictor)}
+predictors = dict()
+
+def model_path(source):
+    ''' Return path of the predictor artifact for the training set. '''
+    return os.path.splitext(source)[0] + '.model'
+
+def source_hash(source):
+    ''' Return SHA-1 of the training set file. '''
+    digest = hashlib.sha1()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_model(path, digest):
+    ''' Read predictor artifact, returns None if it's missing, broken or built from a different source. '''
+    try:
+        with open(path, 'rb') as f:
+            (version, state) = pickle.load(f)
+    except (IOError, EOFError, ValueError, TypeError, KeyError, pickle.UnpicklingError):
+        return None
+    if version != MODEL_VERSION or state.get('digest') != digest:
+        return None
+    predictor = Predictor(dict())
+    predictor.__dict__.update(state)
+    return predictor
+
+def save_model(path, predictor):
+    ''' Write predictor artifact, the file is replaced at once. Read-only location is not an error. '''
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            # Only the state is stored, so the artifact doesn't depend on the module name
+            pickle.dump((MODEL_VERSION, predictor.__dict__), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass
+
+def load_predictor(source = 'gqclass.tsv'):
+    ''' Return predictor for the training set. The predictor is memoized in the process and stored
+        as an artifact next to the training set, versioned by the source hash, so it's rebuilt only
+        when the training set changes. '''
+    stat = os.stat(source)
+    key = (stat.st_mtime, stat.st_size)
+    cached = predictors.get(source)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = source_hash(source)
+    if cached is not None and cached[1].digest == digest:
+        predictor = cached[1]
+    else:
+        predictor = read_model(model_path(source), digest)
+        if predictor is None:
+            predictor = Predictor(load_classlist(source))
+            predictor.digest = digest
+            save_model(model_path(source), predictor)
+    predictors[source] = (key, predictor)
+    return predictor
 
 def evaluate_k(qclass, pred, y_pred, y_true, why = None):
     best = [None, 1.0]
@@ -176,29 +342,63 @@ def evaluate_k(qclass, pred, y_pred, y_true, why = None):
     y_pred.append(1 - best[1])
     return best
 
+def roc_curve(y_true, y_score):
+    ''' Return ROC curve (false positive rates, true positive rates, thresholds) of the scored predictions. '''
+    y_true = numpy.asarray(y_true, bool)
+    y_score = numpy.asarray(y_score, float)
+    order = numpy.argsort(-y_score, kind = 'mergesort')
+    (y_true, y_score) = (y_true[order], y_score[order])
+    # Last prediction of each distinct score
+    last = numpy.r_[numpy.nonzero(numpy.diff(y_score))[0], len(y_score) - 1] if len(y_score) > 0 else numpy.zeros(0, int)
+    tps = numpy.r_[0, numpy.cumsum(y_true)[last]]
+    fps = numpy.r_[0, numpy.cumsum(~y_true)[last]]
+    thresholds = numpy.r_[numpy.inf, y_score[last]]
+    # Undefined without both outcomes
+    fpr = fps / float(fps[-1]) if fps[-1] > 0 else numpy.full(len(fps), numpy.nan)
+    tpr = tps / float(tps[-1]) if tps[-1] > 0 else numpy.full(len(tps), numpy.nan)
+    return (fpr, tpr, thresholds)
+
+def roc_auc(fpr, tpr):
+    ''' Return area under the ROC curve. '''
+    return numpy.trapz(tpr, fpr)
+
+def evaluate(predictor, table, rows = None):
+    ''' Evaluate the predictor on the result table rows (default: all).
+        Returns {reason: (y_true, y_pred)} of the best candidates for each reason. '''
+    (qclasses, loops) = (table['qclass'], table['loops'])
+    if rows is not None:
+        (qclasses, loops) = (qclasses[rows], loops[rows])
+    scores = dict([(reason, ([], [])) for reason in REASONS])
+    queries = [query.replace('I', 'G').split('|') for query in loops]
+    for (qclass, pred) in zip(qclasses, predictor.fit_batch(queries)):
+        for reason in REASONS:
+            (y_true, y_pred) = scores[reason]
+            evaluate_k(qclass, pred, y_pred, y_true, reason)
+    return scores
+
 def evaluate_show(name, y_pred, y_true, pl, style):
-    print '%s accuracy: %f' % (name, y_true.count(True)/float(len(y_true)))
     fpr, tpr, thresholds = roc_curve(y_true, y_pred)
     # Plot ROC curve
     pl.plot(fpr, tpr, marker=style, label=name)
 
-def validate(gq_classlist, input_file, pval_table, graph = True):
-    k_style = [ '^', 'o', 's' ]
-    k_name = [ 'length_match', 'length_dt', 'composition' ]
-    y_pred = [ [], [], [] ]
-    y_true = [ [], [], [] ]
-    for line in input_file:
-        line = line.strip().split('\t')
-        qclass, loops = (line[1], line[8].replace('I', 'G').split('|'))
-        pred = fit(gq_classlist, loops, pval_table)
-        for k in range(len(k_name)):
-            evaluate_k(qclass, pred, y_pred[k], y_true[k], k_name[k])
+def validate(predictor, table, graph = False):
+    ''' Print accuracy and ROC AUC of the predictors, the ROC curves are plotted if requested. '''
+    k_style = [ '^', 'o', 's', 'D' ]
+    scores = evaluate(predictor, table)
+    for reason in REASONS:
+        (y_true, y_pred) = scores[reason]
+        (fpr, tpr, thresholds) = roc_curve(y_true, y_pred)
+        print '%s accuracy: %f AUC: %f' % (reason, y_true.count(True)/float(len(y_true)), roc_auc(fpr, tpr))
+    if not graph:
+        return
     # Plot ROC curve
+    import pylab as pl
     pl.clf()
     dpi = 96.0
     fig = pl.figure(1, figsize=(round(1000/dpi), round(600/dpi)))
-    for k in range(0, len(k_name)):
-        evaluate_show(k_name[k], y_pred[k], y_true[k], pl, k_style[k])
+    for k in range(0, len(REASONS)):
+        (y_true, y_pred) = scores[REASONS[k]]
+        evaluate_show(REASONS[k], y_pred, y_true, pl, k_style[k])
     pl.xlim([0.0, 1.0])
     pl.ylim([0.0, 1.0])
     pl.xlabel('False Positive Rate')
@@ -248,17 +448,16 @@ if __name__ == '__main__':
         else:
             help()
 
-    gq_classlist = load_classlist(class_file)
-    pval = calc_pval(gq_classlist)
+    predictor = load_predictor(class_file)
+    (gq_classlist, pval) = (predictor.classlist, predictor.pval_table)
 
     # Accept sequences as parameters
     if len(args) > 0:
-        for seq in args:
-            seq = seq.trim()
+        sequences = [seq.strip() for seq in args]
+        fragments = [find_fragments(seq) for seq in sequences]
+        for (seq, loops, candidates) in zip(sequences, fragments, predictor.fit_batch(fragments)):
             print('> %s ...' % seq)
-            loops = find_fragments(seq)
             print('%s %s %s %s' % (loop_len_config(loops), loop_len_dt(loops), '|'.join(loops), loop_composition(loops).values()))
-            candidates = fit(gq_classlist, loops, pval)
             for key in candidates:
                 print '%s (%s)' % (key[0], key[1])
                 for reason_str in candidates[key]:
@@ -267,7 +466,7 @@ if __name__ == '__main__':
 
     # Validate file if presented
     elif validate_file != None:
-            validate(gq_classlist, open(validate_file), pval)
+            validate(predictor, gqtable.load(validate_file), show_graph)
 
     # No parameters, just print out current fitting info
     else:  
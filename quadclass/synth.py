@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+''' Synthetic G-quadruplex structure generator.
+    Stacked tetrads of ideal guanines are connected by the loops on one, two or four strands,
+    the atom coordinates may be jittered and decoy guanines placed around the core. '''
+import sys, getopt, math, random
+
+# Guanine in the tetrad frame, the O6 facing the central channel (z = 0).
+# Each next guanine in the tetrad is rotated by -90deg, so the N7 of a guanine
+# forms a Hoogsteen bond with N2-H21 of the next one (both ~2.9A apart).
+GUANINE = [
+    ('C1\'', (0.475, 8.245)),
+    ('N9',   (0.856, 6.836)),
+    ('C8',   (2.131, 6.322)),
+    ('N7',   (2.156, 5.017)),
+    ('C5',   (0.818, 4.645)),
+    ('C6',   (0.220, 3.360)),
+    ('O6',   (0.773, 2.253)),
+    ('N1',   (-1.169, 3.440)),
+    ('C2',   (-1.890, 4.608)),
+    ('N2',   (-3.226, 4.478)),
+    ('N3',   (-1.345, 5.813)),
+    ('C4',   (0.003, 5.759)),
+]
+
+# Rise between the stacked tetrads [A]
+RISE = 3.3
+# Loop bulge distance from the core [A]
+BULGE = 4.0
+# Distance of decoy guanines from the GQ axis [A]
+DECOY_SHELL = (14.0, 22.0)
+
+def rotate(point, angle):
+    ''' Rotate point around the GQ axis (z). '''
+    (x, y, z) = point
+    (cos, sin) = (math.cos(angle), math.sin(angle))
+    return (x * cos - y * sin, x * sin + y * cos, z)
+
+def guanine_atoms(angle, shift = (0.0, 0.0, 0.0)):
+    ''' Place guanine template rotated around the GQ axis and shifted. '''
+    atoms = []
+    for (name, (x, y)) in GUANINE:
+        (x, y, z) = rotate((x, y, 0.0), angle)
+        atoms.append((name, (x + shift[0], y + shift[1], z + shift[2])))
+    return atoms
+
+def core_angle(level, pos, twist):
+    ''' Rotation of the guanine at given tetrad level and position. '''
+    return math.radians(level * twist) - pos * math.pi / 2.0
+
+def strand_layout(tetrads, strands, loops):
+    ''' Place G-runs of each strand on the (level, position) slots of the tetrad stack.
+        Propeller loops keep the strand direction and connect the opposite ends of the stack,
+        lateral and diagonal loops reverse the direction and connect adjacent or diagonal position
+        on the same level. '''
+    if strands not in (1, 2, 4):
+        raise ValueError('unsupported strand count %d' % strands)
+    runs = 4 // strands
+    if len(loops) != runs - 1:
+        raise ValueError('expected %d loop(s) per strand, got "%s"' % (runs - 1, loops))
+    used = set([])
+    layout = []
+    for strand in range(strands):
+        pos = min(set(range(4)) - used)
+        (level, step) = (0, 1)
+        strand_runs = []
+        for run in range(runs):
+            if run > 0:
+                loop = loops[run - 1]
+                if loop == 'D':
+                    choices = [(pos + 2) % 4]
+                elif loop in ('L', 'P'):
+                    choices = [(pos + 1) % 4, (pos - 1) % 4]
+                else:
+                    raise ValueError('unknown loop type "%s"' % loop)
+                choices = [p for p in choices if p not in used]
+                if len(choices) == 0:
+                    raise ValueError('loops "%s" can\'t be placed on the tetrad stack' % loops)
+                pos = choices[0]
+                if loop == 'P':
+                    level = 0 if step > 0 else tetrads - 1
+                else:
+                    level = level - step
+                    step = -step
+            used.add(pos)
+            strand_runs.append([(level + i * step, pos) for i in range(tetrads)])
+            level += step * tetrads
+        layout.append(strand_runs)
+    return layout
+
+def loop_point(entry, closure, t):
+    ''' Interpolate loop nucleotide position, bulging outwards from the core. '''
+    point = [entry[i] + (closure[i] - entry[i]) * t for i in range(3)]
+    radius = math.hypot(point[0], point[1]) or 1.0
+    bulge = BULGE * math.sin(math.pi * t)
+    return (point[0] * (1 + bulge / radius), point[1] * (1 + bulge / radius), point[2])
+
+def nucleotide_atoms(name, point, rng):
+    ''' Atoms of a non-core nucleotide at given point. Guanines get full base, so they may act as decoys. '''
+    if name != 'G':
+        return [('C1\'', point)]
+    angle = rng.uniform(0, 2 * math.pi)
+    (cx, cy, _) = rotate(GUANINE[0][1] + (0.0,), angle)
+    return guanine_atoms(angle, (point[0] - cx, point[1] - cy, point[2]))
+
+def decoy_point(tetrads, rng):
+    ''' Random point on the decoy shell around the GQ core. '''
+    (radius, angle) = (rng.uniform(*DECOY_SHELL), rng.uniform(0, 2 * math.pi))
+    return (radius * math.cos(angle), radius * math.sin(angle), rng.uniform(0, RISE * tetrads))
+
+def build_chains(tetrads, strands, loops, loop_seq, twist, decoys, rng):
+    ''' Build a reference model as a list of chains of (resname, [(atom, xyz)]) residues. '''
+    chains = []
+    for strand_runs in strand_layout(tetrads, strands, loops):
+        residues = []
+        for (k, run) in enumerate(strand_runs):
+            if k > 0:
+                entry = residues[-1][1][0][1]
+                (level, pos) = run[0]
+                closure = rotate(GUANINE[0][1] + (0.0,), core_angle(level, pos, twist))
+                closure = (closure[0], closure[1], level * RISE)
+                for (i, n) in enumerate(loop_seq):
+                    point = loop_point(entry, closure, (i + 1) / float(len(loop_seq) + 1))
+                    residues.append(('D' + n, nucleotide_atoms(n, point, rng)))
+            for (level, pos) in run:
+                residues.append(('DG', guanine_atoms(core_angle(level, pos, twist), (0.0, 0.0, level * RISE))))
+        chains.append(residues)
+    # Decoy guanines flank the first strand on both ends
+    for i in range(decoys):
+        decoy = ('DG', nucleotide_atoms('G', decoy_point(tetrads, rng), rng))
+        if i % 2 == 0:
+            chains[0].insert(0, decoy)
+        else:
+            chains[0].append(decoy)
+    return chains
+
+def write_model(out, chains, jitter, rng):
+    ''' Write single model in the PDB format, atom coordinates with a gaussian jitter. '''
+    serial = 1
+    for (chain_no, residues) in enumerate(chains):
+        chain_id = chr(ord('A') + chain_no)
+        for (resseq, (resname, atoms)) in enumerate(residues):
+            for (name, (x, y, z)) in atoms:
+                if jitter > 0.0:
+                    (x, y, z) = (x + rng.gauss(0, jitter), y + rng.gauss(0, jitter), z + rng.gauss(0, jitter))
+                out.write('ATOM  %5d %-4s %3s %1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f          %2s\n' % \
+                          (serial, ' ' + name, resname, chain_id, resseq + 1, x, y, z, 1.0, 0.0, name[0]))
+                serial += 1
+        out.write('TER   %5d      %3s %1s%4d\n' % (serial, residues[-1][0], chain_id, len(residues)))
+        serial += 1
+
+def generate(out, tetrads = 3, strands = 1, loops = 'LDL', loop_seq = 'TTA', twist = 30.0,
+             jitter = 0.0, decoys = 0, models = 1, seed = None):
+    ''' Write synthetic GQ structure of stacked tetrads in the PDB format. '''
+    rng = random.Random(seed)
+    chains = build_chains(tetrads, strands, loops, loop_seq, twist, decoys, rng)
+    for model in range(models):
+        if models > 1:
+            out.write('MODEL     %4d\n' % (model + 1))
+        write_model(out, chains, jitter, rng)
+        if models > 1:
+            out.write('ENDMDL\n')
+    out.write('END\n')
+
+def help():
+    ''' Print help and exit. '''
+    print('Usage: %s [-t <n>] [-s <n>] [-l <loops>] [-q <seq>] [-w <deg>] [-j <A>] [-d <n>] [-m <n>] [-r <seed>]' % sys.argv[0])
+    print('Parameters:')
+    print('\t-t <n>, --tetrads=<n>\tNumber of stacked tetrads (default: 3).')
+    print('\t-s <n>, --strands=<n>\tNumber of strands, 1, 2 or 4 (default: 1).')
+    print('\t-l <loops>, --loops=<loops>\tLoop types per strand, L/D/P (default: LDL).')
+    print('\t-q <seq>, --loop-seq=<seq>\tLoop sequence (default: TTA).')
+    print('\t-w <deg>, --twist=<deg>\tTwist between the tetrads (default: 30).')
+    print('\t-j <A>, --jitter=<A>\tGaussian jitter of atom coordinates (default: 0).')
+    print('\t-d <n>, --decoys=<n>\tNumber of decoy guanines flanking the first strand (default: 0).')
+    print('\t-m <n>, --models=<n>\tNumber of models (default: 1).')
+    print('\t-r <seed>, --seed=<seed>\tRandom seed.')
+    print('Example:')
+    print('"%s -t 4 -l PPP -m 10 -j 0.2 > 4PPP.pdb" ... 4-tetrad propeller NMR-like ensemble' % sys.argv[0])
+    sys.exit(1)
+
+if __name__ == '__main__':
+
+    # Process parameters
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ht:s:l:q:w:j:d:m:r:",
+                                   ["help", "tetrads=", "strands=", "loops=", "loop-seq=", "twist=",
+                                    "jitter=", "decoys=", "models=", "seed="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        help()
+    params = {}
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            help()
+        elif o in ('-t', '--tetrads'):
+            params['tetrads'] = int(a)
+        elif o in ('-s', '--strands'):
+            params['strands'] = int(a)
+        elif o in ('-l', '--loops'):
+            params['loops'] = a.upper()
+        elif o in ('-q', '--loop-seq'):
+            params['loop_seq'] = a.upper()
+        elif o in ('-w', '--twist'):
+            params['twist'] = float(a)
+        elif o in ('-j', '--jitter'):
+            params['jitter'] = float(a)
+        elif o in ('-d', '--decoys'):
+            params['decoys'] = int(a)
+        elif o in ('-m', '--models'):
+            params['models'] = int(a)
+        elif o in ('-r', '--seed'):
+            params['seed'] = int(a)
+        else:
+            help()
+
+    generate(sys.stdout, **params)
@@ -1,13 +1,40 @@
 #!/usr/bin/env python
 import sys
+import time
+import contextlib
+import collections
+import itertools
 import numpy
 import math
 from Bio.PDB import *
-from Bio import pairwise2
+
+# Analyzer version, cached results of other versions are recomputed
+VERSION = 5
+
+# Print the analysis progress
+VERBOSE = True
+
+# Profiled stages and counters, see Stats
+PROFILE_STAGES = ('parse', 'scan', 'group', 'stack', 'replay', 'planarity', 'twist', 'loops')
+PROFILE_COUNTS = ('guanines', 'queries', 'tetrads', 'stacks')
 
 # Allowed nucleotides in a loop
 NUCLEOTIDE = set([ 'DA', 'DC', 'DG', 'DT', 'DI' ])
 
+# Guanine atoms used in the analysis
+CORE_ATOMS = set([ 'N9', 'O6', 'C1\'', 'N7', 'N2', 'N1' ])
+
+# Padding of the neighbour index radius queries [A], exact distances are checked afterwards
+INDEX_SLACK = 0.01
+
+# Maximum N7-N2 Hoogsteen bond and C1' stacking contact distance [A]
+HOOGSTEEN_MAX = 5.0
+STACKING_MAX = 15.0
+
+# Maximum displacement of the pairing atoms [A] between the models of an ensemble, for which the decisions recorded
+# on the first model are replayed. The recorded candidates are the ones within the distance padded twice by it.
+REPLAY_SLACK = 2.0
+
 def nucleotide_translate(name):
     # Subtitute 8-bromoguanosines for normal DG (see 2E4I)
     if name == 'BGM':
@@ -17,211 +44,444 @@ def nucleotide_translate(name):
         return 'DG'
     return name
 
+def log(message):
+    ''' Print analysis progress, unless quiet. '''
+    if VERBOSE:
+        print(message)
+
+class Stats:
+    ''' Wall time [s] of the analysis stages and counters, recorded per model. '''
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        ''' Measure the stage, repeated stages are summed. '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0.0) + time.time() - start
+
+    def count(self, name, value = 1):
+        ''' Increment counter. '''
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def row(self):
+        ''' Return times [ms] of PROFILE_STAGES, the total time and PROFILE_COUNTS. '''
+        times = [1000.0 * self.times.get(stage, 0.0) for stage in PROFILE_STAGES]
+        return times + [sum(times)] + [self.counts.get(name, 0) for name in PROFILE_COUNTS]
+
 def resi_name(resi):
     ''' Get residue nucleotide name. '''
     return nucleotide_translate(resi.get_resname().strip(' ')).strip('D')
 
+# Tetrad sides, the twist is measured along each of them
+SIDES = ([0, 1, 2, 3], [1, 2, 3, 0])
+
+def tetrad_coords(tetrads, name):
+    ''' Return dense (tetrads x 4 x 3) array of given atom coordinates. '''
+    return numpy.array([[resi[name].get_coord() for resi in tetrad] for tetrad in tetrads], dtype = 'd')
+
 def point_rmsd(a, b):
-    ''' Calculate RMSD between two points. '''
+    ''' Calculate RMSD between points, the coordinates are along the last axis. '''
     sub = a - b
-    sub = (sub[0], sub[1], sub[2]) # Python3 compatibility
-    return numpy.sqrt(numpy.dot(sub, sub))
+    return numpy.sqrt((sub * sub).sum(axis = -1))
 
-def tetragon_cog(atoms):
-    ''' Calculate center of gravity for given tetragon.
+def tetragon_cog(coords):
+    ''' Calculate center of gravity for tetragons in the (... x 4 x 3) coordinate array.
     @note This only works for non self-intersecting tetragons. '''
-    vectors = [atom.get_vector() for atom in atoms]
-    cog1 = (vectors[0] + vectors[3]) / 2.0
-    cog2 = (vectors[1] + vectors[2]) / 2.0
+    cog1 = (coords[..., 0, :] + coords[..., 3, :]) / 2.0
+    cog2 = (coords[..., 1, :] + coords[..., 2, :]) / 2.0
     return (cog1 + cog2) / 2.0
 
-def analyze_planarity(tetrads):
+def dihedral(v1, v2, v3, v4):
+    ''' Calculate absolute dihedral angles between points, the coordinates are along the last axis.
+        Degenerate angles (f.e. two points mapped onto one) are pi, same as in calc_dihedral(). '''
+    cb = v3 - v2
+    u = numpy.cross(v1 - v2, cb)
+    v = numpy.cross(v4 - v3, cb)
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        cos = (u * v).sum(axis = -1) / numpy.sqrt((u * u).sum(axis = -1) * (v * v).sum(axis = -1))
+    cos[numpy.isnan(cos)] = -1.0
+    return numpy.arccos(numpy.clip(cos, -1.0, 1.0))
+
+def analyze_planarity(tetrads, outer = None, inner = None):
     ''' Analyze tetrads planarity. An ideal tetrad consists of an outer and
         inner tetragon. Outer tetragon is formed by N9 atoms where the DG
         connects to the backbone and the inner angle is formed by O6 atoms
         which are formed around the metal ion in the center.
         Planarity is represented by a standard deviation between the
-        centers of gravity of the outer and inner tetragon. '''
-    deviation = []
-    for tetrad in tetrads:
-        outer_cog = tetragon_cog([resi['N9'] for resi in tetrad])
-        inner_cog = tetragon_cog([resi['O6'] for resi in tetrad])
-        # @TODO maximum deviaton is probably the best, but need to verify later
-        dist = point_rmsd(outer_cog, inner_cog)
-        deviation.append(dist)
-    return deviation
-
-def analyze_twist(tetrads):
-    ''' Analyze C1' twist angle. '''
-    twist_angles = []
-    visited = []
-    for tetrad in tetrads:
-        # Select first N guanines' C1' atoms
-        level1 = [resi['C1\''].get_vector() for resi in tetrad]
-        level2 = [None, None, None, None]
-        # Find closest tetrad, this is hard to guess as the C1' distance is fairly varied
-        # mean value is around 4-6A, too low produces false negative and too high hopscotchs
-        # a level
-        min_rmsd = 7.0 # Max 7A
-        closest = None
-        visited.append((tetrad, tetrad))
-        for adjacent in tetrads:
-            # Omit visisted pairs
-            if ((tetrad, adjacent) in visited) or ((adjacent, tetrad) in visited):
-                continue
-            # Find closest C1' complete mapping
-            adjacent_level = [None, None, None, None]
-            adjacent_rmsd = []
-            for i in range(0, len(level1)):
-                local_rmsd = 7.0 # Max 7A
-                for resi in adjacent:
-                    # Ignore already mapped atoms
-                    if resi in adjacent_level:
-                        continue
-                    paired = resi['C1\''].get_vector()
-                    rmsd = point_rmsd(level1[i], paired)
-                    if rmsd < local_rmsd:
-                        local_rmsd = rmsd
-                        adjacent_level[i] = paired
-                # Identify incomplete mapping
-                if adjacent_level[i] is None:
-                    # print('pair for',i,'at',local_rmsd)
-                    # print('incomplete mapping of',tetrads.index(adjacent),tetrads.index(tetrad))
-                    break
-                adjacent_rmsd.append(local_rmsd)
-            # Pair closest, completely mapped tetrads
-            if len(adjacent_rmsd) != len(level1):
-                continue
-            # We are guaranteed that it does not exceed local RMSD constraint, try to minimize mean value now
-            adjacent_rmsd_mean = numpy.mean(adjacent_rmsd)
-            if adjacent_rmsd_mean < min_rmsd:
-                min_rmsd = adjacent_rmsd_mean
-                closest = adjacent
-                level2 = adjacent_level
-
-        # Orphan tetrad or an outlier
-        if closest is None:
-            continue
+        centers of gravity of the outer and inner tetragon.
+        Precomputed (... x tetrads x 4 x 3) N9 and O6 coordinates may be passed instead. '''
+    if outer is None:
+        outer = tetrad_coords(tetrads, 'N9')
+    if inner is None:
+        inner = tetrad_coords(tetrads, 'O6')
+    # @TODO maximum deviaton is probably the best, but need to verify later
+    return point_rmsd(tetragon_cog(outer), tetragon_cog(inner))
+
+def level_mapping(c1, rmsd_max = 7.0):
+    ''' Map C1' atoms between all pairs of tetrads in the (... x tetrads x 4 x 3) array.
+        Each C1' atom is mapped to the closest C1' atom of the adjacent tetrad, the mapping
+        is complete if all of them are closer than rmsd_max. An atom may be mapped more than once.
+        Returns (... x tetrads x tetrads) mean RMSD of the mapping (inf if incomplete) and
+        (... x tetrads x tetrads x 4) indices of the mapped atoms. '''
+    dist = point_rmsd(c1[..., :, None, :, None, :], c1[..., None, :, None, :, :])
+    closest = dist.min(axis = -1)
+    rmsd = numpy.where((closest < rmsd_max).all(axis = -1), closest.mean(axis = -1), numpy.inf)
+    return (rmsd, dist.argmin(axis = -1))
 
+def pair_levels(rmsd, rmsd_max = 7.0):
+    ''' Pair tetrads with the closest completely mapped tetrad from the (... x tetrads x tetrads)
+        mean mapping RMSD. Tetrads are paired in order and a pair is never revisited in the opposite
+        direction. Returns (... x tetrads) index of the paired tetrad, or -1 for the orphans. '''
+    shape = rmsd.shape[:-1]
+    count = rmsd.shape[-1]
+    rmsd = rmsd.reshape((-1, count, count)).copy()
+    batch = numpy.arange(rmsd.shape[0])
+    rmsd[:, numpy.arange(count), numpy.arange(count)] = numpy.inf
+    closest = numpy.full(rmsd.shape[:2], -1, dtype = int)
+    for i in range(count):
+        adjacent = rmsd[:, i, :].argmin(axis = -1)
+        paired = rmsd[batch, i, adjacent] < rmsd_max
+        closest[paired, i] = adjacent[paired]
         # Mark closest tetrad pair as visited
-        visited.append((tetrad, closest))
-        # Calculate dihedral twist angle
-        # Since we don't know which level is higher or lower, absolute value of
-        # the angle has to stay within the <0, 60>deg
-        twist = 0.0
-        for side in [(0,1), (1,2), (2,3), (3,0)]:
-            (a, b) = side
-            pair_twist = abs(calc_dihedral(level1[a], level1[b], level2[b], level2[a]))
-            twist += abs(pair_twist)
-        twist /= 4.0
-        twist_angles.append(twist)
-
-    # Return mean twist angle
-    return twist_angles
-
-def closest_guanine(target, guanines, paired_from = 'N7', paired_to = 'N2', rmsd_min = 5.0, same_level = False):
-    ''' Find closest guanine to target form the list. Attempts to find a shortest RMSD between two
-        connected atoms. H21/N7 is closer, but not always present in the structure, so N2/N7 is selected. '''
-    adjacent = None
-    # No remaining guanines
-    if len(guanines) == 0:
-        return None
-    # Find minimal N7 - H21/N2 identifying adjacent DG
-    for resi in guanines:
-        # Ignore guanine residues without N7 - H21/N2 bonds
-        if paired_to not in resi:
-            continue
-        rmsd = target[paired_from] - resi[paired_to]
-        rmsd_o6 = 0.0
-        # Same level guanines have the close inner O6-N1 core
-        if same_level:
-            rmsd_o6 = target['O6'] - resi['N1']
-        # @todo We shouldn't pair to the closest DG which isn't connected to the GQ core
-        # @note Disabled by default, as some GQs have really twisted tetrads (f.e. 1OZ8)
-        if rmsd < rmsd_min and rmsd_o6 < rmsd_min:
-            rmsd_min = rmsd
-            adjacent = resi
-    return adjacent
-
-def sort_tetrads(tetrads):
+        rmsd[batch[paired], adjacent[paired], i] = numpy.inf
+    return closest.reshape(shape)
+
+def analyze_twist(tetrads, c1 = None):
+    ''' Analyze C1' twist angle.
+        Precomputed (... x tetrads x 4 x 3) C1' coordinates may be passed instead of the tetrads,
+        the result is then a (... x tetrads) array of twist angles, NaN for the orphan tetrads. '''
+    batched = c1 is not None
+    if c1 is None:
+        c1 = tetrad_coords(tetrads, 'C1\'')
+    shape = c1.shape[:-2]
+    c1 = c1.reshape((-1,) + c1.shape[-3:])
+    # Find closest tetrad, this is hard to guess as the C1' distance is fairly varied
+    # mean value is around 4-6A, too low produces false negative and too high hopscotchs
+    # a level
+    (rmsd, mapping) = level_mapping(c1, 7.0)
+    closest = pair_levels(rmsd, 7.0)
+    paired = numpy.maximum(closest, 0)
+    # Select the mapped C1' atoms of the closest tetrad
+    batch = numpy.arange(c1.shape[0])[:, None]
+    level2 = c1[batch[..., None], paired[..., None], mapping[batch, numpy.arange(c1.shape[1]), paired]]
+    # Calculate dihedral twist angle
+    # Since we don't know which level is higher or lower, absolute value of
+    # the angle has to stay within the <0, 60>deg
+    (a, b) = SIDES
+    twist = dihedral(c1[..., a, :], c1[..., b, :], level2[..., b, :], level2[..., a, :]).sum(axis = -1) / 4.0
+    # Orphan tetrad or an outlier
+    twist[closest < 0] = numpy.nan
+    if batched:
+        return twist.reshape(shape)
+    return twist[closest >= 0]
+
+def guanine_index(guanines, atoms = ('N7', 'N2', 'O6', 'N1', 'C1\'')):
+    ''' Build a KD-tree neighbour index over guanine core atoms, once per model.
+        Each atom type maps to a neighbour search and an atom to guanine position map. '''
+    index = {}
+    for name in atoms:
+        atom_list = []
+        owners = {}
+        for (pos, resi) in enumerate(guanines):
+            if name in resi:
+                atom_list.append(resi[name])
+                owners[id(resi[name])] = pos
+        if len(atom_list) > 0:
+            index[name] = (NeighborSearch(atom_list), owners)
+    return index
+
+def nearby_guanines(index, center, name, radius):
+    ''' Return positions of guanines with given atom within radius from the center atom.
+        The radius is padded, exact distances are left to the caller. '''
+    if name not in index:
+        return []
+    (search, owners) = index[name]
+    return [owners[id(atom)] for atom in search.search(center.get_coord(), radius + INDEX_SLACK)]
+
+class HoogsteenGraph:
+    ''' Contact graph of the guanines in a model, shared by all the stages. Nodes are guanine positions
+        in the list, edges are the N7-N2 Hoogsteen bonds (from the N7 to the N2 of the other guanine)
+        and the C1' stacking contacts. Edges of each node are (distance, position) sorted by the distance,
+        they are looked up in the index once when the node is first visited. '''
+
+    def __init__(self, guanines, index = None):
+        if index is None:
+            index = guanine_index(guanines, ('N2', 'C1\''))
+        self.guanines = guanines
+        self.index = index
+        self.edges = {}
+        self.queries = 0
+
+    def contacts(self, pos, paired_from, paired_to, radius):
+        ''' Return edges of the node between the atoms closer than radius, the distance is from the atom of the node. '''
+        key = (pos, paired_from, paired_to, radius)
+        if key not in self.edges:
+            adjacent = []
+            if paired_from in self.guanines[pos]:
+                center = self.guanines[pos][paired_from]
+                for other in nearby_guanines(self.index, center, paired_to, radius):
+                    rmsd = center - self.guanines[other][paired_to]
+                    if rmsd < radius:
+                        adjacent.append((rmsd, other))
+            adjacent.sort()
+            self.edges[key] = adjacent
+        return self.edges[key]
+
+    def hoogsteen(self, pos):
+        ''' Return N7-N2 Hoogsteen bonds of the guanine. H21/N7 is closer, but not always present in the structure. '''
+        return self.contacts(pos, 'N7', 'N2', HOOGSTEEN_MAX)
+
+    def stacking(self, pos):
+        ''' Return C1' stacking contacts of the guanine. '''
+        return self.contacts(pos, 'C1\'', 'C1\'', STACKING_MAX)
+
+    def closest(self, edges, contains, order):
+        ''' Return the closest node from the edges for which contains() holds, or None.
+            Equally distant nodes resolve by the order() key, so ties resolve the same way as in the linear scan. '''
+        self.queries += 1
+        best = None
+        for (rmsd, pos) in edges:
+            if best is not None and rmsd > best[0]:
+                break
+            if contains(pos) and (best is None or order(pos) < order(best[1])):
+                best = (rmsd, pos)
+        if best is None:
+            return None
+        return best[1]
+
+    def record(self, trace, paired_from, paired_to, radius, target, contains, order, closest):
+        ''' Record the decision in the trace list, so it can be replayed on other models. Only the candidates
+            within the radius padded by the REPLAY_SLACK are kept, in the order of the tie-breaks. '''
+        edges = self.contacts(target, paired_from, paired_to, radius + 2 * REPLAY_SLACK)
+        pool = sorted([pos for (rmsd, pos) in edges if contains(pos)], key = order)
+        trace.append((paired_from, paired_to, radius, target, pool, closest))
+
+    def bond(self, target, contains, order, trace = None):
+        ''' Return guanine with the N2 closest to the N7 of the target, for which contains() holds.
+            The decision may be recorded in the trace list. '''
+        adjacent = self.closest(self.hoogsteen(target), contains, order)
+        if trace is not None:
+            self.record(trace, 'N7', 'N2', HOOGSTEEN_MAX, target, contains, order, adjacent)
+        return adjacent
+
+def stack_tetrads(graph, tetrads, trace = None):
     ''' We don't know how the tetrads stack yet, but we know the first tetrad is eith top or bottom.
-        With that we find the next closest tetrad and align it so the first DG in the tetrad is the next
-        one attached to the same P backbone. '''
-    unsorted = tetrads[1:]
-    stack = [tetrads[0]]
+        With that we follow the stacking path to the next closest tetrad and align it so the first DG in the tetrad
+        is the next one attached to the same P backbone. If the stack can't grow further, it's grown from the
+        other end, and the leftover tetrads start a new stack (disconnected GQ levels like in 3CDM).
+        Tetrads are lists of guanine positions, returns a list of stacks. '''
+    # Tetrad of each guanine and the order in the concatenated tetrads
+    owner = {}
+    rank = {}
+    for (i, tetrad) in enumerate(tetrads):
+        for (k, pos) in enumerate(tetrad):
+            owner[pos] = i
+            rank[pos] = (i, k)
+    unsorted = set(range(1, len(tetrads)))
+    contains = lambda pos: owner.get(pos) in unsorted
+    stacks = [[tetrads[0]]]
+    reverse = False
     while len(unsorted) > 0:
+        stack = stacks[-1]
         # Align to first element of the last sorted level
-        lead = stack[-1][0]
-        guanines = reduce(lambda t1, t2: t1 + t2, unsorted)
-        closest = closest_guanine(lead, guanines, "C1'", "C1'", rmsd_min = 15.0, same_level = False)
-        # Identify originating level and align
-        for tetrad in unsorted:
-            if closest in tetrad:
-                offset = tetrad.index(closest)
-                # Rotate tetrad so the closest DG is first
-                unsorted.remove(tetrad)
-                stack.append(tetrad[offset:] + tetrad[:offset])
-                break
-        # Odd, couldn't find a closest guanine pair
+        lead = stack[0][0] if reverse else stack[-1][0]
+        closest = graph.closest(graph.stacking(lead), contains, rank.get)
+        if trace is not None:
+            graph.record(trace, 'C1\'', 'C1\'', STACKING_MAX, lead, contains, rank.get, closest)
+        # No stacked tetrad, continue on the other end or start a new stack
         if closest is None:
-            # This can happen for disconnected GQ levels like in 3CDM
-            # @todo We can't solve two interconnected GQs here, return the partial result
-            break
-    return stack
+            if not reverse:
+                reverse = True
+            else:
+                # Single tetrad doesn't form a GQ on its own
+                if len(stack) < 2 and len(stacks) > 1:
+                    stacks.pop()
+                first = min(unsorted)
+                unsorted.remove(first)
+                stacks.append([tetrads[first]])
+                reverse = False
+            continue
+        # Rotate tetrad so the closest DG is first
+        tetrad = tetrads[owner[closest]]
+        offset = tetrad.index(closest)
+        unsorted.remove(owner[closest])
+        if reverse:
+            stack.insert(0, tetrad[offset:] + tetrad[:offset])
+        else:
+            stack.append(tetrad[offset:] + tetrad[:offset])
+    if len(stacks[-1]) < 2 and len(stacks) > 1:
+        stacks.pop()
+    return stacks
+
+def group_stacks(guanines, graph = None, trace = None, stats = None):
+    ''' Identify guanine tetrads as closed 4-cycles in the graph of N7-H21/N2 Hoogsteen bonds,
+        following the shortest bond from each guanine, and stack them into adjacent floors.
+        The pairing decisions are recorded in the trace list if passed.
+        Returns a list of stacks, each stack is a list of tetrads (lists of guanines). '''
+    if stats is None:
+        stats = Stats()
+    with stats.timer('group'):
+        (graph, tetrads) = pair_tetrads(guanines, graph, trace)
+    # Sort tetrads into adjacent floors
+    with stats.timer('stack'):
+        stacks = [tetrads]
+        if len(tetrads) >= 2:
+            stacks = stack_tetrads(graph, tetrads, trace)
+    stats.count('queries', graph.queries)
+    stats.count('tetrads', len(tetrads))
+    stats.count('stacks', len(stacks))
+    return [[[guanines[pos] for pos in tetrad] for tetrad in stack] for stack in stacks]
+
+class PairingOrder:
+    ''' Guanines waiting in pair_tetrads() in the order of a list, to which the visited guanines are appended
+        and the others of an incomplete tetrad inserted before the last len(visited) guanines. The list is kept
+        as the front and the tail (the last len(visited) guanines) deques and the order key of each guanine,
+        the entries of the guanines removed or moved since are skipped. '''
+
+    def __init__(self, positions):
+        self.front = collections.deque()
+        self.tail = collections.deque()
+        self.key = {}
+        self.in_tail = {}
+        self.free = set([])
+        self.visited = 0
+        self.tail_count = 0
+        # Keys are (0, n) in the front and (1, n) in the tail, the guanines moved to the head of the tail get -n
+        self.sequence = itertools.count()
+        self.moved = itertools.count(1)
+        for pos in positions:
+            self.append(pos, False)
+
+    def __len__(self):
+        return len(self.free)
+
+    def __contains__(self, pos):
+        return pos in self.free
+
+    def append(self, pos, tail):
+        self.key[pos] = (int(tail), next(self.sequence))
+        self.in_tail[pos] = tail
+        (self.tail if tail else self.front).append((self.key[pos], pos))
+        self.free.add(pos)
+        if tail:
+            self.tail_count += 1
+
+    def live(self, entry):
+        (key, pos) = entry
+        return pos in self.free and self.key[pos] == key
+
+    def items(self):
+        ''' Return the guanines in order. '''
+        return [pos for (key, pos) in list(self.front) + list(self.tail) if self.live((key, pos))]
+
+    def pop(self):
+        ''' Remove and return the first guanine. '''
+        for queue in (self.front, self.tail):
+            while len(queue) > 0:
+                entry = queue.popleft()
+                if self.live(entry):
+                    self.remove(entry[1])
+                    return entry[1]
+        return None
+
+    def remove(self, pos):
+        ''' Remove the guanine, the tail takes the last guanine of the front if it's shorter than len(visited). '''
+        self.free.discard(pos)
+        if not self.in_tail[pos]:
+            return
+        self.tail_count -= 1
+        while self.tail_count < self.visited and len(self.front) > 0:
+            entry = self.front.pop()
+            if self.live(entry):
+                moved = entry[1]
+                self.key[moved] = (1, -next(self.moved))
+                self.in_tail[moved] = True
+                self.tail.appendleft((self.key[moved], moved))
+                self.tail_count += 1
+
+    def requeue(self, positions, first):
+        ''' Insert the guanines at len(guanines) - len(visited) in turn (same as list.insert()), then append the first
+            guanine as visited. '''
+        split = len(self.free) - self.visited
+        if split >= 0:
+            for pos in reversed(positions):
+                self.append(pos, False)
+        else:
+            # Fewer guanines than the visited ones, the list is rebuilt
+            order = self.items()
+            for pos in positions:
+                order.insert(split, pos)
+            (self.front, self.tail, self.free, self.tail_count) = (collections.deque(), collections.deque(), set([]), 0)
+            cut = max(len(order) - self.visited, 0)
+            for (i, pos) in enumerate(order):
+                self.append(pos, i >= cut)
+        self.visited += 1
+        self.append(first, True)
 
-def group_tetrads(guanines):
-    ''' Identify guanine tetrads by N7-H21/N2 shortest RMSD distances. '''
+def pair_tetrads(guanines, graph = None, trace = None):
+    ''' Find the closed 4-cycles of Hoogsteen bonds, returns the graph and tetrads of guanine positions. '''
     tetrads = []
     visited = set([])
+    if graph is None:
+        graph = HoogsteenGraph(guanines)
+    remaining = PairingOrder(range(len(guanines)))
 
-    while len(guanines) != 0:
-        tetrad = [guanines.pop(0)]
+    while len(remaining) != 0:
+        tetrad = [remaining.pop()]
         if tetrad[0] in visited:
             break
         while len(tetrad) != 4:
-            adjacent = closest_guanine(tetrad[-1], guanines)
+            adjacent = graph.bond(tetrad[-1], remaining.__contains__, remaining.key.get, trace)
             # No N2 in range, discard incomplete tetrad
             if adjacent is None:
                 break
             # Append adjacent DG to tetrad list
             tetrad.append(adjacent)
-            guanines.remove(adjacent)
-        # Check if tetrad forms a closed loop
-        pin = closest_guanine(tetrad[-1], tetrad[0:3] + guanines)
+            remaining.remove(adjacent)
+        # Check if tetrad forms a closed loop, the head goes first
+        head = tetrad[0:3]
+        order = lambda pos: (-1, head.index(pos)) if pos in head else remaining.key[pos]
+        pin = graph.bond(tetrad[-1], lambda pos: pos in remaining or pos in head, order, trace)
         # Form complete interconnected tetrad
         if len(tetrad) == 4 and pin == tetrad[0]:
             tetrads.append(tetrad)
         else:
             # Reinsert other guanines before visited guanines
-            split = len(guanines) - len(visited)
-            for resi in tetrad[1:]:
-                guanines.insert(split, resi)
             # Mark guanine as visited and append, so we know
             # when to stop trying to match them
-            guanines.append(tetrad[0])
+            remaining.requeue(tetrad[1:], tetrad[0])
             visited.add(tetrad[0])
 
-    # Not enough tetrads identified
-    if len(tetrads) < 2:
-        return tetrads
+    return (graph, tetrads)
 
-    # Sort tetrads into adjacent floors
-    return sort_tetrads(tetrads)
+def group_tetrads(guanines, graph = None, trace = None):
+    ''' Identify guanine tetrads, the stacks are concatenated. '''
+    return reduce(lambda s1, s2: s1 + s2, group_stacks(guanines, graph, trace))
 
-def tetrad_pos(target, tetrads):
-    ''' Identify DG molecule position in tetrad stack. '''
-    for i in range(0, len(tetrads)):
-        for k in range(0, len(tetrads[i])):
-            if tetrads[i][k] is target:
-                return (i, k)
-    return None
+def tetrad_layout(stacks):
+    ''' Map guanines to their (stack, level, strand) position in the tetrad stacks. '''
+    layout = {}
+    for (i, stack) in enumerate(stacks):
+        for (level, tetrad) in enumerate(stack):
+            for (strand, resi) in enumerate(tetrad):
+                layout[id(resi)] = (i, level, strand)
+    return layout
 
-def loop_type(entry, closure, tetrads):
+def loop_type(entry, closure, layout):
     ''' Analyze loop type. '''
-    entry_pos = tetrad_pos(entry, tetrads)
-    closure_pos = tetrad_pos(closure, tetrads)
-    level_dist = abs(entry_pos[0] - closure_pos[0])
-    strand_dist = abs(entry_pos[1] - closure_pos[1])
+    entry_pos = layout[id(entry)]
+    closure_pos = layout[id(closure)]
+    # Loop connects two separate stacks
+    if entry_pos[0] != closure_pos[0]:
+        return 'X'
+    level_dist = abs(entry_pos[1] - closure_pos[1])
+    strand_dist = abs(entry_pos[2] - closure_pos[2])
     # Loop connects G on the same level.
     if level_dist == 0:
         # Loop connects edge-wise to the neighbouring strand
@@ -238,9 +498,9 @@ def loop_type(entry, closure, tetrads):
     # Unidentified loop type
     return 'X'
 
-def analyze_loops(tetrads, strands):
+def analyze_loops(stacks, strands):
     ''' Analyze backbone direction. '''
-    core = reduce(lambda t1, t2: t1 + t2, tetrads)
+    layout = tetrad_layout(stacks)
     loop_list = []
     topology = []
 
@@ -251,8 +511,8 @@ def analyze_loops(tetrads, strands):
         for resi in strand:
             if loop_entry is not None:
                 # Find loop closure
-                if resi in core:
-                    topology.append(loop_type(loop_entry, resi, tetrads))
+                if id(resi) in layout:
+                    topology.append(loop_type(loop_entry, resi, layout))
                     loop_list.append(''.join([resi_name(r) for r in loop]))
                     loop_entry = None
                     loop = [resi]
@@ -264,7 +524,7 @@ def analyze_loops(tetrads, strands):
             else:
                 # If next residue is not part of the DG core, start loop with the last
                 # identified core DG on the strand
-                if resi not in core:
+                if id(resi) not in layout:
                     # Cutoff leading nucleotides
                     if len(loop) == 0:
                         continue
@@ -281,11 +541,10 @@ def analyze_loops(tetrads, strands):
 
     return (''.join(topology), '|'.join(loop_list))
 
-def analyze(model, output = None):
-    ''' Assemble guanine tetrads and analyze properties. '''
+def model_guanines(model):
+    ''' Collect guanines and nucleotide strands of the model chains, chains without DG are ignored. '''
     guanines = []
     strands = []
-    chain_count = 0
     for chain in model:
         strand = []
         chain_dg = []
@@ -301,36 +560,191 @@ def analyze(model, output = None):
                     strand.append(residue)
         # Ignore chains without DG
         if len(chain_dg) > 0:
-            chain_count += 1
             guanines += chain_dg
             strands.append(strand)
+    return (guanines, strands)
+
+def analyze(model, output = None, stats = None):
+    ''' Assemble guanine tetrads and analyze properties.
+        Stage times and counters are recorded in the stats if passed. '''
+    if stats is None:
+        stats = Stats()
+    with stats.timer('scan'):
+        (guanines, strands) = model_guanines(model)
+    stats.count('guanines', len(guanines))
     # Must have at least 8 guanines to form a tetrad
     if len(guanines) < 8:
         sys.stderr.write(' [!!] less than 8 DGs found, ignoring\n')
         return None
     # Group tetrads from guanine list
-    print(' * scanning model %s, %d DGs' % (model.__repr__(), len(guanines)))
-    tetrads = group_tetrads(guanines)
-    print('  - assembly: %d tetrads' % len(tetrads))
+    log(' * scanning model %s, %d DGs' % (model.__repr__(), len(guanines)))
+    stacks = group_stacks(guanines, stats = stats)
+    return analyze_tetrads(stacks, strands, stats = stats)
+
+def analyze_tetrads(stacks, strands, planarity = None, twist_angles = None, loops = None, stats = None):
+    ''' Analyze properties of assembled tetrad stacks.
+        Planarity, twist angles and loops may be precomputed (f.e. for a whole ensemble). '''
+    tetrads = reduce(lambda s1, s2: s1 + s2, stacks)
+    if len(stacks) > 1:
+        log('  - assembly: %d tetrads in %d stacks' % (len(tetrads), len(stacks)))
+    else:
+        log('  - assembly: %d tetrads' % len(tetrads))
     if len(tetrads) < 2:
         sys.stderr.write(' [!!] at least 2 tetrads are required\n')
         return None
-    planarity = analyze_planarity(tetrads)
+    if stats is None:
+        stats = Stats()
+    if planarity is None:
+        with stats.timer('planarity'):
+            planarity = analyze_planarity(tetrads)
     planarity_mean = numpy.mean(planarity)
     planarity_std = numpy.std(planarity)
-    print('  - mean planarity: %.02f A, stddev %.02f A' % (planarity_mean, planarity_std))
-    twist_angles = analyze_twist(tetrads)
+    log('  - mean planarity: %.02f A, stddev %.02f A' % (planarity_mean, planarity_std))
+    if twist_angles is None:
+        with stats.timer('twist'):
+            twist_angles = analyze_twist(tetrads)
     if len(twist_angles) == 0:
         sys.stderr.write(' [!!] can\'t calculate twist angles\n')
         return None
     twist = numpy.mean(twist_angles)
     twist_dev = numpy.std(twist_angles)
-    print('  - twist angle: %.02f rad (%.02f deg), stddev %.02f rad' % (twist, math.degrees(twist), twist_dev))
+    log('  - twist angle: %.02f rad (%.02f deg), stddev %.02f rad' % (twist, math.degrees(twist), twist_dev))
 
     # Calculate consensus loop
+    chain_count = len(strands)
     consensus = ''.join([resi_name(resi) for resi in strands[0]])
-    print('  - chains: %d, consensus: %s' % (chain_count, consensus))
-    (topology, loops) = analyze_loops(tetrads, strands)
-    print('  - topology: %s, fragments: %s' % (topology, loops))
+    log('  - chains: %d, consensus: %s' % (chain_count, consensus))
+    if loops is None:
+        with stats.timer('loops'):
+            loops = analyze_loops(stacks, strands)
+    (topology, loops) = loops
+    log('  - topology: %s, fragments: %s' % (topology, loops))
 
     return [planarity_mean, planarity_std, math.degrees(twist), math.degrees(twist_dev), chain_count, topology, loops]
+
+# Atoms gathered for the ensemble analysis, pairing (N7, N2, C1') and geometry (N9, O6, C1')
+ENSEMBLE_ATOMS = ('N7', 'N2', 'C1\'', 'N9', 'O6')
+
+def ensemble_key(guanines, strands):
+    ''' Models with the same key have the same guanines (incl. atoms) and strands in the same order. '''
+    resi_key = lambda resi: (resi.get_parent().get_id(), resi.get_id(), resi.get_resname())
+    return (tuple([resi_key(resi) + tuple([name in resi for name in ENSEMBLE_ATOMS]) for resi in guanines]),
+            tuple([tuple([resi_key(resi) for resi in strand]) for strand in strands]))
+
+def guanine_coords(guanines, atoms = ENSEMBLE_ATOMS):
+    ''' Return dense (guanines x atoms x 3) array of atom coordinates, NaN for the missing atoms. '''
+    coords = numpy.full((len(guanines), len(atoms), 3), numpy.nan, dtype = 'f')
+    for (pos, resi) in enumerate(guanines):
+        for (i, name) in enumerate(atoms):
+            if name in resi:
+                coords[pos, i] = resi[name].get_coord()
+    return coords
+
+def replay_trace(trace, coords, atoms = ENSEMBLE_ATOMS):
+    ''' Replay pairing decisions recorded by group_stacks() on (models x guanines x atoms x 3) coordinates.
+        Returns boolean array of models, for which all the decisions resolve to the recorded guanine. '''
+    # Decisions hold only the candidates near the recorded ones, so the models moved further are regrouped
+    used = [atoms.index(name) for name in set([decision[0] for decision in trace] + [decision[1] for decision in trace])]
+    shift = point_rmsd(coords[:, :, used], coords[:1, :, used])
+    shift[numpy.isnan(shift)] = 0.0
+    valid = (shift <= REPLAY_SLACK).reshape(coords.shape[0], -1).all(axis = -1)
+    for key in sorted(set([decision[0:3] for decision in trace])):
+        (paired_from, paired_to, radius) = key
+        decisions = [decision for decision in trace if decision[0:3] == key]
+        width = max([1] + [len(decision[4]) for decision in decisions])
+        # Pad the candidate pools to a dense (decisions x width) array
+        pools = numpy.zeros((len(decisions), width), dtype = int)
+        padding = numpy.ones(pools.shape, dtype = bool)
+        for (i, decision) in enumerate(decisions):
+            pools[i, :len(decision[4])] = decision[4]
+            padding[i, :len(decision[4])] = False
+        targets = numpy.array([decision[3] for decision in decisions])
+        expected = numpy.array([-1 if decision[5] is None else decision[5] for decision in decisions])
+        center = coords[:, targets, atoms.index(paired_from)]
+        dist = point_rmsd(center[:, :, None, :], coords[:, pools, atoms.index(paired_to)])
+        # Missing atoms, padding and candidates out of range are never closest
+        dist[numpy.isnan(dist)] = numpy.inf
+        dist[:, padding] = numpy.inf
+        # First closest candidate in the pool order, same as the linear scan
+        closest = dist.argmin(axis = -1)
+        found = dist.min(axis = -1) < radius
+        paired = numpy.where(found, pools[numpy.arange(len(decisions)), closest], -1)
+        valid &= (paired == expected).all(axis = -1)
+    return valid
+
+def analyze_ensemble(models, stats = None):
+    ''' Assemble guanine tetrads and analyze properties of all models in an ensemble (f.e. NMR structure).
+        Tetrads are grouped once for the first model with given guanines, other models with the same
+        guanines are checked by replaying its pairing decisions on their coordinates in a single batch.
+        Models that don't resolve the same way are grouped separately.
+        Stage times and counters of the whole ensemble are recorded in the stats if passed.
+        Returns a list of per-model results, same as analyze(). '''
+    if stats is None:
+        stats = Stats()
+    models = list(models)
+    with stats.timer('scan'):
+        entries = [model_guanines(model) for model in models]
+    stats.count('guanines', sum([len(guanines) for (guanines, strands) in entries]))
+    stacks = [None] * len(models)
+    metrics = [None] * len(models)
+    pending = [i for i in range(len(models)) if len(entries[i][0]) >= 8]
+    while len(pending) > 0:
+        (guanines, strands) = entries[pending[0]]
+        trace = []
+        reference = group_stacks(guanines, trace = trace, stats = stats)
+        # Positions of the reference tetrads in the guanine list
+        positions = dict([(id(resi), pos) for (pos, resi) in enumerate(guanines)])
+        positions = [[[positions[id(resi)] for resi in tetrad] for tetrad in stack] for stack in reference]
+        key = ensemble_key(guanines, strands)
+        members = [pending[0]] + [i for i in pending[1:] if ensemble_key(*entries[i]) == key]
+        pending = [i for i in pending if i not in members]
+        with stats.timer('replay'):
+            coords = numpy.array([guanine_coords(entries[i][0]) for i in members])
+            valid = replay_trace(trace, coords)
+            valid[0] = True
+        for (i, ok) in zip(members, valid):
+            if ok:
+                stacks[i] = [[[entries[i][0][pos] for pos in tetrad] for tetrad in stack] for stack in positions]
+            else:
+                stacks[i] = group_stacks(entries[i][0], stats = stats)
+        positions = reduce(lambda s1, s2: s1 + s2, positions)
+        if len(positions) < 2:
+            continue
+        # Batch planarity and twist over the verified members, loops are the same for each of them
+        core = coords[valid][:, positions].astype('d')
+        with stats.timer('planarity'):
+            planarity = analyze_planarity(None, core[..., ENSEMBLE_ATOMS.index('N9'), :], core[..., ENSEMBLE_ATOMS.index('O6'), :])
+        with stats.timer('twist'):
+            twist = analyze_twist(None, core[..., ENSEMBLE_ATOMS.index('C1\''), :])
+        with stats.timer('loops'):
+            loops = analyze_loops(reference, strands)
+        for (k, i) in enumerate([i for (i, ok) in zip(members, valid) if ok]):
+            metrics[i] = (planarity[k], twist[k][~numpy.isnan(twist[k])], loops)
+
+    # Report models in order
+    results = []
+    for (i, model) in enumerate(models):
+        (guanines, strands) = entries[i]
+        if len(guanines) < 8:
+            sys.stderr.write(' [!!] less than 8 DGs found, ignoring\n')
+            results.append(None)
+            continue
+        log(' * scanning model %s, %d DGs' % (model.__repr__(), len(guanines)))
+        if metrics[i] is None:
+            results.append(analyze_tetrads(stacks[i], strands, stats = stats))
+        else:
+            results.append(analyze_tetrads(stacks[i], strands, *metrics[i]))
+    return results
+
+def summarize_ensemble(results):
+    ''' Summarize per-model results of an ensemble, metrics are averaged over the models and the spread
+        is the standard deviation between them. Topology and loops are the most common among the models.
+        Returns [models, planarity, planarity spread, twist, twist spread, topology, loops] or None. '''
+    results = [result for result in results if result is not None]
+    if len(results) == 0:
+        return None
+    planarity = [result[0] for result in results]
+    twist = [result[2] for result in results]
+    shapes = [(result[5], result[6]) for result in results]
+    (topology, loops) = max(shapes, key = shapes.count)
+    return [len(results), numpy.mean(planarity), numpy.std(planarity), numpy.mean(twist), numpy.std(twist), topology, loops]
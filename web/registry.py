@@ -0,0 +1,156 @@
+import os, copy, time, pickle, sqlite3, threading
+import runnable, resultdb
+
+''' Registry of the searches and their tasks shared by the web processes. The searches and tasks
+    are kept in an SQLite database indexed by their uuid, the tasks are pickled without the results,
+    which are loaded from the result store on demand. Volatile searches expire after a time to live. '''
+
+REGISTRY_DB = os.path.join(runnable.RESULT_PATH, 'registry.db')
+# Interval [s] of the task version checks while waiting for an update
+POLL_INTERVAL = 0.25
+
+class Registry:
+    ''' Search and task registry, each thread uses its own connection. '''
+
+    def __init__(self, results, path = REGISTRY_DB):
+        self.results = results
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout = 30.0)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS searches (uid TEXT PRIMARY KEY, persistent INTEGER, updated REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY AUTOINCREMENT, uid TEXT UNIQUE, '
+                       'search TEXT, state TEXT, version INTEGER, task BLOB)')
+            db.execute('CREATE INDEX IF NOT EXISTS tasks_search ON tasks (search)')
+            db.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)')
+            self.local.db = db
+        return db
+
+    def dump_task(self, task):
+        ''' Pickle the task without the results and the open output. '''
+        task = copy.copy(task)
+        task.__dict__.pop('result', None)
+        task.__dict__.pop('out', None)
+        return sqlite3.Binary(pickle.dumps(task, pickle.HIGHEST_PROTOCOL))
+
+    def load_task(self, data):
+        ''' Unpickle the task, its results are loaded from the result store on demand. '''
+        task = pickle.loads(str(data))
+        task.result = resultdb.ResultRows(self.results, task.uid)
+        return task
+
+    def add_search(self, uid, persistent = False):
+        ''' Add a new search. '''
+        db = self.connect()
+        with db:
+            db.execute('INSERT INTO searches VALUES (?, ?, ?)', (uid, int(persistent), time.time()))
+
+    def has_search(self, uid):
+        ''' Return True if the search exists. '''
+        return self.connect().execute('SELECT 1 FROM searches WHERE uid = ?', (uid,)).fetchone() is not None
+
+    def search(self, uid):
+        ''' Return the search with its tasks (the newest first), or None if it doesn't exist. '''
+        db = self.connect()
+        row = db.execute('SELECT persistent FROM searches WHERE uid = ?', (uid,)).fetchone()
+        if row is None:
+            return None
+        search = runnable.Search(uid)
+        search.persistent = bool(row[0])
+        search.task_list = [self.load_task(data) for (data,) in
+                            db.execute('SELECT task FROM tasks WHERE search = ? ORDER BY id DESC', (uid,))]
+        return search
+
+    def searches(self, persistent = True):
+        ''' Return the saved or volatile searches. '''
+        uids = self.connect().execute('SELECT uid FROM searches WHERE persistent = ?', (int(persistent),)).fetchall()
+        return [search for search in [self.search(uid) for (uid,) in uids] if search is not None]
+
+    def touch(self, uid):
+        ''' Mark the search as used now, so it doesn't expire. '''
+        db = self.connect()
+        with db:
+            db.execute('UPDATE searches SET updated = ? WHERE uid = ?', (time.time(), uid))
+
+    def set_persistent(self, uid, persistent = True):
+        ''' Save the search, or make it volatile again. '''
+        db = self.connect()
+        with db:
+            db.execute('UPDATE searches SET persistent = ?, updated = ? WHERE uid = ?', (int(persistent), time.time(), uid))
+
+    def remove_search(self, uid):
+        ''' Remove the search, returns its removed tasks. '''
+        db = self.connect()
+        with db:
+            tasks = [self.load_task(data) for (data,) in db.execute('SELECT task FROM tasks WHERE search = ?', (uid,))]
+            db.execute('DELETE FROM tasks WHERE search = ?', (uid,))
+            db.execute('DELETE FROM searches WHERE uid = ?', (uid,))
+        return tasks
+
+    def expire(self, ttl):
+        ''' Remove volatile searches not used for the ttl [s], returns their removed tasks. '''
+        uids = self.connect().execute('SELECT uid FROM searches WHERE persistent = 0 AND updated < ?',
+                                      (time.time() - ttl,)).fetchall()
+        tasks = []
+        for (uid,) in uids:
+            tasks += self.remove_search(uid)
+        return tasks
+
+    def add_task(self, search, task):
+        ''' Add the task to the search. '''
+        db = self.connect()
+        with db:
+            db.execute('INSERT INTO tasks (uid, search, state, version, task) VALUES (?, ?, ?, ?, ?)',
+                       (task.uid, search, task.state, task.version, self.dump_task(task)))
+            db.execute('UPDATE searches SET updated = ? WHERE uid = ?', (time.time(), search))
+
+    def save_task(self, task):
+        ''' Save the updated task. '''
+        db = self.connect()
+        with db:
+            db.execute('UPDATE tasks SET state = ?, version = ?, task = ? WHERE uid = ?',
+                       (task.state, task.version, self.dump_task(task), task.uid))
+
+    def task(self, uid):
+        ''' Return the task, or None if it doesn't exist. '''
+        row = self.connect().execute('SELECT task FROM tasks WHERE uid = ?', (uid,)).fetchone()
+        if row is None:
+            return None
+        return self.load_task(row[0])
+
+    def tasks(self, *states):
+        ''' Return the tasks in any of the states. '''
+        query = 'SELECT task FROM tasks WHERE state IN (%s) ORDER BY id' % ', '.join(['?'] * len(states))
+        return [self.load_task(data) for (data,) in self.connect().execute(query, states)]
+
+    def remove_task(self, uid):
+        ''' Remove the task, the search is removed with its last task. Returns the removed task or None. '''
+        task = self.task(uid)
+        if task is None:
+            return None
+        db = self.connect()
+        with db:
+            search = db.execute('SELECT search FROM tasks WHERE uid = ?', (uid,)).fetchone()[0]
+            db.execute('DELETE FROM tasks WHERE uid = ?', (uid,))
+            if db.execute('SELECT 1 FROM tasks WHERE search = ?', (search,)).fetchone() is None:
+                db.execute('DELETE FROM searches WHERE uid = ?', (search,))
+        return task
+
+    def version(self, uid):
+        ''' Return the task version, or None if it doesn't exist. '''
+        row = self.connect().execute('SELECT version FROM tasks WHERE uid = ?', (uid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def wait(self, uid, version, timeout):
+        ''' Wait until the task is updated past the version, returns its current version.
+            The task may be updated by another process, so its version is polled. '''
+        deadline = time.time() + timeout
+        current = self.version(uid)
+        while current == version and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            current = self.version(uid)
+        return current
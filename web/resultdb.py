@@ -0,0 +1,154 @@
+import os, re, sqlite3, threading
+import runnable
+
+''' On-disk store of the task results. The rows of each task are kept in an SQLite table
+    with an index on each column, so a sorted and filtered page is read without loading
+    the whole result. The row counts are kept separately, so the unfiltered total is known at once. '''
+
+RESULT_DB = os.path.join(runnable.RESULT_PATH, 'results.db')
+# Filter as '<column><op><value>', the '~' operator is a case-insensitive substring match
+FILTER_RE = re.compile(r'^\s*(\w+)\s*(>=|<=|!=|>|<|=|~)\s*(.*?)\s*$')
+
+def table_name(uid):
+    ''' Return table name of the task results, the uuid is validated. '''
+    if not re.match(r'^[0-9a-fA-F-]+$', uid):
+        raise ValueError('invalid task uuid "%s"' % uid)
+    return 'result_' + uid.replace('-', '_')
+
+def parse_filter(text, fields):
+    ''' Parse '<column><op><value>' filter, the column is a field name or index. The value of
+        the comparisons is a number if possible. Returns (column index, op, value). '''
+    match = FILTER_RE.match(text)
+    if match is None:
+        raise ValueError('invalid filter "%s"' % text)
+    (column, op, value) = match.groups()
+    column = column_index(column, fields)
+    if op != '~':
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    return (column, op, value)
+
+def column_index(column, fields):
+    ''' Return index of the column given by a field name or index. '''
+    if isinstance(column, basestring) and not column.isdigit():
+        names = [field.lower().replace(' ', '_') for field in fields]
+        if column.lower() not in names:
+            raise ValueError('unknown column "%s"' % column)
+        return names.index(column.lower())
+    column = int(column)
+    if column < 0 or column >= len(fields):
+        raise ValueError('unknown column "%s"' % column)
+    return column
+
+class ResultDB:
+    ''' Task results store, each thread uses its own connection. '''
+
+    def __init__(self, path = RESULT_DB):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout = 30.0)
+            # Readers don't block the writer of another process
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS results (uid TEXT PRIMARY KEY, columns INTEGER, total INTEGER)')
+            self.local.db = db
+        return db
+
+    def store(self, uid, columns, rows):
+        ''' Store the task result rows, previous results of the task are replaced. '''
+        table = table_name(uid)
+        names = ['c%d' % i for i in range(columns)]
+        db = self.connect()
+        with db:
+            db.execute('DROP TABLE IF EXISTS %s' % table)
+            db.execute('CREATE TABLE %s (%s)' % (table, ', '.join(names)))
+            db.executemany('INSERT INTO %s VALUES (%s)' % (table, ', '.join(['?'] * columns)),
+                           [tuple(row[:columns]) for row in rows])
+            for name in names:
+                db.execute('CREATE INDEX %s_%s ON %s (%s)' % (table, name, table, name))
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (uid, columns, len(rows)))
+
+    def append(self, uid, columns, rows):
+        ''' Append the result rows of the running task, the columns aren't indexed until it's stored. '''
+        table = table_name(uid)
+        names = ['c%d' % i for i in range(columns)]
+        db = self.connect()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, ', '.join(names)))
+            db.executemany('INSERT INTO %s VALUES (%s)' % (table, ', '.join(['?'] * columns)),
+                           [tuple(row[:columns]) for row in rows])
+            total = db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (uid, columns, total))
+
+    def count(self, uid):
+        ''' Return the number of the stored task result rows. '''
+        row = self.connect().execute('SELECT total FROM results WHERE uid = ?', (uid,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def contains(self, uid):
+        ''' Return True if the task results are stored. '''
+        return self.connect().execute('SELECT 1 FROM results WHERE uid = ?', (uid,)).fetchone() is not None
+
+    def remove(self, uid):
+        ''' Remove the task results. '''
+        db = self.connect()
+        with db:
+            db.execute('DROP TABLE IF EXISTS %s' % table_name(uid))
+            db.execute('DELETE FROM results WHERE uid = ?', (uid,))
+
+    def page(self, uid, offset = 0, limit = 50, sort = None, descending = False, filters = (), columns = None):
+        ''' Return (total, rows) of the filtered results and their page. The rows are in the stored
+            order unless sorted by the column, the filters are (column, op, value) tuples. '''
+        table = table_name(uid)
+        db = self.connect()
+        if not self.contains(uid):
+            return (0, [])
+        (where, params) = ([], [])
+        for (column, op, value) in filters:
+            if op == '~':
+                where.append('instr(lower(c%d), lower(?)) > 0' % column)
+            else:
+                where.append('c%d %s ?' % (column, op))
+            params.append(value)
+        where = (' WHERE ' + ' AND '.join(where)) if len(where) > 0 else ''
+        if len(filters) > 0:
+            total = db.execute('SELECT COUNT(*) FROM %s%s' % (table, where), params).fetchone()[0]
+        else:
+            total = self.count(uid)
+        order = ' ORDER BY rowid'
+        if sort is not None:
+            order = ' ORDER BY c%d %s, rowid' % (sort, 'DESC' if descending else 'ASC')
+        select = '*' if columns is None else ', '.join(['c%d' % column for column in columns])
+        query = 'SELECT %s FROM %s%s%s LIMIT ? OFFSET ?' % (select, table, where, order)
+        rows = [list(row) for row in db.execute(query, params + [limit, offset])]
+        return (total, rows)
+
+class ResultRows:
+    ''' Task result rows loaded from the store on demand, the rows are read as lists. '''
+
+    def __init__(self, results, uid):
+        self.results = results
+        self.uid = uid
+
+    def __len__(self):
+        return self.results.count(self.uid)
+
+    def __iter__(self):
+        return iter(self.results.page(self.uid, 0, -1)[1])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(len(self))
+            rows = self.results.page(self.uid, start, max(stop - start, 0))[1]
+            return rows[::step]
+        if index < 0:
+            index += len(self)
+        rows = self.results.page(self.uid, index, 1)[1]
+        if len(rows) == 0:
+            raise IndexError('result row out of range')
+        return rows[0]
@@ -12,6 +12,12 @@ ResultFasta = 'result_fasta'
 ResultScore = 'result_score' 
 ResultGFF   = 'result_gff' 
 
+''' Task states, the tasks run in the job queue are queued first. '''
+TaskQueued  = 'queued'
+TaskRunning = 'running'
+TaskDone    = 'done'
+TaskFailed  = 'failed'
+
 def result_suffix(result_type):
     if result_type == ResultNone:  return ''
     if result_type == ResultFasta: return '.fasta'
@@ -36,6 +42,10 @@ class Runnable:
     data_in = None
     data_out = None
     persistent = False
+    state = TaskDone
+    error = None
+    out = None
+    version = 0
 
     def __init__(self, data_in):
         self.data_in = data_in
@@ -45,7 +55,12 @@ class Runnable:
     def progress(self):
         if self.planned == 0:
             return -1 
-        return self.processed / self.planned
+        return self.processed / float(self.planned)
+
+    def count_records(self):
+        ''' Count FASTA records of the input, so the progress is known while running. '''
+        with open(self.data_in) as fasta_in:
+            return sum([1 for line in fasta_in if line.startswith('>')])
 
     def in_stream(self):
         return open(self.data_in)
@@ -56,12 +71,40 @@ class Runnable:
         if data_out is None:
             out = tempfile.NamedTemporaryFile(delete = False, prefix = 'result', suffix = result_suffix(self.type), dir = RESULT_PATH)
             self.data_out = out.name
-        elif data_out is "-":
+        elif data_out == "-":
             out = sys.stdout
         else:
-            out = open(data_out, 'r')
+            out = open(data_out, 'w')
+        self.out = out
         return out
 
+    def close_streams(self):
+        ''' Flush and close the output, so the results are complete once the task is done. '''
+        if self.out is not None and self.out is not sys.stdout:
+            self.out.close()
+        self.out = None
+
+    def status(self, result = True):
+        ''' Return the attributes reported by the worker running the task, the results are optional. '''
+        status = dict(processed = self.processed, planned = self.planned, data_out = self.data_out)
+        if result:
+            status['result'] = self.result
+        return status
+
+    def update(self, state, status):
+        ''' Update the task state and the attributes reported by the worker, the 'rows' are
+            appended to the results. Each update bumps the task version. '''
+        self.state = state
+        for (key, value) in status.items():
+            if key == 'rows':
+                # Results are shared by the class until the first one is set
+                if 'result' not in self.__dict__:
+                    self.result = []
+                self.result.extend(value)
+            else:
+                setattr(self, key, value)
+        self.version += 1
+
     def pickle(self):
         ''' Pickle the runnable object with the results. '''
         return dict(
@@ -70,6 +113,10 @@ class Runnable:
                 fields    = self.fields,
                 result    = self.result,
                 processed = self.processed,
+                planned   = self.planned,
+                progress  = self.progress(),
+                state     = self.state,
+                error     = self.error,
                 data_in   = self.data_in,
                 data_out  = self.data_out);
 
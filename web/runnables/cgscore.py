@@ -47,7 +47,7 @@ class Runnable(runnable.Runnable):
                 out.write('>%s\n%s\n' % (record.id, str(record.seq)))
 
 	def run(self, data_out = None):
-            self.planned = 0
+            self.planned = self.count_records()
             self.processed = 0
             self.result = []
 
@@ -35,8 +35,8 @@ class Runnable(runnable.Runnable):
 
     def run(self, data_out = None):
         self.result = []
-        self.planned = 0
-        self.procesed = 0
+        self.planned = self.count_records()
+        self.processed = 0
         
         # Open source / destination files
 	fasta_in = self.in_stream()
@@ -6,6 +6,9 @@ import markdown
 import runnable
 from quadclasslib import seqlearn, quadclass
 
+# Number of sequences classified at once
+BATCH_SIZE = seqlearn.BATCH_SIZE
+
 class Runnable(runnable.Runnable):
     ''' Quadclass wrapper for GQ structure prediction. '''
 
@@ -18,17 +21,22 @@ class Runnable(runnable.Runnable):
         self.type = runnable.ResultGFF
         self.fields = ['Accession', 'Sequence', 'Topology']
 
-    def eval_sequence(self, id, seq, out):
-        # Load class list
-        gq_classlist = seqlearn.load_classlist('runnables/quadclasslib/gqclass-mono.tsv')
-        pval_table = seqlearn.calc_pval(gq_classlist)
-        loops = loops = seqlearn.find_fragments(seq.upper())
-        candidates = seqlearn.fit(gq_classlist, loops, pval_table)
-        configurations = []
-        for key in candidates:
-            configurations.append('%s:%s/%s' % (key[1], key[0], ','.join(candidates[key])))
-        self.result.append( (id, seq, ' '.join(configurations)) )
-        out.write('%s %s %s\n' % self.result[-1][0:3])
+    def eval_sequences(self, records, out):
+        # Predictor is loaded once per process and shared by the tasks
+        predictor = seqlearn.load_predictor('runnables/quadclasslib/gqclass-mono.tsv')
+        # Classify the sequences in batches, so the progress and the results are reported while running
+        for start in range(0, len(records), BATCH_SIZE):
+            batch = records[start:start + BATCH_SIZE]
+            fitted = predictor.fit_batch([seq.upper() for (id, seq) in batch])
+            rows = []
+            for ((id, seq), candidates) in zip(batch, fitted):
+                configurations = []
+                for key in candidates:
+                    configurations.append('%s:%s/%s' % (key[1], key[0], ','.join(candidates[key])))
+                rows.append( (id, seq, ' '.join(configurations)) )
+                out.write('%s %s %s\n' % rows[-1])
+            self.result.extend(rows)
+            self.processed += len(batch)
 
     def run(self, data_out = None):
         self.planned = 0
@@ -40,9 +48,9 @@ class Runnable(runnable.Runnable):
         file_in = self.in_stream()
 
         if in_type == runnable.ResultFasta or in_type == runnable.ResultScore:
-            for record in SeqIO.parse(file_in, 'fasta'):
-                self.eval_sequence(record.id, str(record.seq), score_out)
-                self.processed += 1
+            records = [(record.id, str(record.seq)) for record in SeqIO.parse(file_in, 'fasta')]
+            self.planned = len(records)
+            self.eval_sequences(records, score_out)
         if in_type == runnable.ResultGFF:
             pass
 
@@ -1,36 +1,215 @@
-import os, sys, glob
+import os, sys, glob, time, traceback, threading, multiprocessing, Queue
+import runnable
 
 RUNNABLE_PATH = 'runnables'
 sys.path.append(RUNNABLE_PATH)
 
+# Default number of worker processes and the limit of the queued and running tasks
+PROCESSES = 2
+QUEUE_DEPTH = 32
+# Interval [s] of the progress reports from the workers
+PROGRESS_INTERVAL = 0.5
+# Interval [s] of the checks for the tasks lost by the workers
+WORKER_CHECK = 5.0
+
+# Status queue of the worker process
+g_status = None
+
+def init_worker(status):
+    ''' Initialize worker process with the status queue. '''
+    global g_status
+    g_status = status
+
+def run_job(task, output):
+    ''' Run the task in a worker process. The progress and the new result rows are sampled
+        while it's running, the final state and the results are reported once it's done. '''
+    done = threading.Event()
+    def sample():
+        (sent, last) = (0, None)
+        while not done.wait(PROGRESS_INTERVAL):
+            status = task.status(result = False)
+            rows = task.result[sent:]
+            # Unchanged task isn't reported
+            if status == last and len(rows) == 0:
+                continue
+            last = dict(status)
+            status['rows'] = rows
+            sent += len(rows)
+            g_status.put((task.uid, runnable.TaskRunning, status))
+    # Worker is reported, so the task is failed if it dies
+    g_status.put((task.uid, runnable.TaskRunning, dict(worker = os.getpid())))
+    sampler = threading.Thread(target = sample)
+    sampler.daemon = True
+    sampler.start()
+    try:
+        task.run(output)
+        (state, status) = (runnable.TaskDone, task.status())
+    # Failed task is reported, the worker carries on with others
+    except Exception as err:
+        (state, status) = (runnable.TaskFailed, dict(error = str(err)))
+    finally:
+        done.set()
+        sampler.join()
+        task.close_streams()
+    g_status.put((task.uid, state, status))
+
 class Runner:
 
-    tasklist = [] 
+    tasklist = []
     runnable_list = []
 
-    def __init__(self):
+    def __init__(self, processes = PROCESSES, queue_depth = QUEUE_DEPTH, results = None, on_update = None):
+        ''' The result rows reported by the workers are stored in the results (ResultDB) if passed,
+            the on_update(task) is called after each update of the task. '''
         for runnable_id in glob.glob(RUNNABLE_PATH + '/*.py'):
             runnable_id = os.path.basename(runnable_id)[:-3]
             self.runnable_list.append(runnable_id)
+        self.processes = processes
+        self.queue_depth = queue_depth
+        self.results = results
+        self.on_update = on_update
+        self.pool = None
+        self.status = None
+        # Queued and running tasks by uuid, their pool calls and the worker processes running them
+        self.jobs = {}
+        self.calls = {}
+        self.workers = {}
+        self.lock = threading.Lock()
 
     def runnable(self, runnable_id):
         return getattr(__import__(runnable_id), 'Runnable')
 
     def info_list(self):
-        result = {} 
+        result = {}
         for runnable_id in self.runnable_list:
             result[runnable_id] = self.runnable(runnable_id).info()
         return result
 
     def run(self, runnable_id, dataset, params, output = None):
+        ''' Run the task at once, returns None if the runnable doesn't exist. '''
         if not runnable_id in self.runnable_list:
             return None
 
         task = self.runnable(runnable_id)(dataset, params)
         task.run(output)
+        task.close_streams()
         self.tasklist.append(task)
         return task
 
+    def start(self):
+        ''' Start the worker pool and the collector of the task states. '''
+        self.status = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(self.processes, init_worker, (self.status,))
+        collector = threading.Thread(target = self.collect)
+        collector.daemon = True
+        collector.start()
+
+    def collect(self):
+        ''' Apply the task states reported by the workers, the tasks lost by the workers are
+            failed every WORKER_CHECK. An update that can't be applied fails its task. '''
+        checked = time.time()
+        while True:
+            try:
+                (uid, state, status) = self.status.get(timeout = WORKER_CHECK)
+                try:
+                    self.apply(uid, state, status)
+                except Exception as err:
+                    sys.stderr.write(traceback.format_exc())
+                    self.fail(uid, 'update failed: %s' % err)
+            except Queue.Empty:
+                pass
+            if time.time() - checked >= WORKER_CHECK:
+                self.check()
+                checked = time.time()
+
+    def apply(self, uid, state, status):
+        ''' Apply the task state. The new rows are appended to the stored results and the final
+            results replace them, before the update is passed on. '''
+        with self.lock:
+            task = self.jobs.get(uid)
+            if task is None:
+                return
+            if 'worker' in status:
+                self.workers[uid] = status.pop('worker')
+            task.update(state, status)
+            if state in (runnable.TaskDone, runnable.TaskFailed):
+                self.forget(uid)
+        if self.results is not None:
+            if len(status.get('rows', [])) > 0:
+                self.results.append(uid, len(task.fields), status['rows'])
+            if state == runnable.TaskDone:
+                self.results.store(uid, len(task.fields), task.result)
+        if self.on_update is not None:
+            self.on_update(task)
+
+    def forget(self, uid):
+        ''' Remove the finished task from the jobs, the lock must be held. '''
+        self.calls.pop(uid, None)
+        self.workers.pop(uid, None)
+        return self.jobs.pop(uid, None)
+
+    def fail(self, uid, error):
+        ''' Fail the task and pass the update on, the error is logged. '''
+        sys.stderr.write('task %s failed, %s\n' % (uid, error))
+        with self.lock:
+            task = self.forget(uid)
+        if task is None:
+            return
+        task.update(runnable.TaskFailed, dict(error = error))
+        if self.on_update is not None:
+            try:
+                self.on_update(task)
+            except Exception:
+                sys.stderr.write(traceback.format_exc())
+
+    def check(self):
+        ''' Fail the tasks of the calls failed outside of the run_job and the tasks of the dead workers. '''
+        # Dead workers are joined, so they're not active
+        alive = set([process.pid for process in multiprocessing.active_children()])
+        lost = []
+        with self.lock:
+            for (uid, call) in self.calls.items():
+                if call.ready():
+                    # Finished call has reported the final state, unless it failed
+                    if not call.successful():
+                        try:
+                            call.get(0)
+                        except Exception as err:
+                            lost.append((uid, 'worker call failed: %s' % err))
+                elif uid in self.workers and self.workers[uid] not in alive:
+                    lost.append((uid, 'worker process died'))
+        for (uid, error) in lost:
+            self.fail(uid, error)
+
+    def pending(self):
+        ''' Return the number of queued and running tasks. '''
+        with self.lock:
+            return len(self.jobs)
+
+    def submit(self, runnable_id, dataset, params, output = None, on_submit = None):
+        ''' Enqueue the task and return it at once, it's run by the worker pool. Returns None
+            if the runnable doesn't exist or the queue is full. The on_submit(task) is called
+            before the task is enqueued, so it's registered before its first update. '''
+        if not runnable_id in self.runnable_list:
+            return None
+
+        with self.lock:
+            if len(self.jobs) >= self.queue_depth:
+                return None
+            if self.pool is None:
+                self.start()
+            task = self.runnable(runnable_id)(dataset, params)
+            task.state = runnable.TaskQueued
+            self.jobs[task.uid] = task
+        if on_submit is not None:
+            on_submit(task)
+        call = self.pool.apply_async(run_job, (task, output))
+        with self.lock:
+            # Task may be finished already
+            if task.uid in self.jobs:
+                self.calls[task.uid] = call
+        return task
+
 if __name__ == "__main__":
 
     if len(sys.argv) < 1:
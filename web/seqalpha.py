@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 from flask import Flask, redirect, url_for, render_template, flash, request, session, abort, jsonify, Response
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date
 import os
+import re
+import json
+import zlib
 import pickle
 import genomedb
 import glob
-import runner, runnable
+import runner, runnable, resultdb, registry
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -15,10 +20,22 @@ app.config.update(dict(
     DATA_PATH='data',
     UPLOAD_FOLDER = 'data',
     HOST='0.0.0.0',
-    PORT=5000
+    PORT=5000,
+    JOB_PROCESSES=2,
+    JOB_QUEUE_DEPTH=32,
+    GZIP_FILES=True,
+    SEARCH_TTL=7*24*3600
 ))
 
 ALLOWED_EXTENSIONS = set(['fasta', 'gff', 'gz'])
+# Default and maximum number of rows in a result page
+PAGE_ROWS = 50
+PAGE_ROWS_MAX = 100000
+# Interval [s] of the keep-alive comments in the event streams
+STREAM_KEEPALIVE = 15.0
+# Size of the chunks of the downloaded files
+FILE_CHUNK = 64 * 1024
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
@@ -30,49 +47,66 @@ def utility_processor():
         return os.path.basename(path)
     return dict(basename = basename)
 
-g_searches = {}
-g_runner = runner.Runner()
+g_results = resultdb.ResultDB()
+g_registry = registry.Registry(g_results)
+g_runner = runner.Runner(app.config['JOB_PROCESSES'], app.config['JOB_QUEUE_DEPTH'], g_results, g_registry.save_task)
 g_datadb = genomedb.GenomeDB(app.config['DATA_PATH'])
 
-
-def search_filename(uuid):
-    ''' Assume uuid is safe as it was found in the g_searches map. '''
-    return '%s/%s.pkl' % (runnable.RESULT_PATH, uuid)
-
 def find_task(uuid):
-    for search in g_searches.values():
-        for task in search.task_list:
-            if task.uid == uuid:
-                return task
-    return None
+    return g_registry.task(uuid)
+
+def discard_task(task):
+    ''' Remove the stored results and the output of the task of a removed search. '''
+    g_results.remove(task.uid)
+    # Only the outputs written by the tasks are removed, not the input data sets
+    data_out = task.data_out
+    if data_out and os.path.dirname(os.path.abspath(data_out)) == os.path.abspath(runnable.RESULT_PATH) \
+       and os.path.isfile(data_out):
+        os.remove(data_out)
 
 def remove_task(uuid):
-    for search in g_searches.values():
-        for task in search.task_list:
-            if task.uid == uuid:
-                # @todo Some destructor to remove data as well
-                search.task_list.remove(task)
-                if search.task_list == 0:
-                    del g_searches[search.uid]
-                return True
-    return False
+    task = g_registry.remove_task(uuid)
+    if task is None:
+        return False
+    # The output is kept, the refined tasks may read it
+    g_results.remove(uuid)
+    return True
+
+def remove_search(uuid):
+    for task in g_registry.remove_search(uuid):
+        discard_task(task)
+
+def expire_searches():
+    ''' Remove volatile searches unused for the SEARCH_TTL. '''
+    for task in g_registry.expire(app.config['SEARCH_TTL']):
+        discard_task(task)
 
 def make_search_persistent(uuid):
-    if uuid in g_searches:
-        search = g_searches[uuid]
-        search.persistent = True
-        pickle.dump(search, open(search_filename(uuid), 'wb'))
+    g_registry.set_persistent(uuid, True)
 
 def make_search_volatile(uuid):
-    if uuid in g_searches:
-        search = g_searches.pop(uuid, None)
-        os.remove(search_filename(uuid))
+    remove_search(uuid)
 
 def load_persistent():
+    ''' Mark the tasks interrupted by the restart as failed and move searches saved
+        by the older versions (pickle files) to the registry. '''
+    for task in g_registry.tasks(runnable.TaskQueued, runnable.TaskRunning):
+        task.update(runnable.TaskFailed, dict(error = 'interrupted'))
+        g_registry.save_task(task)
     for pkl in glob.glob(runnable.RESULT_PATH + '/*.pkl'):
         search = pickle.load(open(pkl, 'rb'))
-        if len(search.task_list) > 0:
-            g_searches[search.uid] = search
+        if not g_registry.has_search(search.uid) and len(search.task_list) > 0:
+            g_registry.add_search(search.uid, persistent = True)
+            # Tasks are listed the newest first
+            for task in reversed(search.task_list):
+                # Tasks unfinished at the time of saving will never finish
+                if task.state in (runnable.TaskQueued, runnable.TaskRunning):
+                    task.update(runnable.TaskFailed, dict(error = 'interrupted'))
+                if task.state == runnable.TaskDone:
+                    g_results.store(task.uid, len(task.fields), task.result)
+                g_registry.add_task(search.uid, task)
+        os.remove(pkl)
+    expire_searches()
 
 @app.errorhandler(404)
 def page_not_found(error):
@@ -81,7 +115,7 @@ def page_not_found(error):
 @app.route("/")
 def index():
     if 'search_id' in session:
-        if session['search_id'] in g_searches:
+        if g_registry.has_search(session['search_id']):
             return redirect(url_for('search', search_id = session['search_id']))
     return render_template('query.html', datasets = g_datadb.list(), runnables = g_runner.info_list())
 
@@ -101,7 +135,7 @@ def examples():
 
 @app.route("/saved")
 def saved():
-    return render_template('saved.html', searches = filter(lambda k: k.persistent, g_searches.values()), \
+    return render_template('saved.html', searches = g_registry.searches(persistent = True), \
                            datasets = g_datadb.list(), runnables = g_runner.info_list())
 
 @app.route('/query', methods=['POST'])
@@ -114,38 +148,46 @@ def query():
         task = find_task(request.form['uuid'])
         if task is None:
             abort(404)
+        # Results of the unfinished task are not complete yet
+        if task.state != runnable.TaskDone:
+            abort(409)
         dataset = task.data_out
     else:
         abort(404)
+    if request.form['runner'] not in g_runner.runnable_list:
+        abort(404)
 
-    # Run a new task
-    task = g_runner.run(request.form['runner'], dataset, request.form)
-
-    # Start a new session if not exists
-    if ('search_id' not in session) or (session['search_id'] not in g_searches):
-        session['search_id'] = task.uid
-        g_searches[task.uid] = runnable.Search(task.uid)
-
-    g_searches[ session['search_id'] ].task_list.insert(0, task)
+    # Enqueue a new task, refuse it if the queue is full
+    def add_task(task):
+        # Start a new session if not exists
+        if ('search_id' not in session) or not g_registry.has_search(session['search_id']):
+            expire_searches()
+            session['search_id'] = task.uid
+            g_registry.add_search(task.uid)
+        g_registry.add_task(session['search_id'], task)
+    task = g_runner.submit(request.form['runner'], dataset, request.form, on_submit = add_task)
+    if task is None:
+        abort(503)
     return redirect(url_for('search', search_id = session['search_id']))
 
 @app.route('/reset')
 def reset():
     if 'search_id' in session:
         uuid = session['search_id']
-        if uuid in g_searches:
-            if not g_searches[uuid].persistent:
-                g_searches.pop(uuid, None)
+        search = g_registry.search(uuid)
+        if search is not None and not search.persistent:
+            remove_search(uuid)
     session.clear()
     return redirect(url_for('index'))
 
 @app.route('/search/<search_id>')
 def search(search_id):
-    if not search_id in g_searches:
+    search = g_registry.search(search_id)
+    if search is None:
         abort(404)
-    else:
-        session['search_id'] = search_id
-    return render_template('search.html', search = g_searches[search_id], datasets = g_datadb.list(), runnables = g_runner.info_list())
+    session['search_id'] = search_id
+    g_registry.touch(search_id)
+    return render_template('search.html', search = search, datasets = g_datadb.list(), runnables = g_runner.info_list())
 
 @app.route('/_result')
 def _result():
@@ -153,7 +195,81 @@ def _result():
     task = find_task(uuid)
     if not task:
         abort(404)
-    return jsonify(task = task.pickle())
+    data = task.pickle()
+    # Results are paged through the /_rows
+    if not request.args.get('rows', 1, type=int):
+        data['total'] = len(data.pop('result'))
+    else:
+        data['result'] = list(data['result'])
+    return jsonify(task = data)
+
+@app.route('/_rows')
+def _rows():
+    ''' Return page of the finished task results. The parameters are 'offset' and 'limit' of the page,
+        'sort' column (field name or index) and 'order' ('asc' or 'desc'), 'filter[]' list of
+        '<column><op><value>' filters (op is one of >=, <=, !=, >, <, = or ~ for a substring) and
+        the 'columns' comma-separated list of the returned columns. '''
+    uuid = request.args.get('uuid', '', type=str)
+    task = find_task(uuid)
+    if not task:
+        abort(404)
+    if task.state != runnable.TaskDone:
+        abort(409)
+    try:
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', PAGE_ROWS, type=int), 0), PAGE_ROWS_MAX)
+        sort = request.args.get('sort', '', type=str)
+        sort = resultdb.column_index(sort, task.fields) if sort else None
+        descending = (request.args.get('order', 'asc', type=str) == 'desc')
+        filters = [resultdb.parse_filter(text, task.fields) for text in request.args.getlist('filter[]')]
+        columns = request.args.get('columns', '', type=str)
+        columns = [resultdb.column_index(column, task.fields) for column in columns.split(',')] if columns else None
+    except ValueError:
+        abort(400)
+    (total, rows) = g_results.page(task.uid, offset, limit, sort, descending, filters, columns)
+    return jsonify(total = total, offset = offset, limit = limit, rows = rows)
+
+def stream_event(event, data):
+    ''' Format Server-Sent Event with the JSON data. '''
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+@app.route('/_stream')
+def _stream():
+    ''' Stream the task progress and the new result rows as Server-Sent Events. The 'progress' event
+        is sent on each update, the 'rows' event with the rows produced since the last one while the
+        task is running, and the 'done' event once it's finished. The final results may be sorted
+        differently, so they're not streamed. The 'offset' parameter skips the rows already seen. '''
+    uuid = request.args.get('uuid', '', type=str)
+    offset = request.args.get('offset', 0, type=int)
+    task = find_task(uuid)
+    if not task:
+        abort(404)
+    def generate():
+        (version, sent) = (None, offset)
+        while True:
+            # The task may be run by another process, its updates are read from the registry
+            current = g_registry.wait(uuid, version, STREAM_KEEPALIVE) if version is not None else task.version
+            if current is None:
+                return
+            if current == version:
+                yield ': keepalive\n\n'
+                continue
+            version = current
+            current = g_registry.task(uuid)
+            if current is None:
+                return
+            state = current.state
+            progress = dict(state = state, processed = current.processed, planned = current.planned, progress = current.progress())
+            yield stream_event('progress', progress)
+            if state in (runnable.TaskDone, runnable.TaskFailed):
+                yield stream_event('done', dict(state = state, error = current.error))
+                return
+            total = len(current.result)
+            if total > sent:
+                yield stream_event('rows', dict(offset = sent, rows = current.result[sent:total]))
+                sent = total
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(), mimetype = 'text/event-stream', headers = headers)
 
 @app.route('/_remove')
 def _remove():
@@ -204,15 +320,84 @@ def getfile(uuid, inout):
     file_name = task.data_in 
     if 'out' in inout:
         file_name = task.data_out
-    file_object = open(file_name)
-    def generate():
-        yield file_object.read(4096)
-    return Response(generate(), mimetype='text/plain')
+    if file_name is None or not os.path.isfile(file_name):
+        abort(404)
+    size = os.path.getsize(file_name)
+    modified = http_date(os.path.getmtime(file_name))
+    headers = {'Accept-Ranges': 'bytes', 'Last-Modified': modified}
+    # Range of a different file version is ignored
+    byte_range = request.headers.get('Range')
+    if request.headers.get('If-Range', modified) != modified:
+        byte_range = None
+    try:
+        byte_range = file_range(byte_range, size)
+    except ValueError:
+        headers['Content-Range'] = 'bytes */%d' % size
+        return Response(status = 416, headers = headers)
+    file_object = open(file_name, 'rb')
+    # Whole file is compressed on the fly if the client accepts it
+    if byte_range is None and app.config['GZIP_FILES'] and not file_name.endswith('.gz') \
+       and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        return Response(gzip_chunks(read_chunks(file_object, 0, size)), mimetype = 'text/plain', headers = headers)
+    (start, end, status) = (0, size, 200)
+    if byte_range is not None:
+        (start, end, status) = byte_range + (206,)
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+    headers['Content-Length'] = str(end - start)
+    # Tail of the file is passed to the server, which may send it without copying
+    if end == size:
+        file_object.seek(start)
+        body = wrap_file(request.environ, file_object, FILE_CHUNK)
+    else:
+        body = read_chunks(file_object, start, end - start)
+    return Response(body, status = status, mimetype = 'text/plain', headers = headers, direct_passthrough = True)
+
+def file_range(header, size):
+    ''' Parse the single byte range of the Range header, returns (start, end) with the end excluded,
+        or None if there's no valid range. Raises ValueError if the range is unsatisfiable. '''
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    (start, end) = match.groups()
+    if start == '':
+        # Suffix range, the last bytes of the file
+        (start, end) = (max(size - int(end), 0), size)
+    elif end and int(end) < int(start):
+        # Invalid range is ignored, the whole file is sent
+        return None
+    else:
+        (start, end) = (int(start), min(int(end) + 1, size) if end else size)
+    if start >= size or start >= end:
+        raise ValueError('unsatisfiable range "%s"' % header)
+    return (start, end)
+
+def read_chunks(file_object, start, length):
+    ''' Read the file part in chunks, the file is closed at the end. '''
+    try:
+        file_object.seek(start)
+        while length > 0:
+            chunk = file_object.read(min(FILE_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file_object.close()
+
+def gzip_chunks(chunks):
+    ''' Compress the chunks as a gzip stream. '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 if __name__ == "__main__":
 
-    # Load pickled searches
+    # Recover the registry after the restart
     load_persistent()
 
     # Run app
-    app.run(host = app.config['HOST'], port = app.config['PORT'])
+    app.run(host = app.config['HOST'], port = app.config['PORT'], threaded = True)
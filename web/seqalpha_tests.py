@@ -1,13 +1,216 @@
 import os
+import sys
+import time
+import json
+import zlib
+import multiprocessing
 import seqalpha
+import runner
 import unittest
 
 class WebTestCase(unittest.TestCase):
 
     def setUp(self):
-        pass
+        seqalpha.app.config['TESTING'] = True
+        self.app = seqalpha.app.test_client()
+        self.searches = set()
     def tearDown(self):
-        pass
+        for uuid in self.searches:
+            seqalpha.remove_search(uuid)
+
+    def wait(self, task, timeout = 30.0):
+        ''' Wait until the task is done or failed, returns its registered state. '''
+        start = time.time()
+        task = seqalpha.find_task(task.uid)
+        while task.state in ('queued', 'running') and time.time() - start < timeout:
+            time.sleep(0.1)
+            task = seqalpha.find_task(task.uid)
+        return task
+
+    def submit(self, **form):
+        ''' Submit the query, returns the new task. '''
+        form.setdefault('dataset', 'data/5UTRaspic_small.fasta')
+        response = self.app.post('/query', data = form)
+        self.assertEqual(response.status_code, 302)
+        with self.app.session_transaction() as session:
+            search = seqalpha.g_registry.search(session['search_id'])
+        self.searches.add(search.uid)
+        return search.task_list[0]
+
+    def test_query_enqueued(self):
+        task = self.submit(runner = 'pattern', query = 'g{3,}[acgtu]{1,7}g{3,}')
+        self.assertIn(task.state, ('queued', 'running', 'done'))
+        task = self.wait(task)
+        self.assertEqual(task.state, 'done')
+        self.assertEqual(task.processed, 500)
+        self.assertEqual(task.progress(), 1.0)
+        self.assertTrue(os.path.getsize(task.data_out) > 0)
+
+    def test_stream(self):
+        task = self.submit(runner = 'cgscore', limit = '1')
+        response = self.app.get('/_stream?uuid=' + task.uid)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = [event.split('\n') for event in ''.join(response.response).split('\n\n') if event.startswith('event:')]
+        self.assertEqual(events[-1][0], 'event: done')
+        self.assertEqual(events[-2][0], 'event: progress')
+        self.assertIn('"progress": 1.0', events[-2][1])
+        # Streamed rows are contiguous
+        offset = 0
+        for (event, data) in events:
+            if event == 'event: rows':
+                rows = json.loads(data[len('data: '):])
+                self.assertEqual(rows['offset'], offset)
+                offset += len(rows['rows'])
+        self.assertTrue(offset <= len(self.wait(task).result))
+
+    def rows(self, task, **params):
+        ''' Return page of the task results. '''
+        params['uuid'] = task.uid
+        response = self.app.get('/_rows', query_string = params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_rows(self):
+        task = self.wait(self.submit(runner = 'cgscore', limit = '1'))
+        response = self.app.get('/_result', query_string = {'uuid': task.uid, 'rows': 0})
+        self.assertEqual(json.loads(response.data)['task']['total'], len(task.result))
+        page = self.rows(task)
+        self.assertEqual(page['total'], len(task.result))
+        self.assertEqual(page['rows'], [list(row) for row in task.result[:50]])
+        page = self.rows(task, offset = 10, limit = 5, sort = 2, order = 'desc')
+        expected = sorted(task.result, key = lambda row: row[2], reverse = True)[10:15]
+        self.assertEqual([row[2] for row in page['rows']], [row[2] for row in expected])
+        page = self.rows(task, limit = 1000, columns = '0,1', **{'filter[]': ['1>=20', '0~hsa']})
+        expected = [row for row in task.result if row[1] >= 20 and 'hsa' in row[0].lower()]
+        self.assertEqual(page['total'], len(expected))
+        self.assertEqual(page['rows'], [[row[0], row[1]] for row in expected])
+        response = self.app.get('/_rows', query_string = {'uuid': task.uid, 'sort': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_getfile(self):
+        task = self.wait(self.submit(runner = 'cgscore', limit = '1'))
+        url = '/getfile/%s/in' % task.uid
+        with open(task.data_in, 'rb') as f:
+            content = f.read()
+        response = self.app.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, content)
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        response = self.app.get(url, headers = {'Range': 'bytes=100-199'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, content[100:200])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 100-199/%d' % len(content))
+        response = self.app.get(url, headers = {'Range': 'bytes=-10'})
+        self.assertEqual(response.data, content[-10:])
+        response = self.app.get(url, headers = {'Range': 'bytes=%d-' % len(content)})
+        self.assertEqual(response.status_code, 416)
+        response = self.app.get(url, headers = {'Range': 'bytes=5-3'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, content)
+        response = self.app.get(url, headers = {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.data, zlib.MAX_WBITS | 16), content)
+
+    def test_registry(self):
+        first = self.wait(self.submit(runner = 'cgscore', limit = '1'))
+        second = self.submit(runner = 'pattern', uuid = first.uid, query = 'g{3,}[acgtu]{1,7}g{3,}')
+        search = seqalpha.g_registry.search(first.uid)
+        self.assertEqual([task.uid for task in search.task_list], [second.uid, first.uid])
+        # Results are read from the result store, not kept with the task
+        self.assertEqual(len(first.result), seqalpha.g_results.count(first.uid))
+        self.assertEqual(first.result[:3], seqalpha.g_results.page(first.uid, 0, 3)[1])
+        self.wait(second)
+        # Saved searches don't expire, volatile searches unused for the TTL do
+        ttl = seqalpha.app.config['SEARCH_TTL']
+        seqalpha.app.config['SEARCH_TTL'] = -1
+        try:
+            seqalpha.make_search_persistent(search.uid)
+            seqalpha.expire_searches()
+            self.assertTrue(seqalpha.g_registry.has_search(search.uid))
+            seqalpha.g_registry.set_persistent(search.uid, False)
+            seqalpha.expire_searches()
+        finally:
+            seqalpha.app.config['SEARCH_TTL'] = ttl
+        self.assertFalse(seqalpha.g_registry.has_search(search.uid))
+        self.assertIsNone(seqalpha.find_task(first.uid))
+        self.assertEqual(seqalpha.g_results.count(first.uid), 0)
+        self.assertFalse(os.path.exists(first.data_out))
+
+    def test_query_unknown_runner(self):
+        response = self.app.post('/query', data = dict(dataset = 'data/5UTRaspic_small.fasta', runner = 'nope'))
+        self.assertEqual(response.status_code, 404)
+
+class RunnerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.updates = []
+        self.runner = runner.Runner(1, 4, on_update = self.on_update)
+        self.tasks = []
+    def tearDown(self):
+        if self.runner.pool is not None:
+            self.runner.pool.terminate()
+        for task in self.tasks:
+            if task.data_out and os.path.exists(task.data_out):
+                os.remove(task.data_out)
+
+    def on_update(self, task):
+        self.updates.append(task.uid)
+        # First update can't be passed on
+        if len(self.updates) == 1:
+            raise RuntimeError('broken')
+
+    def submit(self):
+        ''' Submit the task and wait until it's finished. '''
+        task = self.runner.submit('cgscore', 'data/5UTRaspic_small.fasta', {'limit': '1'})
+        self.tasks.append(task)
+        start = time.time()
+        while self.runner.pending() > 0 and time.time() - start < 30.0:
+            time.sleep(0.1)
+        return task
+
+    def test_failed_update(self):
+        task = self.submit()
+        self.assertEqual(task.state, 'failed')
+        self.assertIn('broken', task.error)
+        # Collector carries on with the other tasks
+        task = self.submit()
+        self.assertEqual(task.state, 'done')
+
+    def test_quadclass_progress(self):
+        quadclass = self.runner.runnable('quadclass')
+        module = sys.modules[quadclass.__module__]
+        task = quadclass('data/5UTRaspic_small.fasta', {})
+        predictor = module.seqlearn.load_predictor('runnables/quadclasslib/gqclass-mono.tsv')
+        # Progress and the results seen by the worker sampler at each batch
+        seen = []
+        class Recorder:
+            def fit_batch(self, queries):
+                seen.append((task.progress(), len(task.result)))
+                return predictor.fit_batch(queries)
+        (load_predictor, batch_size) = (module.seqlearn.load_predictor, module.BATCH_SIZE)
+        (module.seqlearn.load_predictor, module.BATCH_SIZE) = (lambda path: Recorder(), 100)
+        try:
+            task.run(os.devnull)
+        finally:
+            (module.seqlearn.load_predictor, module.BATCH_SIZE) = (load_predictor, batch_size)
+        self.assertEqual(task.processed, 500)
+        self.assertEqual(task.progress(), 1.0)
+        self.assertEqual(seen, [(0.0, 0), (0.2, 100), (0.4, 200), (0.6, 300), (0.8, 400)])
+
+    def test_dead_worker(self):
+        self.submit()
+        process = multiprocessing.Process(target = int)
+        process.start()
+        process.join()
+        task = self.runner.runnable('cgscore')('data/5UTRaspic_small.fasta', {})
+        with self.runner.lock:
+            self.runner.jobs[task.uid] = task
+            self.runner.workers[task.uid] = process.pid
+            self.runner.calls[task.uid] = self.runner.pool.apply_async(time.sleep, (5,))
+        self.runner.check()
+        self.assertEqual(task.state, 'failed')
+        self.assertEqual(task.error, 'worker process died')
+        self.assertEqual(self.runner.pending(), 0)
 
 if __name__ == '__main__':
     unittest.main()
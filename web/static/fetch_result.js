@@ -1,74 +1,236 @@
 var ROW_LIMIT = 50;
+/* Rows of the score charts. */
+var CHART_LIMIT = 100000;
+
+/* Event stream of the shown unfinished task. */
+var task_stream = null;
+
+/* Describe the task state and progress. */
+function task_state(task) {
+	var msg = 'Task is ' + task.state;
+	if (task.state == 'failed' && task.error) {
+		msg += ': ' + task.error;
+	} else if (task.progress >= 0) {
+		msg += ', ' + Math.floor(task.progress * 100) + '% processed';
+	}
+	return msg + '.';
+}
+
+/* Create result table with the heading. */
+function result_table(task) {
+	var table = $('<table class="' + task.type + '"></table');
+	var heading = $('<tr />');
+	for(i in task.fields) {
+		heading.append($('<th>' + task.fields[i] + '</th>'));
+	}
+	table.append(heading);
+	return table;
+}
+
+/* Append result rows to the table, up to the ROW_LIMIT rows are shown. */
+function append_rows(table, task, rows, offset) {
+	for(var i = 0; i < rows.length; ++i) {
+		var row_id = offset + i;
+		if (row_id > ROW_LIMIT) {
+			break;
+		}
+		var row = $('<tr />');
+		row.data('result_id', row_id);
+		for (k in task.fields) {
+			row.append('<td>' + rows[i][k] + '</td>');
+		}
+		table.append(row);
+		if (row_id == ROW_LIMIT) {
+		    var msg = 'Dataset too large, displaying first 100 results...';
+			table.append('<tr><th class="terminator" colspan="' + task.fields.length + '">' + msg + '</td></tr>');
+		}
+	}
+}
+
+/* Stop watching the unfinished task. */
+function unwatch_task() {
+	if (task_stream != null) {
+		task_stream.close();
+		task_stream = null;
+	}
+}
+
+/* Watch the unfinished task, its progress and result rows are shown as they arrive.
+ * The result is loaded again once the task is finished. */
+function watch_task(parent, subresult, task) {
+	var status = $('<div class="centered"></div>').text(task_state(task));
+	var table = result_table(task).hide();
+	subresult.append(status);
+	subresult.append(table);
+	if (typeof(EventSource) == 'undefined') {
+		return;
+	}
+	task_stream = new EventSource($SCRIPT_ROOT + '/_stream?uuid=' + task.uuid);
+	task_stream.addEventListener('progress', function(e) {
+		status.text(task_state(JSON.parse(e.data)));
+	});
+	task_stream.addEventListener('rows', function(e) {
+		var data = JSON.parse(e.data);
+		append_rows(table, task, data.rows, data.offset);
+		table.show();
+	});
+	task_stream.addEventListener('done', function(e) {
+		unwatch_task();
+		load_result(parent);
+	});
+}
+
+/* Task result view, the page of rows is loaded from the server sorted and filtered. */
+function result_view() {
+	return { offset: 0, sort: '', order: 'asc', filter: '' };
+}
+
+/* Convert the filter text to the server filter, plain text is looked up in the first column. */
+function view_filters(view) {
+	var text = $.trim(view.filter);
+	if (text.length == 0) {
+		return [];
+	}
+	if (!text.match(/^\w+\s*(>=|<=|!=|>|<|=|~)/)) {
+		text = '0~' + text;
+	}
+	return [ text ];
+}
+
+/* Create result page controls: filter box, the row range and the previous/next page links. */
+function page_controls(subresult, task, view, total) {
+	var controls = $('<div class="result_pager"></div>');
+	var filter = $('<input type="text" placeholder="Filter, f.e. 1>=100 or text" />').val(view.filter);
+	filter.change(function() {
+		view.filter = $(this).val();
+		view.offset = 0;
+		show_page(subresult, task, view, false);
+	});
+	controls.append(filter);
+	var last = Math.min(view.offset + ROW_LIMIT, total);
+	controls.append(' Rows ' + (total > 0 ? view.offset + 1 : 0) + '-' + last + ' of ' + total + ' ');
+	if (view.offset > 0) {
+		var prev = $('<a href="#">&larr; Previous</a>').click(function() {
+			view.offset = Math.max(view.offset - ROW_LIMIT, 0);
+			show_page(subresult, task, view, false);
+			return false;
+		});
+		controls.append(prev).append(' ');
+	}
+	if (last < total) {
+		var next = $('<a href="#">Next &rarr;</a>').click(function() {
+			view.offset += ROW_LIMIT;
+			show_page(subresult, task, view, false);
+			return false;
+		});
+		controls.append(next);
+	}
+	return controls;
+}
+
+/* Load and show the page of the result rows, the charts are created on the first page. */
+function show_page(subresult, task, view, charts) {
+	var params = { uuid: task.uuid, offset: view.offset, limit: ROW_LIMIT, sort: view.sort, order: view.order,
+	               'filter[]': view_filters(view) };
+	$.getJSON($SCRIPT_ROOT + '/_rows', params, function(data) {
+
+		/* Page is replaced, the charts are kept. */
+		var page = subresult.find('.result_page');
+		if (page.length == 0) {
+			page = $('<div class="result_page"></div>');
+			subresult.append(page);
+		}
+		page.empty();
+		page.append(page_controls(subresult, task, view, data.total));
+
+		/* Create table, the headings sort the rows. */
+		var table = result_table(task);
+		table.find('th').each(function(index) {
+			var heading = $(this).addClass('clickable');
+			if (view.sort == String(index)) {
+				heading.append(view.order == 'asc' ? ' &#x25B2;' : ' &#x25BC;');
+			}
+			heading.click(function() {
+				view.order = (view.sort == String(index) && view.order == 'asc') ? 'desc' : 'asc';
+				view.sort = String(index);
+				view.offset = 0;
+				show_page(subresult, task, view, false);
+			});
+		});
+		page.append(table);
+		append_rows(table, task, data.rows, 0);
+
+		/* FASTA table visualization, the first page has the ratio. */
+		if (charts) {
+			jQuery.fastaTable(table, $.extend({}, task, { result: data.rows }));
+		}
+
+		/* Score results table, the charts need the first two columns of all rows. */
+		jQuery.scoreTable(table, $.extend({}, task, { result: null }));
+		if (charts && (task.type == 'result_gff' || task.type == 'result_score')) {
+			$.getJSON($SCRIPT_ROOT + '/_rows', { uuid: task.uuid, columns: '0,1', limit: CHART_LIMIT }, function(data) {
+				jQuery.scoreCharts(page, $.extend({}, task, { result: data.rows }));
+			});
+		}
+
+		/* GQ topology. */
+		jQuery.topologyTable(table, task);
+	});
+}
+
+/* Load and show the task result. */
+function load_result(parent) {
+	$.getJSON($SCRIPT_ROOT + '/_result', { uuid: parent.data('uuid'), rows: 0 }, function(data) {
+
+		var task = data.task;
+		var subresult = $('<div class="subresult"><h4>Query results in table</h4></div>');
+
+		/* Hook the results table in the container. */
+		$('#result').empty();
+		$('#result').appendTo(parent);
+		$('#result').append(subresult);
+
+		/* Watch unfinished task. */
+		if (task.state == 'queued' || task.state == 'running') {
+			watch_task(parent, subresult, task);
+			return;
+		}
+		if (task.state != 'done') {
+			subresult.append('<div class="centered">' + task_state(task) + '</div>');
+			return;
+		}
+
+		/* Check empty result. */
+		if (task.total == 0) {
+            subresult.append('<div class="centered">No results, try something else.</div>');
+            return;
+		}
+
+		show_page(subresult, task, result_view(), true);
+	});
+}
 
 $(function () {
 
 	$('a.result_show').bind('click', function() {
 
 		var parent = $(this).parent().parent();
-		var load_result = !parent.hasClass('active_result');
+		var show_result = !parent.hasClass('active_result');
 
 		/* Hide all current result tables. */
+		unwatch_task();
         $('.result').removeClass('active_result');
         $('a.result_show').text('Show');
         $('#result').empty();
 		$('#result').hide();
 
 		/* Return if we're not going to show a result. */
-		if (!load_result) {
+		if (!show_result) {
 		    return;
 		}
 
         /* Load current result. */
-		$.getJSON($SCRIPT_ROOT + '/_result', { uuid: parent.data('uuid') }, function(data) {
-
-			var task = data.task;
-			var subresult = $('<div class="subresult"><h4>Query results in table</h4></div>');
-
-			/* Hook the results table in the container. */
-			$('#result').empty();
-			$('#result').appendTo(parent);
-			$('#result').append(subresult);
-
-			/* Check empty result. */
-			if (task.result.length == 0) {
-                subresult.append('<div class="centered">No results, try something else.</div>');
-                return;
-			}
-
-            var table = $('<table class="' + task.type + '"></table');
-			subresult.append(table);
-
-            /* Create table heading. */
-			var heading = $('<tr />');
-			for(i in task.fields) {
-				heading.append($('<th>' + task.fields[i] + '</th>'));
-			}
-			table.append(heading);
-
-            /* Create table data. */
-			for(i in task.result) {
-				var row = $('<tr />');
-				row.data('result_id', i);
-				for (k in task.fields) {
-					row.append('<td>' + task.result[i][k] + '</td>');
-				}
-				table.append(row);
-				if (i == ROW_LIMIT) {
-				    var msg = 'Dataset too large, displaying first 100 results...';
-					table.append('<tr><th class="terminator" colspan="' + task.fields.length + '">' + msg + '</td></tr>');
-					break;
-				}
-			}
-
-            /* FASTA table visualization. */
-            jQuery.fastaTable(table, task);
-
-            /* Score results table. */
-			jQuery.scoreTable(table, task);
-
-			/* GQ topology. */
-			jQuery.topologyTable(table, task);
-		});
+		load_result(parent);
 
         /* Mark this result as currently visible. */
         parent.addClass('active_result');
@@ -81,6 +243,7 @@ $(function () {
     $('a.result_del').bind('click', function() {
 
         var parent = $(this).parent().parent();
+		unwatch_task();
 	    $.getJSON($SCRIPT_ROOT + '/_remove', { uuid: parent.data('uuid') });
         $('#result').empty();
 		$('#result').hide();
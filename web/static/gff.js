@@ -89,6 +89,17 @@ $(function () {
         return false;
     }
 
+	jQuery.scoreCharts = function (container, task) {
+
+		/* Hook to GFF/Score results only. */
+		if (task.type != 'result_gff' && task.type != 'result_score') {
+		    return;
+		}
+
+		/* Create histogram and partition charts after the container. */
+		createScoreCharts(container, task.fields, task.result);
+	}
+
 	jQuery.scoreTable = function (table, task) {
 
 		/* Hook to GFF/Score results only. */
@@ -96,8 +107,10 @@ $(function () {
 		    return;
 		}
 
-		/* Create histogram and partition charts. */
-		createScoreCharts(table, task.fields, task.result);
+		/* Create histogram and partition charts, unless only the table page is updated. */
+		if (task.result) {
+			createScoreCharts(table, task.fields, task.result);
+		}
 
         /* Make RefSeq/Locus clickable. */
 		table.find("tr").each(function () {
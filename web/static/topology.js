@@ -17,6 +17,10 @@ $(function () {
         case 'composition': /* Sequence similarity. */
             ret = 'Loops nucleotide composition <b>' + arg + '</b>';
 			break;
+        case 'similarity': /* Most similar known loops, the value is 1 - Dice coefficient of the loop k-mers. */
+            ret = 'Loop sequences similar to the known loops <b>' + arg.split('|').join(', ') + '</b> of this GQ family.';
+            ret += ' <i>( k-mer distance = ' + pval + ' )</i>';
+            return ret;
         }
 
 		ret += ' <i>( P-value = ' + pval + ' )</i>';